@@ -6,19 +6,81 @@
 #
 
 declare -A HASH_DATA
+# file -> seconds since its last-ok, see hash.lastok.load
+declare -A HASH_LASTOK
 declare -A HASHER_CFG
-declare -A HASHER_QUEUE
-declare -A REMOTE_QUEUE
-declare -A HASHER_DELTA_LAST_OK
 
-HASHER_QUEUE_FILE=""
-REMOTE_QUEUE_FILE=""
+# remote queue of failed/incomplete remote patching, revisited by hash.remote.revisit.queue
+REMOTE_QUEUE="remote"
 
 #HASHER_CFG["FILEHASHER"]="/export/disk-1/home/loc_adm/Syncthing/src/avahi-backup/filehasher.py"
 HASHER_CFG["FILEHASHER"]="filehasher.py"
+# 1 = page cache friendly reads/writes (fadvise), large images next to running containers
+HASHER_CFG["IO_MODE"]="1"
+# "some avg10" pressure SLOW:PAUSE, hashing slows down/stops instead of hurting the host
+HASHER_CFG["PSI_IO"]="20:60"
+HASHER_CFG["PSI_CPU"]="50:90"
+# one json line per filehasher run (bytes, chunks, phase times), see hash.metrics.summary
+HASHER_CFG["METRICS"]="${HOME}/.cache/avahi-backup/metrics.jsonl"
+# chunks compared with the hashfile per run (N or P%), see hash.spot_check
+HASHER_CFG["SPOT_CHECK"]="1%"
+# seconds to revisit the hashing/remote queue, shared by all queued files
+HASHER_CFG["QUEUE_BUDGET"]="600"
 
 HASHER_CFG["local.version"]="$("${HASHER_CFG["FILEHASHER"]}" --version)"
 
+function hash.governor.args() {
+   # io governor options, see filehasher.py --help
+   echo --psi-io "${HASHER_CFG["PSI_IO"]}" --psi-cpu "${HASHER_CFG["PSI_CPU"]}"
+   for item in ${BLACKLIST_PROCESS[@]}
+   do
+      echo --pause-process "${item}"
+   done
+}
+
+function hash.state.args() {
+   # sqlite store of the queues and last-ok times of this backup root
+   echo --state "${RUNTIME["BACKUP_ROOT"]}/backup.avahi/hashes/.state.sqlite"
+}
+
+function hash.state.migrate() {
+   # declare -p files of older versions go into the state store once
+   local file
+   for file in "${RUNTIME["BACKUP_ROOT"]}/.hasher-queue" "${RUNTIME["BACKUP_ROOT"]}/backup.avahi/hashes/.cache"
+   do
+      if [ -e "${file}" ]
+      then
+         output "- import ${file} into the state store"
+         "${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) --state-import "${file}"
+      fi
+   done
+}
+
+function hash.metrics.args() {
+   # metrics of the run, labeled with the host it is done for
+   mkdir -p "$(dirname "${HASHER_CFG["METRICS"]}")"
+   echo --metrics "${HASHER_CFG["METRICS"]}" --metrics-label "host=${RUNTIME["BACKUP_HOSTNAME"]:-$(hostname)}"
+}
+
+function hash.metrics.summary() {
+   # summary handler: throughput of the filehasher runs since the start, per host
+   # (the file may have been rotated to .1 during the run)
+   local line
+   local -a files=()
+   [ -e "${HASHER_CFG["METRICS"]}" ] || return 0
+   [ -e "${HASHER_CFG["METRICS"]}.1" ] && files+=( "${HASHER_CFG["METRICS"]}.1" )
+   files+=( "${HASHER_CFG["METRICS"]}" )
+   while read -r line
+   do
+      SUMMARY[${#SUMMARY[@]}]="M.HASHER: ${line}"
+   done < <(jq -rs --argjson since "${RUNTIME["START_EPOCH"]:-0}" '
+      def mb: . / 1048576 | floor;
+      map(select(.start >= $since)) | group_by(.labels.host // "-")[] |
+      (map(.seconds) | add) as $seconds |
+      "host[\(.[0].labels.host // "-")] runs[\(length)] read[\(map(.counters.bytes_read) | add | mb)MB] hashed[\(map(.counters.bytes_hashed) | add | mb)MB] skipped[\(map(.counters.chunks_skipped) | add)] transferred[\(map(.counters.chunks_transferred) | add)] sent[\(map(.counters.bytes_sent) | add | mb)MB] received[\(map(.counters.bytes_received) | add | mb)MB] written[\(map(.counters.bytes_written) | add | mb)MB] in \($seconds | floor)s"
+   ' "${files[@]}")
+}
+
 function remote.hasher.version() {
    # $1 ... remote hostname
    if [ -z "${HASHER_CFG["remote.$1.version"]}" ]
@@ -41,106 +103,47 @@ function remote.hasher.version() {
 function hash.remote.add2queue() {
    # $1 ... name
    # $2+ .. all attributes
-   if [ ! -z "${REMOTE_QUEUE_FILE}" ]
+   if [ ! -z "${REMOTE_QUEUE}" ]
    then
-      touch "${REMOTE_QUEUE_FILE}"
-      source "${REMOTE_QUEUE_FILE}"
-      local item="${1}"
-      shift 
-      REMOTE_QUEUE["${item}"]="{ 'args': '${@}' }"
-      output "- save remote queue[${REMOTE_QUEUE_FILE}] with #${#REMOTE_QUEUE[@]} entries"
-      declare -p REMOTE_QUEUE > "${REMOTE_QUEUE_FILE}"
+      shift
+      "${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) --queue-add "${REMOTE_QUEUE}" "${@}"
    fi
 }
 
+function hash.remote.batch2queue() {
+   # $1 ... local file
+   # $2 ... remote src file
+   # $3 ... chunk-size
+   # $4 ... remote host
+   hash.remote.add2queue "${1}" "--min-chunk-size=${3}" \
+      --inputfile "${1}" \
+      --hashfile "$(hash.gen_full_hash_filename "${1}")" \
+      --remote-patching \
+      --remote-host "${4}" \
+      --remote-username "$(id -un)" \
+      --remote-ssh-key ".ssh/backup" \
+      --remote-src-file "${2}"
+}
+
 function hash.remote.remove_from_queue() {
    # $1 ... name
-   if [ ! -z "${REMOTE_QUEUE_FILE}" ]
+   if [ ! -z "${REMOTE_QUEUE}" ]
    then
-      touch "${REMOTE_QUEUE_FILE}"
-      source "${REMOTE_QUEUE_FILE}"
-      unset REMOTE_QUEUE["${1}"]
-      output "- save remote queue[${REMOTE_QUEUE_FILE}] with #${#REMOTE_QUEUE[@]} entries"
-      declare -p REMOTE_QUEUE > "${REMOTE_QUEUE_FILE}"
+      "${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) --queue-remove "${REMOTE_QUEUE}" --inputfile "${1}"
    fi
 }
 
 function hash.remote.revisit.queue() {
 
-   # $1 ... define queue file
-   REMOTE_QUEUE_FILE="${1}"
-
-   if [ -e "${REMOTE_QUEUE_FILE}" ]
-   then
-      # shellcheck disable=SC1091
-      if source "${REMOTE_QUEUE_FILE}"
-      then
-         output "- sourcing hasher queue[${REMOTE_QUEUE_FILE}]..."
-         declare -p REMOTE_QUEUE
-      else
-         rm -f "${REMOTE_QUEUE_FILE}"
-      fi
-   else
-      output "- no hasher queue[${REMOTE_QUEUE_FILE}]..."
-   fi
+   # $1 ... queue name in the state store
+   REMOTE_QUEUE="${1:-remote}"
 
-   # execute
-   local -i item_max="${#REMOTE_QUEUE[@]}"
-   if [ ${item_max} -gt 0 ]
-   then
-      local item=""
-      local -i count=0
-      local -i item_count=0
-      local -i time_left=600
-      local chunk_size=""
-      local hash_file=""
-      local -i s_time=0
-      s_time=$(date +%s)
-
-      for item in "${!REMOTE_QUEUE[@]}"
-      do
-         local -i scan_time=$(( time_left / (item_max-item_count) ))
-         if [ ${scan_time} -lt 10 ]
-         then
-            scan_time=10
-         fi
-         # remove from local list
-         output "- remote patching[${count}] item[${item_count}/${item_max}] time left[${time_left} sec] scan time per item[${scan_time}]"
-         output "  - ${item}"
-
-         # remove missing items
-         if [ ! -e "${item}" ]
-         then
-            hash.remote.remove_from_queue "${item}"
-         else
-            timeout ${scan_time} filehasher.py $(echo "${REMOTE_QUEUE[${item}]//\'/\"}" | jq -r '."args"') 
-            stat=${PIPESTATUS[0]}
-            output "stat: ${stat}"
-            if [ ${stat} -eq 124 ]
-            then
-               output "- timeout...keep"
-            elif [ ${stat} -eq 0 ]
-            then
-               output "  - complete. drop from list."
-               hash.remote.remove_from_queue "${item}"
-            fi
-         fi
-         item_count=$(( item_count + 1 ))
-
-         e_time=$(date +%s)
-         time_left=$(( 600 - ( e_time - s_time ) ))
-         if [ ${time_left} -lt 0 ]
-         then
-            break
-         fi
-
-         if check.blacklisted.process
-         then
-            break
-         fi
-
-      done
-   fi
+   # all entries in one filehasher process, one ssh session per host
+   output "- revisit remote queue[${REMOTE_QUEUE}]..."
+   "${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) --queue "${REMOTE_QUEUE}" --queue-budget "${HASHER_CFG["QUEUE_BUDGET"]}" \
+               --thread-mode 1 --io-mode "${HASHER_CFG["IO_MODE"]}" \
+               $(hash.governor.args) $(hash.metrics.args)
+   output "stat: $?"
 
 }
 
@@ -149,20 +152,12 @@ function hash.add2queue() {
    # $1 ... name
    # $2 ... chunk size
    # $3 ... hashfile
-   touch "${HASHER_QUEUE_FILE}"
-   source "${HASHER_QUEUE_FILE}"
-   HASHER_QUEUE["${1}"]="{ 'chunk-size': ${2}, 'hashfile': '${3}' }"
-   output "- save hasher queue[${HASHER_QUEUE_FILE}] with #${#HASHER_QUEUE[@]} entries"
-   declare -p HASHER_QUEUE > "${HASHER_QUEUE_FILE}"
+   "${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) --queue-add hasher --inputfile "${1}" --min-chunk-size "${2}" --hashfile "${3}"
 }
 
 function hash.remove_from_queue() {
    # $1 ... name
-   touch "${HASHER_QUEUE_FILE}"
-   source "${HASHER_QUEUE_FILE}"
-   unset HASHER_QUEUE["${1}"]
-   output "- save hasher queue[${HASHER_QUEUE_FILE}] with #${#HASHER_QUEUE[@]} entries"
-   declare -p HASHER_QUEUE > "${HASHER_QUEUE_FILE}"
+   "${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) --queue-remove hasher --inputfile "${1}"
 }
 
 function hash.gen_hash_filename() {
@@ -195,12 +190,14 @@ function hash.local_file() {
    HASH_DATA["${3}"]="${hashfile}"
 
    echo timeout --preserve-status "$1" "${HASHER_CFG["FILEHASHER"]}" "--min-chunk-size=$2" \
-                  --inputfile "${3}" --thread-mode 1 \
+                  --inputfile "${3}" --thread-mode 1 --io-mode "${HASHER_CFG["IO_MODE"]}" \
+                  $(hash.governor.args) $(hash.metrics.args) \
                   --hashfile "${hashfile}"
 
 
    timeout --preserve-status "$1" "${HASHER_CFG["FILEHASHER"]}" "--min-chunk-size=$2" \
-                  --inputfile "${3}" --thread-mode 1 \
+                  --inputfile "${3}" --thread-mode 1 --io-mode "${HASHER_CFG["IO_MODE"]}" \
+                  $(hash.governor.args) $(hash.metrics.args) \
                   --hashfile "${hashfile}"
 
    stat=$?
@@ -224,74 +221,38 @@ function hash.local_file() {
 
 function hash.revisit.queue() {
 
-   # $1 ... define queue file
-   HASHER_QUEUE_FILE="${1}"
+   # all entries in one filehasher process, files with more left and longer
+   # in the queue get more of the budget
+   output "- revisit hasher queue..."
+   "${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) --queue hasher --queue-budget "${HASHER_CFG["QUEUE_BUDGET"]}" \
+               --thread-mode 1 --io-mode "${HASHER_CFG["IO_MODE"]}" \
+               $(hash.governor.args) $(hash.metrics.args)
+   output "stat: $?"
 
-   if [ -e "${HASHER_QUEUE_FILE}" ]
-   then
-      # shellcheck disable=SC1091
-      if source "${HASHER_QUEUE_FILE}"
-      then
-         output "- sourcing hasher queue[${HASHER_QUEUE_FILE}]..."
-         declare -p HASHER_QUEUE
-      else
-         rm -f "${HASHER_QUEUE_FILE}"
-      fi
-   else
-      output "- no hasher queue[${HASHER_QUEUE_FILE}]..."
-   fi
+}
 
-   # execute
-   local -i item_max="${#HASHER_QUEUE[@]}"
-   if [ ${item_max} -gt 0 ]
+function hash.spot_check() {
+   # $1 ... chunk-size
+   # $2 ... inputfile
+   # $3 ... hashfile (optional)
+   # return 1 ... sampled chunks do not match the hashes, backup copy damaged
+   # return 2 ... could not check (no usable hashes, read errors, ...)
+   local hashfile="${3:-$(hash.gen_full_hash_filename "${2}")}"
+   output "# spot check[$2:${HASHER_CFG["SPOT_CHECK"]}]"
+   "${HASHER_CFG["FILEHASHER"]}" "--min-chunk-size=$1" --inputfile "${2}" --hashfile "${hashfile}" \
+                  --spot-check "${HASHER_CFG["SPOT_CHECK"]}" --io-mode "${HASHER_CFG["IO_MODE"]}" \
+                  $(hash.governor.args) $(hash.metrics.args) | grep -v "^{"
+   local -i stat=${PIPESTATUS[0]}
+   if [ ${stat} -eq 3 ]
    then
-      local item=""
-      local -i count=0
-      local -i item_count=0
-      local -i time_left=600
-      local chunk_size=""
-      local hash_file=""
-      local -i s_time=0
-      s_time=$(date +%s)
-
-      for item in "${!HASHER_QUEUE[@]}"
-      do
-         local -i scan_time=$(( time_left / (item_max-item_count) ))
-         if [ ${scan_time} -lt 10 ]
-         then
-            scan_time=10
-         fi
-         # remove from local list
-         output "- local hashing scanned[${count}] item[${item_count}/${item_max}] time left[${time_left} sec] scan time per item[${scan_time}]"
-         output "  - ${item}"
-
-         chunk_size="$(echo "${HASHER_QUEUE[${item}]//\'/\"}" | jq -r '."chunk-size"')"
-         hash_file="$(echo "${HASHER_QUEUE[${item}]//\'/\"}" | jq -r '."hashfile"')"
-
-         # remove missing items
-         if [ ! -e "${item}" ]
-         then
-            hash.remove_from_queue "${item}"
-         else
-            hash.local_file "${scan_time}s" "${chunk_size}" "${item}" "${hash_file}" 
-         fi
-         item_count=$(( item_count + 1 ))
-
-         e_time=$(date +%s)
-         time_left=$(( 600 - ( e_time - s_time ) ))
-         if [ ${time_left} -lt 0 ]
-         then
-            break
-         fi
-
-         if check.blacklisted.process
-         then
-            break
-         fi
-
-      done
+      output "  ! chunks do not match the hashes."
+      return 1
+   elif [ ${stat} -ne 0 ]
+   then
+      output "  ! spot check failed (${stat})."
+      return 2
    fi
-
+   return 0
 }
 
 function hash.remote_file() {
@@ -325,29 +286,47 @@ function hash.remote_file() {
 }
 
 
-function hash.lastok.delta() {
+function hash.lastok.load() {
 
-   # $1 ... file
-   # $2 ... age limit
-   if [ ${#HASHER_DELTA_LAST_OK[@]} -eq 0 ]
+   # $@ ... files
+   # ages of all files in one lookup of the state store, used by hash.lastok.delta
+   local -a keys=()
+   local -a ages=()
+   local file=""
+   local -i idx=0
+   for file in "${@}"
+   do
+      keys+=( --last-ok "$(hash.gen_full_hash_filename "${file}")" )
+   done
+   if [ ${#keys[@]} -eq 0 ]
    then
-      if [ -e "${RUNTIME["BACKUP_ROOT"]}/backup.avahi/hashes/.cache" ]
-      then
-         if source "${RUNTIME["BACKUP_ROOT"]}/backup.avahi/hashes/.cache"
-         then
-            :
-         else
-            rm -f "${RUNTIME["BACKUP_ROOT"]}/backup.avahi/hashes/.cache"
-         fi
-      fi
+      return 0
    fi
+   mapfile -t ages < <("${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) "${keys[@]}")
+   for file in "${@}"
+   do
+      HASH_LASTOK["${file}"]="${ages[${idx}]:--1}"
+      idx=$(( idx + 1 ))
+   done
+
+}
+
+function hash.lastok.delta() {
 
+   # $1 ... file
+   # $2 ... age limit
    local -i age=0
    local -i ret=0
-   local hash_file_name="$(hash.gen_full_hash_filename "${1}")"
-   if [ -n "${HASHER_DELTA_LAST_OK["${hash_file_name}"]}" ]
+   if [ -n "${HASH_LASTOK["${1}"]}" ]
+   then
+      # loaded by hash.lastok.load
+      age=${HASH_LASTOK["${1}"]}
+   else
+      # one key lookup in the state store
+      age=$("${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) --last-ok "$(hash.gen_full_hash_filename "${1}")" || echo -1)
+   fi
+   if [ ${age} -ge 0 ]
    then
-      age=$(( $(date +%s) - "${HASHER_DELTA_LAST_OK["${hash_file_name}"]}" ))
       if [ ${age} -gt ${2} ]
       then
          ret=1
@@ -404,8 +383,11 @@ function hash.transfer_remote_file() {
                --remote-host "${4}" \
                --remote-username "$(id -un)" \
                --remote-ssh-key ".ssh/backup" \
-               --remote-src-file "${3}"
+               --remote-src-file "${3}" \
+               $(hash.governor.args) $(hash.metrics.args) \
+               --time-budget 50
 
+            # the transfer pauses itself before the timeout, the next run resumes where it stopped
             timeout --preserve-status 60s "${HASHER_CFG["FILEHASHER"]}" \
                "--min-chunk-size=${2}" \
                --inputfile "${1}" \
@@ -414,7 +396,9 @@ function hash.transfer_remote_file() {
                --remote-host "${4}" \
                --remote-username "$(id -un)" \
                --remote-ssh-key ".ssh/backup" \
-               --remote-src-file "${3}" | tee "$(hash.gen_full_hash_filename "${1}").log" 2>&1
+               --remote-src-file "${3}" \
+               $(hash.governor.args) $(hash.metrics.args) \
+               --time-budget 50 | tee "$(hash.gen_full_hash_filename "${1}").log" 2>&1
             P=$(declare -p PIPESTATUS)
             echo ${P}
             eval declare -a status=$(echo ${P} | cut -d= -f2-)
@@ -426,11 +410,7 @@ function hash.transfer_remote_file() {
             then
                # mark as successful - skip next 24h
                output "- mark as done."
-               touch "${RUNTIME["BACKUP_ROOT"]}/backup.avahi/hashes/.cache"
-               source "${RUNTIME["BACKUP_ROOT"]}/backup.avahi/hashes/.cache"
-               HASHER_DELTA_LAST_OK["$(hash.gen_full_hash_filename "${1}")"]=$(date +%s)
-               output "- write ${#HASHER_DELTA_LAST_OK[@]} caches"
-               declare -p HASHER_DELTA_LAST_OK > "${RUNTIME["BACKUP_ROOT"]}/backup.avahi/hashes/.cache"
+               "${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) --last-ok-set "$(hash.gen_full_hash_filename "${1}")"
                hash.remote.remove_from_queue "$1"
                return 0
             else
@@ -462,3 +442,113 @@ function hash.transfer_remote_file() {
 
 }
 
+function hash.transfer_remote_files() {
+   # $1 ... manifest (json lines: inputfile, remote-src-filename, hashfile)
+   # $2 ... chunk-size
+   # $3 ... remote host
+   # $4 ... timeout
+
+   # return 0 ... all fine
+   # return 1 ... timeout reached or some files failed - complete next time
+   # return 2 ... hasher version mismatch
+
+   # all files over one ssh session, results as json lines in the report.
+   local -i stat=0
+   local report=""
+   local line=""
+   local file=""
+   local -i budget=0
+
+   if ! remote.hasher.version "${3}"
+   then
+      return 2
+   fi
+   export FILEHASHER_SKIP_VERSION=1
+
+   # chunks already on this server (other files, older backups) are copied locally
+   local chunk_index="${RUNTIME["BACKUP_ROOT"]}/backup.avahi/hashes/.chunks.sqlite"
+   "${HASHER_CFG["FILEHASHER"]}" --chunk-index "${chunk_index}" \
+      --index-hashfiles "${RUNTIME["BACKUP_ROOT"]}/backup.avahi/hashes"
+
+   # leave some seconds of the timeout to pause the transfer and save hashes
+   budget=$(( ${4%s} - 10 ))
+   if [ ${budget} -lt 1 ]
+   then
+      budget=1
+   fi
+
+   report="$(mktemp)"
+   echo timeout --preserve-status "${4}" "${HASHER_CFG["FILEHASHER"]}" \
+      "--min-chunk-size=${2}" \
+      --remote-patching \
+      --remote-host "${3}" \
+      --remote-username "$(id -un)" \
+      --remote-ssh-key ".ssh/backup" \
+      --chunk-index "${chunk_index}" \
+      --time-budget "${budget}" \
+      $(hash.governor.args) $(hash.metrics.args) \
+      --batch-manifest "${1}" \
+      --batch-report "${report}"
+
+   timeout --preserve-status "${4}" "${HASHER_CFG["FILEHASHER"]}" \
+      "--min-chunk-size=${2}" \
+      --remote-patching \
+      --remote-host "${3}" \
+      --remote-username "$(id -un)" \
+      --remote-ssh-key ".ssh/backup" \
+      --chunk-index "${chunk_index}" \
+      --time-budget "${budget}" \
+      $(hash.governor.args) $(hash.metrics.args) \
+      --batch-manifest "${1}" \
+      --batch-report "${report}"
+   stat=$?
+   echo "stat: ${stat}"
+
+   # mark completed files as successful - skip next 24h, all in one call.
+   # failed files go to the remote queue like those of hash.transfer_remote_file,
+   # files without a report line (killed run) count as failed.
+   local -a last_ok=()
+   local -A reported=()
+   while read -r line
+   do
+      file="$(echo "${line}" | jq -r '."inputfile"')"
+      reported["${file}"]=1
+      if [ "$(echo "${line}" | jq -r '."status"')" == "ok" ]
+      then
+         output "- ${file}: done. updated[$(echo "${line}" | jq -r '."updated"')] in $(echo "${line}" | jq -r '."seconds"') sec"
+         last_ok+=( --last-ok-set "$(hash.gen_full_hash_filename "${file}")" )
+         hash.remote.remove_from_queue "${file}"
+      elif [ "$(echo "${line}" | jq -r '."status"')" == "paused" ] && [ "$(echo "${line}" | jq -r '."stage"')" == "hash" ]
+      then
+         output "- ${file}: paused while hashing locally - continues next run"
+      elif [ "$(echo "${line}" | jq -r '."status"')" == "paused" ]
+      then
+         output "- ${file}: paused. updated[$(echo "${line}" | jq -r '."updated"')] - resumes at chunk $(echo "${line}" | jq -r '."resume"') next run"
+      else
+         output "- ${file}: failed. $(echo "${line}" | jq -r '."error"')"
+         hash.remote.batch2queue "${file}" "$(echo "${line}" | jq -r '."remote-src-filename"')" "${2}" "${3}"
+      fi
+   done < "${report}"
+   while read -r line
+   do
+      file="$(echo "${line}" | jq -r '."inputfile"')"
+      if [ -z "${reported["${file}"]}" ]
+      then
+         output "- ${file}: failed. no result (stat: ${stat})"
+         hash.remote.batch2queue "${file}" "$(echo "${line}" | jq -r '."remote-src-filename"')" "${2}" "${3}"
+      fi
+   done < <(jq -c . "${1}")
+   if [ ${#last_ok[@]} -gt 0 ]
+   then
+      output "- mark $(( ${#last_ok[@]} / 2 )) files as done"
+      "${HASHER_CFG["FILEHASHER"]}" $(hash.state.args) "${last_ok[@]}"
+   fi
+   rm -f "${report}"
+
+   if [ ${stat} -ne 0 ]
+   then
+      return 1
+   fi
+   return 0
+
+}
@@ -184,6 +184,10 @@ function type.path.perform.backup() {
    if [ ${#FLIST[@]} -ne 0 ]
    then
       local -i item_stat=0
+      local manifest=""
+      manifest="$(mktemp)"
+      # last-ok of all files in one call
+      hash.lastok.load "${FLIST[@]/#/${RUNTIME_ITEM["zfs.subvol.target.dir"]}/}"
       for item in "${FLIST[@]}"
       do
          if hash.lastok.delta "${RUNTIME_ITEM["zfs.subvol.target.dir"]}/${item}" $(( 24 * 60 * 60 )) >> "${RUNTIME_ITEM["logfile"]}"
@@ -192,40 +196,38 @@ function type.path.perform.backup() {
             continue
          fi
          count=$(( count + 1 ))
-         output "    - skipped last_ok[${skip_last_ok}] item[${count}/${item_max}], processing #${count}..."
          output "     ${item}" >> "${RUNTIME_ITEM["logfile"]}"
-         hash.transfer_remote_file \
-            "${RUNTIME_ITEM["zfs.subvol.target.dir"]}/${item}" \
+         # create if not there
+         if [ ! -e "${RUNTIME_ITEM["zfs.subvol.target.dir"]}/${item}" ]
+         then
+            touch "${RUNTIME_ITEM["zfs.subvol.target.dir"]}/${item}"
+         fi
+         jq -cn --arg inputfile "${RUNTIME_ITEM["zfs.subvol.target.dir"]}/${item}" \
+            --arg src "${RUNTIME_ITEM["path"]}/${item}" \
+            --arg hashfile "$(hash.gen_full_hash_filename "${RUNTIME_ITEM["zfs.subvol.target.dir"]}/${item}")" \
+            '{ "inputfile": $inputfile, "remote-src-filename": $src, "hashfile": $hashfile }' >> "${manifest}"
+      done
+      output "    - skipped last_ok[${skip_last_ok}] item[${count}/${item_max}], processing #${count} in one session..."
+
+      if [ ${count} -ne 0 ]
+      then
+         # all files in one ssh session, files not reached within the time budget follow next run.
+         # blacklisted processes pause the transfer (io governor) instead of skipping it.
+         hash.transfer_remote_files \
+            "${manifest}" \
             "$(( 8 * 1024 * 1024 ))" \
-            "${RUNTIME_ITEM["path"]}/${item}" \
             "${RUNTIME["BACKUP_HOSTNAME"]}" \
+            "${time_left}s" \
             2>&1 | tee -a "${RUNTIME_ITEM["logfile"]}"
-#         declare -p PIPESTATUS
          item_stat=${PIPESTATUS[0]}
          stat=$(( stat + item_stat ))
          if [ ${item_stat} -ne 0 ]
          then
-            output "- there was an issue with ${item}...${item_stat}"
-            SUMMARY[${#SUMMARY[@]}]="B.BACKUP-WARNING:${src} large file syncing had an issue with ${item}"
-         fi
-
-         if check.blacklisted.process
-         then
-            SUMMARY[${#SUMMARY[@]}]="B.BACKUP-WARNING:${src} large file syncing had been interrupted due to blacklist process"
-            # mark as broken
-            stat=$(( stat + 1))
-            break
-         fi
-
-         if [ ${count} -gt 10 ]
-         then
-            SUMMARY[${#SUMMARY[@]}]="B.BACKUP-WARNING:${src} large file syncing had been interrupted due to 10 items processed."
-            stat=$(( stat + 1))
-            break
+            output "- there was an issue with large file syncing...${item_stat}"
+            SUMMARY[${#SUMMARY[@]}]="B.BACKUP-WARNING:${src} large file syncing had an issue, see ${RUNTIME_ITEM["logfile"]}"
          fi
-
-      done
-      output "    - skipped last_ok[${skip_last_ok}] item[${count}/${item_max}]"
+      fi
+      rm -f "${manifest}"
 
    fi
 
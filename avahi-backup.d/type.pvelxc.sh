@@ -156,6 +156,15 @@ function type.pvelxc.check.preflight() {
          if hash.local_file "10s" "${_PVELXC["cfg.min-chunk-size"]}" "${item}"
          then
             _PVELXC["summary.hash.up-to-date"]=$(( ${_PVELXC["summary.hash.up-to-date"]} + 1 ))
+            # sample of the backup copy against its hashes, full scrubs are rare runs
+            hash.spot_check "${_PVELXC["cfg.min-chunk-size"]}" "${item}"
+            case $? in
+               1) SUMMARY[${#SUMMARY[@]}]="S.PVELXC: ${RUNTIME["BACKUP_HOSTNAME"]} ${RUNTIME_ITEM["pvelxc"]} spot check mismatch ${item}"
+                  error_count=$(( error_count + 1 ))
+                  ;;
+               2) SUMMARY[${#SUMMARY[@]}]="S.PVELXC: ${RUNTIME["BACKUP_HOSTNAME"]} ${RUNTIME_ITEM["pvelxc"]} spot check failed ${item}"
+                  ;;
+            esac
          else
             SUMMARY[${#SUMMARY[@]}]="S.PVELXC: ${RUNTIME["BACKUP_HOSTNAME"]} ${RUNTIME_ITEM["pvelxc"]} local hash updating ${item}"
             _PVELXC["summary.hash.updating"]=$(( ${_PVELXC["summary.hash.updating"]} + 1 ))
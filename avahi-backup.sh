@@ -83,14 +83,14 @@ else
    }
 fi
 
-function check.blacklisted.process() {
-   # do not run backups when those processes are around
-   local -a blacklist
-   blacklist[${#blacklist[@]}]="steamlink"
-   blacklist[${#blacklist[@]}]="moonlight"
-   blacklist[${#blacklist[@]}]="remote-viewer"
+# do not run backups when those processes are around, hashing pauses while they run
+declare -a BLACKLIST_PROCESS
+BLACKLIST_PROCESS[${#BLACKLIST_PROCESS[@]}]="steamlink"
+BLACKLIST_PROCESS[${#BLACKLIST_PROCESS[@]}]="moonlight"
+BLACKLIST_PROCESS[${#BLACKLIST_PROCESS[@]}]="remote-viewer"
 
-   for item in ${blacklist[@]}
+function check.blacklisted.process() {
+   for item in ${BLACKLIST_PROCESS[@]}
    do
       if pgrep ${item} >> /dev/null 2>&1
       then 
@@ -482,8 +482,10 @@ backup) {
    RUNTIME["BACKUP_ROOT_DATASET"]="$(zfs.get_dataset.name "${RUNTIME["BACKUP_ROOT"]}")"
    output "ZFS dataset root: ${RUNTIME["BACKUP_ROOT_DATASET"]}"
 
-   # revisit hashing queue
-   hash.revisit.queue "${RUNTIME["BACKUP_ROOT"]}/.hasher-queue"
+   # revisit hashing and remote patching queue
+   hash.state.migrate
+   hash.revisit.queue
+   hash.remote.revisit.queue
 
    # backup root
    BROOT="$(pwd)"
@@ -540,7 +542,10 @@ backup) {
 
    declare -a SUMMARY
    SUMMARY[${#SUMMARY[@]}]="A.START:$(date)"
+   RUNTIME["START_EPOCH"]="$(date +%s)"
    declare -A summary_handler
+   # filehasher throughput of this run
+   summary_handler["hash.metrics.summary"]=1
 
    for b_host in ${!AVAHI_IDX[@]}
    do
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+# copyright 2024-2025 by gh-hastmu@gmx.de
+# homed at: https://github.com/hastmu/avahi-backup
+#
+# benchmark of filehasher.py: hashing (thread modes), verify, delta generation and
+# patching on synthetic workloads. every step runs filehasher.py as its own process,
+# MB/s, cpu time and peak rss come from wait4(). results are written as json,
+# --compare reports throughput regressions against an older result file.
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+
+parser = argparse.ArgumentParser("filehasher-bench")
+parser.add_argument("--tool", help="filehasher.py to benchmark", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),"filehasher.py"))
+parser.add_argument("--size", help="size of the generated files in MiB", type=int, default=64)
+parser.add_argument("--chunk-sizes", help="comma separated chunk sizes in bytes", type=str, default="65536,1048576,8388608")
+parser.add_argument("--thread-modes", help="comma separated thread modes for hashing, verify and delta", type=str, default="0,1,2")
+parser.add_argument("--workloads", help="comma separated subset of: "+",".join(["random","zero-heavy","sparse","append","scattered","shifted"]), type=str, default="random,zero-heavy,sparse,append,scattered,shifted")
+parser.add_argument("--cdc", action='store_true', help="also run content defined chunking (max chunk size = 4 x chunk size)")
+parser.add_argument("--cold", action='store_true', help="drop the inputs from the page cache before every step (fadvise)")
+parser.add_argument("--repeat", help="runs per step, the fastest one is reported", type=int, default=1)
+parser.add_argument("--seed", help="seed of the generated data", type=int, default=1)
+parser.add_argument("--workdir", help="directory for the generated files (default: temporary)", type=str, default=False)
+parser.add_argument("--keep", action='store_true', help="keep the generated files")
+parser.add_argument("--output", help="json result file (- = stdout)", type=str, default="-")
+parser.add_argument("--compare", help="older json result file to compare with", type=str, default=False)
+parser.add_argument("--threshold", help="relative MB/s drop reported as regression", type=float, default=0.10)
+args = parser.parse_args()
+
+MiB=1024*1024
+
+
+class workload():
+   """ old (target) and new (source) version of a file, the delta turns target into source. """
+
+   def __init__(self, *, name, directory, size, seed):
+      self.name=name
+      self.size=size
+      self.rnd=random.Random(f"{seed}:{name}")
+      self.source=os.path.join(directory,f"{name}.src")
+      self.target=os.path.join(directory,f"{name}.trg")
+      getattr(self,"gen_"+name.replace("-","_"))()
+
+   def fill(self, filename, size, *, zero_ratio=0.0, holes=False):
+      # random data in 1 MiB blocks, zero_ratio of the blocks are zeros (holes when sparse)
+      with open(filename,"wb") as handle:
+         handle.truncate(size)
+         for offset in range(0,size,MiB):
+            length=min(MiB,size-offset)
+            if self.rnd.random() < zero_ratio:
+               if holes is False:
+                  os.pwrite(handle.fileno(),bytes(length),offset)
+               continue
+            os.pwrite(handle.fileno(),self.rnd.randbytes(length),offset)
+
+   def edit(self, filename, count, length):
+      # overwrite count random places with random data
+      size=os.path.getsize(filename)
+      with open(filename,"r+b") as handle:
+         for _ in range(0,count):
+            offset=self.rnd.randrange(0,max(1,size-length))
+            os.pwrite(handle.fileno(),self.rnd.randbytes(length),offset)
+
+   def copy(self):
+      shutil.copyfile(self.source,self.target)
+
+   def gen_random(self):
+      # one changed MiB like filehasher-tests.sh
+      self.fill(self.source,self.size)
+      self.copy()
+      self.edit(self.target,1,MiB)
+
+   def gen_zero_heavy(self):
+      self.fill(self.source,self.size,zero_ratio=0.9)
+      self.copy()
+      self.edit(self.target,8,64*1024)
+
+   def gen_sparse(self):
+      self.fill(self.source,self.size,zero_ratio=0.9,holes=True)
+      self.fill(self.target,self.size,zero_ratio=0.95,holes=True)
+
+   def gen_append(self):
+      # target is the older, shorter version
+      self.fill(self.source,self.size)
+      with open(self.source,"rb") as src, open(self.target,"wb") as trg:
+         trg.write(src.read(self.size*3//4))
+
+   def gen_scattered(self):
+      self.fill(self.source,self.size)
+      self.copy()
+      self.edit(self.target,64,4096)
+
+   def gen_shifted(self):
+      # 4097 bytes inserted close to the start, fixed chunks do not match anymore
+      self.fill(self.target,self.size)
+      with open(self.target,"rb") as trg, open(self.source,"wb") as src:
+         src.write(trg.read(4096))
+         src.write(self.rnd.randbytes(4097))
+         shutil.copyfileobj(trg,src,MiB)
+
+
+def drop_cache(filename):
+   if os.path.isfile(filename) is False:
+      return
+   fd=os.open(filename,os.O_RDONLY)
+   try:
+      os.posix_fadvise(fd,0,0,os.POSIX_FADV_DONTNEED)
+   finally:
+      os.close(fd)
+
+
+def unlink(*filenames):
+   for filename in filenames:
+      if os.path.exists(filename):
+         os.remove(filename)
+
+
+def file_digest(filename):
+   with open(filename,"rb") as handle:
+      digest=hashlib.sha256()
+      while True:
+         data=handle.read(MiB)
+         if len(data) == 0:
+            return digest.hexdigest()
+         digest.update(data)
+
+
+def run(cmd, *, inputs=(), prepare=None, expected=(0,1)):
+   # best of --repeat, rusage of the child only. a run with an exit code not in
+   # expected (crashed, refused) is flagged failed and only taken if all runs failed.
+   best=False
+   for _ in range(0,args.repeat):
+      if prepare is not None:
+         prepare()
+      if args.cold is True:
+         for filename in inputs:
+            drop_cache(filename)
+      log=open(os.devnull,"wb")
+      start=time.perf_counter()
+      proc=subprocess.Popen([sys.executable,args.tool]+cmd,stdout=log,stderr=log)
+      _, status, usage = os.wait4(proc.pid,0)
+      elapsed=time.perf_counter()-start
+      log.close()
+      proc.returncode=os.waitstatus_to_exitcode(status)
+      result={
+         "rc": proc.returncode,
+         "failed": proc.returncode not in expected,
+         "seconds": round(elapsed,4),
+         "cpu_user": round(usage.ru_utime,4),
+         "cpu_sys": round(usage.ru_stime,4),
+         # linux reports KiB
+         "max_rss_kb": usage.ru_maxrss,
+      }
+      if best is False or (result["failed"],result["seconds"]) < (best["failed"],best["seconds"]):
+         best=result
+   return best
+
+
+def record(results, *, load, op, chunk_size, mode, measured, nbytes, **extra):
+   entry={
+      "workload": load.name,
+      "op": op,
+      "chunk_size": chunk_size,
+      "thread_mode": mode,
+      "bytes": nbytes,
+      "mb_s": round(nbytes/MiB/max(measured["seconds"],0.0001),2),
+   }
+   entry.update(measured)
+   entry.update(extra)
+   if entry.get("ok",True) is False:
+      entry["failed"]=True
+   results.append(entry)
+   print(f"- {load.name:<10} {op:<7} chunk[{chunk_size:>9}] mode[{mode}] {entry['mb_s']:>9.2f} MB/s cpu[{entry['cpu_user']+entry['cpu_sys']:.2f}s] rss[{entry['max_rss_kb']//1024}MiB] rc[{entry['rc']}]"+"".join(f" {k}[{v}]" for k, v in extra.items())+(" FAILED" if entry["failed"] is True else ""),file=sys.stderr)
+
+
+def bench(load, results):
+   src_size=os.path.getsize(load.source)
+   variants=[ (chunk_size,False) for chunk_size in chunk_sizes ]
+   if args.cdc is True:
+      variants+=[ (chunk_size,chunk_size*4) for chunk_size in chunk_sizes ]
+
+   for chunk_size, max_chunk_size in variants:
+      chunking=[ f"--min-chunk-size={chunk_size}" ]
+      if max_chunk_size is not False:
+         chunking.append(f"--max-chunk-size={max_chunk_size}")
+      # boundaries of cdc do not depend on the thread mode
+      modes=thread_modes if max_chunk_size is False else [0]
+      label=chunk_size if max_chunk_size is False else f"{chunk_size}-{max_chunk_size}"
+      base=os.path.join(workdir,f"{load.name}.{label}")
+      src_hash, trg_hash = base+".src.hash", base+".trg.hash"
+
+      for mode in modes:
+         mode_args=[ "--thread-mode",str(mode) ]
+         measured=run([ "--inputfile",load.source,"--hashfile",src_hash ]+chunking+mode_args,inputs=(load.source,),prepare=lambda: unlink(src_hash))
+         record(results,load=load,op="hash",chunk_size=label,mode=mode,measured=measured,nbytes=src_size)
+
+      # target side as it would be on the backup server
+      run([ "--inputfile",load.target,"--hashfile",trg_hash ]+chunking)
+
+      delta=base+".delta"
+      for mode in modes:
+         mode_args=[ "--thread-mode",str(mode) ]
+         measured=run([ "--inputfile",load.source,"--hashfile",src_hash,"--verify-against",trg_hash ]+chunking+mode_args,inputs=(load.source,))
+         record(results,load=load,op="verify",chunk_size=label,mode=mode,measured=measured,nbytes=src_size)
+         measured=run([ "--inputfile",load.source,"--hashfile",src_hash,"--verify-against",trg_hash,"--delta-file",delta ]+chunking+mode_args,inputs=(load.source,),prepare=lambda: unlink(delta))
+         record(results,load=load,op="delta",chunk_size=label,mode=mode,measured=measured,nbytes=src_size,delta_bytes=os.path.getsize(delta) if os.path.exists(delta) else 0)
+
+      # patch a copy of the target, the result has to be the source
+      patched, patched_hash = base+".patched", base+".patched.hash"
+      def reset():
+         # hashfiles belong to one inputfile, the copy gets its own (not measured)
+         unlink(patched_hash)
+         shutil.copyfile(load.target,patched)
+         subprocess.run([sys.executable,args.tool,"--inputfile",patched,"--hashfile",patched_hash]+chunking,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+      measured=run([ "--inputfile",patched,"--hashfile",patched_hash,"--apply-delta-file",delta ]+chunking,inputs=(patched,delta),prepare=reset,expected=(0,))
+      record(results,load=load,op="patch",chunk_size=label,mode=0,measured=measured,nbytes=src_size,ok=file_digest(patched) == file_digest(load.source))
+      unlink(patched,patched_hash,patched+".patching",delta)
+
+
+def compare(old, new):
+   # same step = same workload/op/chunk size/thread mode
+   key=lambda entry: (entry["workload"],entry["op"],str(entry["chunk_size"]),entry["thread_mode"])
+   before={ key(entry): entry for entry in old["results"] }
+   regressions=[]
+   for entry in new["results"]:
+      previous=before.get(key(entry),False)
+      # timings of failed runs say nothing
+      if previous is False or previous["mb_s"] == 0 or previous.get("failed",False) is True or entry.get("failed",False) is True:
+         continue
+      change=entry["mb_s"]/previous["mb_s"]-1
+      if change < -args.threshold:
+         regressions.append({ "step": list(key(entry)), "before": previous["mb_s"], "after": entry["mb_s"], "change": round(change,3) })
+         print(f"- regression {key(entry)}: {previous['mb_s']} -> {entry['mb_s']} MB/s ({change:+.1%})",file=sys.stderr)
+   return regressions
+
+
+chunk_sizes=[ int(value) for value in args.chunk_sizes.split(",") ]
+thread_modes=[ int(value) for value in args.thread_modes.split(",") ]
+
+if args.workdir is False:
+   workdir=tempfile.mkdtemp(prefix="filehasher-bench.")
+else:
+   workdir=args.workdir
+   os.makedirs(workdir,exist_ok=True)
+
+report={
+   "tool": args.tool,
+   "version": subprocess.run([sys.executable,args.tool,"--version"],capture_output=True,text=True).stdout.strip(),
+   "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+   "host": { "node": platform.node(), "machine": platform.machine(), "cpus": os.cpu_count(), "python": platform.python_version(), "kernel": platform.release() },
+   "settings": { "size_mib": args.size, "chunk_sizes": chunk_sizes, "thread_modes": thread_modes, "cdc": args.cdc, "cold": args.cold, "repeat": args.repeat, "seed": args.seed },
+   "results": [],
+}
+
+try:
+   for name in args.workloads.split(","):
+      print(f"- generate workload[{name}] size[{args.size}MiB]",file=sys.stderr)
+      load=workload(name=name,directory=workdir,size=args.size*MiB,seed=args.seed)
+      bench(load,report["results"])
+      if args.keep is False:
+         unlink(load.source,load.target)
+finally:
+   if args.keep is False and args.workdir is False:
+      shutil.rmtree(workdir,ignore_errors=True)
+
+status=0
+if False in [ entry.get("ok",True) for entry in report["results"] ]:
+   print("- patched files differ from their source",file=sys.stderr)
+   status=2
+failed=[ entry for entry in report["results"] if entry["failed"] is True ]
+if len(failed) > 0:
+   print(f"- {len(failed)} steps failed (exit code or result), their timings are not compared",file=sys.stderr)
+   status=2
+
+if args.compare is not False:
+   with open(args.compare) as handle:
+      report["regressions"]=compare(json.load(handle),report)
+   if len(report["regressions"]) > 0 and status == 0:
+      status=1
+
+if args.output == "-":
+   print(json.dumps(report,indent=1))
+else:
+   with open(args.output,"w") as handle:
+      json.dump(report,handle,indent=1)
+
+exit(status)
@@ -8,13 +8,26 @@ import sys
 import base64
 import threading
 import multiprocessing
+import concurrent.futures
+import collections
+import queue
 import os
 import hashlib
 import atexit
 import time
 import pickle
 import math
+import mmap
+import struct
+import errno
 import argparse
+import json
+import socket
+import sqlite3
+import resource
+import array
+import random
+import re
 
 import timeit
 
@@ -26,28 +39,68 @@ import zlib
 from pathlib import Path
 
 _CFG={
-   "default_hash_basedir": str(Path.home())+"/.cache/avahi-backup/hashes"
+   "default_hash_basedir": str(Path.home())+"/.cache/avahi-backup/hashes",
+   "default_agent_socket": str(Path.home())+"/.cache/avahi-backup/agent.sock",
+   "default_state": str(Path.home())+"/.cache/avahi-backup/state.sqlite"
 }
 
+def pressure_limits(value):
+   # SLOW[:PAUSE] of --psi-io/--psi-cpu -> (slow, pause)
+   slow, _, pause = value.partition(":")
+   try:
+      limits=(float(slow),float(pause) if pause != "" else 100.0)
+   except ValueError:
+      raise argparse.ArgumentTypeError(f"{value} is not SLOW[:PAUSE] in %, e.g. 20:60")
+   if not 0 <= limits[0] <= limits[1] <= 100:
+      raise argparse.ArgumentTypeError(f"{value}: 0 <= SLOW <= PAUSE <= 100 expected")
+   return limits
+
+def process_pattern(value):
+   # --pause-process, a pattern like pgrep takes
+   try:
+      return re.compile(value)
+   except re.error as e:
+      raise argparse.ArgumentTypeError(f"{value} is not a valid pattern: {e}")
 
 parser = argparse.ArgumentParser("filehasher")
 parser.add_argument("--version", action='store_true', help="show version and exit")
 parser.add_argument("--debug", action='store_true', help="enable debug messages")
 parser.add_argument("--report-used-hashfile", action='store_true', help="reports used hashfile and exits.")
 parser.add_argument("--thread-mode", help="0=no-threading, 1=read+hash threading, 2=hash threading", type=int, default=0)
+parser.add_argument("--threads", help="worker threads for thread-mode 1/2 and the patch receiver (0=cpu count)", type=int, default=0)
+parser.add_argument("--read-mode", help="0=pread, 1=preadv into reused buffers, 2=mmap", type=int, default=0)
+parser.add_argument("--io-mode", help="page cache use of reads and patch writes: 0=buffered, 1=fadvise (readahead window, drop behind), 2=O_DIRECT reads", type=int, default=0)
+parser.add_argument("--max-rate", help="cap of read/written bytes per second (hashing, delta transfer, patching)", type=int, default=False)
+parser.add_argument("--psi-io", help="SLOW[:PAUSE] io pressure (some avg10 in %%) to slow down/pause at", type=pressure_limits, default=False)
+parser.add_argument("--psi-cpu", help="SLOW[:PAUSE] cpu pressure (some avg10 in %%) to slow down/pause at", type=pressure_limits, default=False)
+parser.add_argument("--pause-process", help="pause io while a process matching this pattern runs, matched like pgrep does (repeatable)", type=process_pattern, action="append", default=[])
+parser.add_argument("--readahead", help="readahead/drop window of io mode 1/2 in bytes", type=int, default=64*1024*1024)
+parser.add_argument("--metrics", help="write counters and phase times of this run to this file at exit", type=str, default=False)
+parser.add_argument("--metrics-format", help="json (appends one line per run) or prometheus (textfile collector)", type=str, choices=["json","prometheus"], default="json")
+parser.add_argument("--metrics-label", help="KEY=VALUE added to the metrics (repeatable), e.g. host=...", action="append", default=[])
+parser.add_argument("--metrics-max-size", help="json: bytes of --metrics before it is moved to <file>.1 (one older file is kept)", type=int, default=16*1024*1024)
+parser.add_argument("--profile", help="write a profile report (wall/cpu time per phase) of this run to this file at exit", type=str, default=False)
+parser.add_argument("--profile-with", help="comma separated: cprofile (<report>.pstats), sample (<report>.folded for flamegraphs), memory (tracemalloc)", type=str, default="")
+parser.add_argument("--profile-interval", help="seconds between stack samples of --profile-with sample", type=float, default=0.005)
 
 group = parser.add_argument_group('Hashing...')
 group.add_argument("--inputfile", help="file which should be hashed.", type=str, default=False)
 group.add_argument("--min-chunk-size", help="smallest chunk for hashing.", type=int, default=8192)
+group.add_argument("--max-chunk-size", help="enables content defined chunks between min and max chunk size (no threading)", type=int, default=False)
 group.add_argument("--build-only", help="build only - no compare", type=bool, default=True)
+group.add_argument("--hash-algorithm", help="chunk hash: sha256 (default), sha512, blake2b, blake2s, blake3 (module blake3), xxh3 (module xxhash, detection only)", type=str, default="sha256")
+group.add_argument("--verify-algorithm", help="strong digest for transferred chunks only, two-tier with a fast --hash-algorithm (e.g. xxh3 + sha256)", type=str, default=False)
 group.add_argument("--force-refresh", action='store_true', help="refresh also available hashes in build-only mode")
 group.add_argument("--hashfile", help="define which hashfile is used",default=False)
 
 group = parser.add_argument_group('Verifying...')
 group.add_argument("--verify-against", help="hashed which should be verified for matching", type=str, default=False)
+group.add_argument("--spot-check", help="N chunks or P%% of the chunks compared with the hashfile instead of all (--verify-against), weighted to never verified and patched chunks. exit 3 on mismatch, 2 if it could not check", type=str, default=False)
 group.add_argument("--delta-file", help="store deltas to this file for patching", type=str, default=False)
 group.add_argument("--remote-delta", action='store_true', help="sent delta for remote-patching")
-group.add_argument("--chunk-limit", help="limit written deltas per run", type=int, default=False)
+group.add_argument("--merkle-delta", action='store_true', help="negotiate differing chunks by hash tree on stdin/stdout, then sent delta (remote side of remote-patching)")
+group.add_argument("--compress-threads", help="threads compressing delta frames, frames are written in chunk order (0=cpu count, 1=inline)", type=int, default=0)
+group.add_argument("--chunk-limit", help="limit written deltas per run (remote patching: chunks sent, the sender pauses and the next run resumes)", type=int, default=False)
 group = parser.add_argument_group('Patching...')
 group.add_argument("--apply-delta-file", help="patches the inputfile with the content of the delta file", type=str, default=False)
 
@@ -58,23 +111,59 @@ group.add_argument("--remote-src-filename", help="remote file name which is sour
 group.add_argument("--remote-username", help="ssh key to load in addition to use", type=str, default=False)
 group.add_argument("--remote-password", help="ssh key to load in addition to use", type=str, default=False)
 group.add_argument("--remote-ssh-key", help="ssh key to load in addition to use", type=str, default=False)
-group.add_argument("--remote-transfer-mode", help="0 (default): json-ascii, 1: binary, 2: bin+compression, 3: bin+auto-compress", type=int, default=0)
+group.add_argument("--batch-manifest", help="json lines with inputfile, remote-src-filename and optional hashfile, all patched over one ssh session (- = stdin)", type=str, default=False)
+group.add_argument("--time-budget", help="seconds of one remote patching run (of all files with --batch-manifest), the sender pauses and the next run resumes", type=float, default=False)
+group.add_argument("--byte-budget", help="bytes of one remote patching run, the sender pauses and the next run resumes", type=int, default=False)
+group.add_argument("--chunk-index", help="sqlite index of the chunks of all local files, chunks found there are copied locally instead of transferred", type=str, default=False)
+group.add_argument("--index-hashfiles", help="add all hashfiles below this directory to --chunk-index and exit", type=str, default=False)
+group.add_argument("--batch-report", help="json line result per file of --batch-manifest (- = stdout, progress goes to stderr then)", type=str, default="-")
+group.add_argument("--remote-transfer-mode", help="0 (default): zlib if it pays, 1: binary, 2: bin+compression (first of --compression), 3: bin+auto-compress (codec/level by link and compression speed)", type=int, default=0)
+group.add_argument("--compression", help="codecs for --remote-transfer-mode 2/3, name[:level] in order of preference, missing modules are skipped", type=str, default="zstd,lz4,zlib")
+
+group = parser.add_argument_group('State (queues, last-ok)...')
+group.add_argument("--state", help="sqlite store of the queues and last-ok times", type=str, default=_CFG["default_state"])
+group.add_argument("--state-import", help="import a declare -p file (HASHER_QUEUE, REMOTE_QUEUE, HASHER_DELTA_LAST_OK) or json queue file of older versions into --state, renamed to .imported, and exit (repeatable)", type=str, action='append', default=[])
+group.add_argument("--queue", help="revisit the files of this queue (hasher, remote) of --state in one process: hashing, then remote patching for entries with a remote host", type=str, default=False)
+group.add_argument("--queue-budget", help="seconds for all files of --queue, shared by bytes left and time in the queue", type=float, default=600)
+group.add_argument("--queue-add", help="add --inputfile (--min-chunk-size, --hashfile, --remote-* of --remote-patching) to this queue and exit", type=str, default=False)
+group.add_argument("--queue-remove", help="remove --inputfile from this queue and exit", type=str, default=False)
+group.add_argument("--last-ok", help="print the seconds since the last-ok of this key (-1 = never) and exit (repeatable, one line per key in order)", type=str, action='append', default=[])
+group.add_argument("--last-ok-set", help="set the last-ok of this key to now and exit (repeatable)", type=str, action='append', default=[])
+
+group = parser.add_argument_group('Agent (remote side of remote patching)...')
+group.add_argument("--agent", action='store_true', help="serve requests on stdin/stdout, relayed to the agent service on --agent-socket if it runs")
+group.add_argument("--agent-listen", action='store_true', help="run as agent service on --agent-socket, hash tables stay in memory between requests")
+group.add_argument("--agent-socket", help="unix socket of the agent service", type=str, default=_CFG["default_agent_socket"])
+group.add_argument("--agent-cache", help="files (hash tables) kept in memory by the agent, least recently used are dropped", type=int, default=32)
 
 group = parser.add_argument_group('Debugging...')
 group.add_argument("--show-hashes", help="lists stored hashes in hash file", type=str, default=False)
 
 args = parser.parse_args()
+if args.chunk_limit is not False and args.chunk_limit < 1:
+   parser.error("--chunk-limit: at least 1 chunk expected")
+if args.chunk_limit is not False and args.max_chunk_size is not False and (args.remote_patching is True or args.queue is not False):
+   # content defined chunks are sent without negotiation, there is no resume point
+   parser.error("--chunk-limit does not work with --max-chunk-size on remote patching")
 
 # exit function
 def save_hash_file():
    # print("---save hash---")
-   FH.save_hash()
+   if globals().get("FH",False) is not False:
+      FH.save_hash()
    try:
       ssh.close()
    except:
       pass
 
 
+def save_metrics():
+   if args.metrics is not False:
+      try:
+         metrics.write(args.metrics,format=args.metrics_format,labels=metrics_labels,max_size=args.metrics_max_size)
+      except OSError as e:
+         print(f"- metrics not written: {e}",file=sys.stderr)
+
 def sigterm_handler(_signal, _stack_frame):
    # Raises SystemExit(0):
 ##   os.write(sys.stdout.fileno(), b"-- signal handler --\n")
@@ -83,30 +172,65 @@ def sigterm_handler(_signal, _stack_frame):
 #   signal.signal(signal.SIGTERM, False)
 #   signal.signal(signal.SIGINT, False)
    try:
-      FH.save_hash()
+      FH.checkpoint()
    except:
       pass
+   save_metrics()
+   if profiler is not False:
+      profiler.stop()
 
    #sys.exit(2)
    os._exit(2)
 
+def remote_connect(*, hostname=False, username=False, ssh_key=False):
+   # ssh session to --remote-hostname (or the host of a --queue entry)
+   import paramiko
+   hostname=hostname or args.remote_hostname
+   username=username or args.remote_username
+   ssh_key=ssh_key or args.remote_ssh_key
+   ssh = paramiko.SSHClient()
+   ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+   try:
+      if args.remote_password is False:
+         private_key = paramiko.RSAKey.from_private_key_file(ssh_key)
+         ssh.connect(hostname, username=username, pkey=private_key, look_for_keys=False,compress=False)
+      else:
+         ssh.connect(hostname, username=username, password=args.remote_password,compress=False)
+   except Exception as e:
+      # batch and queue go on with a report/the queue entry, not with exit()
+      raise Exception(f"SSH-Connect failed: {e}")
+   return ssh
+
+def remote_version_check(ssh):
+   # skip version check if already done. set FILEHASHER_SKIP_VERSION
+   if os.environ.get("FILEHASHER_SKIP_VERSION",False) is False:
+      ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command("filehasher.py --version")
+      remote_version=ssh_stdout.readline().strip()
+   else:
+      remote_version=version
+   if remote_version != version:
+      raise Exception("local and remote version do not match")
 
 class speed():
 
    def __init__(self,*, max_size=False, start_chunk=0):
       self.min=False
       self.max=False
-      self.avg=False
+      self.avg=0
       self.max_size=max_size
       self.chk_read_count_max=1
       self.chk_read_count=1
       self.abs_chk_reads=start_chunk
       self.s_time=time.time()
+      # average = all bytes since the start / time since the start
+      self.start_time=self.s_time
+      self.bytes=0
 
    def update_run(self,size):
       
       # update total counter
       self.abs_chk_reads=self.abs_chk_reads+1
+      self.bytes+=size
 
       # update cycle counter
       self.chk_read_count=self.chk_read_count-1
@@ -146,12 +270,9 @@ class speed():
       elif value > self.max:
          self.max=value
 
-      if self.avg is False:
-         self.avg=value
-      else:
-         self.avg=(self.avg + value) / 2
-
    def size_bw(self,value):
+      if value is False:
+         return "-"
       idx=0
       units=("B/s","KB/s","MB/s","GB/s","TB/s","PB/s")
       while value > 1024:
@@ -162,6 +283,7 @@ class speed():
 
    def report(self):
 #      result=self.size_bw(self.min)+" - " + self.size_bw(self.avg) + " - " + self.size_bw(self.max)
+      self.avg=self.bytes/max(time.time()-self.start_time,0.001)
       result=f"{self.size_bw(self.min):4} - {self.size_bw(self.avg):4} - {self.size_bw(self.max):4}"
       return result
    
@@ -178,21 +300,1573 @@ class benchmark():
       self.end=timeit.default_timer()
       print(f"{self.name} took {self.end - self.start} seconds")
       
+class run_metrics():
+   """ counters and phase timers of a process (--metrics), shared by all threads and files.
+
+   phase seconds are summed over the threads, in thread mode 1/2 they may exceed the run
+   time. json appends one record per run (history), prometheus rewrites a textfile
+   for the node exporter.
+   """
+
+   counters=("bytes_read","bytes_hashed","chunks_hashed","chunks_skipped","chunks_transferred","bytes_raw","bytes_compressed","bytes_sent","bytes_received","bytes_written")
+   phases=("read","hash","compress","network","write")
+
+   def __init__(self):
+      self.lock=threading.Lock()
+      self.values=dict.fromkeys(self.counters,0)
+      self.seconds=dict.fromkeys(self.phases,0.0)
+      # cpu time of the phases, only with --profile (one more clock per call)
+      self.cpu=False
+      self.cpu_seconds=dict.fromkeys(self.phases,0.0)
+      self.start=time.time()
+
+   def clock(self):
+      # start of a phase for add()
+      if self.cpu is False:
+         return time.perf_counter()
+      return (time.perf_counter(),time.thread_time())
+
+   def elapsed(self, start):
+      # wall seconds since clock()
+      return time.perf_counter()-(start if self.cpu is False else start[0])
+
+   def add(self, *, phase=False, start=0, **values):
+      # start: clock() at the begin of the phase
+      if phase is not False:
+         if self.cpu is False:
+            wall=time.perf_counter()-start
+         else:
+            wall=time.perf_counter()-start[0]
+            cpu=time.thread_time()-start[1]
+      with self.lock:
+         if phase is not False:
+            self.seconds[phase]+=wall
+            if self.cpu is not False:
+               self.cpu_seconds[phase]+=cpu
+         for name, value in values.items():
+            self.values[name]+=value
+
+   def record(self, *, labels={}):
+      end=time.time()
+      record={
+         "version": version,
+         "start": round(self.start,3),
+         "end": round(end,3),
+         "seconds": round(end-self.start,3),
+         "labels": dict(labels),
+         "counters": dict(self.values),
+         "phase_seconds": { name: round(value,3) for name, value in self.seconds.items() },
+      }
+      if self.cpu is not False:
+         record["phase_cpu_seconds"]={ name: round(value,3) for name, value in self.cpu_seconds.items() }
+      return record
+
+   def prometheus(self, *, labels={}):
+      record=self.record(labels=labels)
+      def sample(name, value, **extra):
+         # json string escaping is the one of label values (\\, \", \n)
+         pairs=",".join(f'{key}={json.dumps(str(label),ensure_ascii=False)}' for key, label in { **record["labels"], **extra }.items())
+         return f"filehasher_{name}{{{pairs}}} {value}\n"
+      text="# TYPE filehasher_run_start_timestamp_seconds gauge\n"+sample("run_start_timestamp_seconds",record["start"])
+      text+="# TYPE filehasher_run_seconds gauge\n"+sample("run_seconds",record["seconds"])
+      text+="# TYPE filehasher_run_bytes gauge\n"+"".join(sample("run_bytes",value,kind=name[6:]) for name, value in record["counters"].items() if name.startswith("bytes_"))
+      text+="# TYPE filehasher_run_chunks gauge\n"+"".join(sample("run_chunks",value,kind=name[7:]) for name, value in record["counters"].items() if name.startswith("chunks_"))
+      text+="# TYPE filehasher_run_phase_seconds gauge\n"+"".join(sample("run_phase_seconds",value,phase=name) for name, value in record["phase_seconds"].items())
+      return text
+
+   def write(self, filename, *, format="json", labels={}, max_size=False):
+      if format == "prometheus":
+         # textfile collectors must never see half written files
+         with open(filename+".tmp","w") as handle:
+            handle.write(self.prometheus(labels=labels))
+         os.replace(filename+".tmp",filename)
+      else:
+         with open(filename,"a") as handle:
+            handle.write(json.dumps(self.record(labels=labels))+"\n")
+            handle.flush()
+            # the history does not grow forever, the last full file is kept as .1.
+            # another run may have rotated it already.
+            stats=os.fstat(handle.fileno())
+            if max_size is not False and stats.st_size > max_size and os.stat(filename).st_ino == stats.st_ino:
+               os.replace(filename,filename+".1")
+
+class null_metrics(run_metrics):
+   """ run_metrics without --metrics/--profile: clock() and elapsed() still time (link
+   speed of --remote-transfer-mode 3), add() keeps nothing and takes no lock.
+   """
+
+   def add(self, *, phase=False, start=0, **values):
+      pass
+
+class run_profiler():
+   """ --profile: where the time of a run goes, written as text report at exit.
+
+   the phases of run_metrics get the cpu time of their threads besides the wall time.
+   --profile-with adds:
+   cprofile = deterministic profile of the main thread, stats in <report>.pstats
+              (snakeviz, gprof2dot, flameprof)
+   sample   = stacks of all threads every --profile-interval seconds, folded in
+              <report>.folded (flamegraph.pl, speedscope), workers included
+   memory   = tracemalloc, peak of python allocations and the top allocation sites
+   """
+
+   def __init__(self, *, filename, metrics, tools=(), interval=0.005):
+      self.filename=filename
+      self.metrics=metrics
+      self.tools=set(tools)
+      unknown=self.tools-{"cprofile","sample","memory"}
+      if len(unknown) > 0:
+         raise Exception(f"unknown profile tools: {sorted(unknown)}")
+      self.interval=interval
+      self.samples=collections.Counter()
+      self.sample_count=0
+      self.running=False
+      self.profile=False
+
+   def start(self):
+      self.metrics.cpu=True
+      self.s_time=time.perf_counter()
+      self.s_cpu=time.process_time()
+      self.running=True
+      if "memory" in self.tools:
+         import tracemalloc
+         tracemalloc.start(16)
+      if "sample" in self.tools:
+         self.sampler=threading.Thread(target=self._sampler,name="profile-sampler",daemon=True)
+         self.sampler.start()
+      if "cprofile" in self.tools:
+         import cProfile
+         self.profile=cProfile.Profile()
+         self.profile.enable()
+
+   def _sampler(self):
+      me=threading.get_ident()
+      while self.running is True:
+         time.sleep(self.interval)
+         names={ thread.ident: thread.name for thread in threading.enumerate() }
+         for ident, frame in sys._current_frames().items():
+            if ident == me:
+               continue
+            stack=[]
+            while frame is not None:
+               code=frame.f_code
+               stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+               frame=frame.f_back
+            # workers of one pool are one root: ThreadPoolExecutor-0_3 -> ThreadPoolExecutor-0
+            root=names.get(ident,str(ident)).rsplit("_",1)[0]
+            self.samples[";".join([root]+stack[::-1])]+=1
+         self.sample_count+=1
+
+   def stop(self):
+      # ends all tools and writes the report (once)
+      if self.running is False:
+         return
+      self.running=False
+      if self.profile is not False:
+         self.profile.disable()
+      wall=time.perf_counter()-self.s_time
+      cpu=time.process_time()-self.s_cpu
+      usage=resource.getrusage(resource.RUSAGE_SELF)
+      record=self.metrics.record()
+      counters=record["counters"]
+      phase_bytes={ "read": counters["bytes_read"], "hash": counters["bytes_hashed"], "compress": counters["bytes_raw"], "network": counters["bytes_sent"]+counters["bytes_received"], "write": counters["bytes_written"] }
+
+      report=[f"filehasher {version} profile - wall[{wall:.3f}s] cpu[{cpu:.3f}s] user[{usage.ru_utime:.3f}s] sys[{usage.ru_stime:.3f}s] max rss[{usage.ru_maxrss//1024} MB]","",
+              "phase        wall s      cpu s          bytes       MB/s"]
+      for phase in self.metrics.phases:
+         seconds=record["phase_seconds"][phase]
+         report.append(f"{phase:<8} {seconds:>10.3f} {record['phase_cpu_seconds'][phase]:>10.3f} {phase_bytes[phase]:>14} {phase_bytes[phase]/(1024*1024)/max(seconds,0.000001):>10.1f}")
+      report.append(f"{'other':<8} {max(wall-sum(record['phase_seconds'].values()),0):>10.3f} {max(cpu-sum(record['phase_cpu_seconds'].values()),0):>10.3f}   (phases are summed over threads)")
+
+      if "memory" in self.tools:
+         import tracemalloc
+         current, peak = tracemalloc.get_traced_memory()
+         top=tracemalloc.take_snapshot().statistics("lineno")[:10]
+         tracemalloc.stop()
+         report+=["",f"python memory - current[{current//1024} KB] peak[{peak//1024} KB], top allocation sites:"]
+         report+=[ f"  {stat.size//1024:>10} KB {stat.count:>8}x {stat.traceback[0].filename}:{stat.traceback[0].lineno}" for stat in top ]
+
+      if self.profile is not False:
+         import pstats
+         import io
+         self.profile.dump_stats(self.filename+".pstats")
+         text=io.StringIO()
+         pstats.Stats(self.profile,stream=text).sort_stats("cumulative").print_stats(25)
+         report+=["",f"cprofile (main thread), stats in {self.filename}.pstats:",text.getvalue()]
+
+      if "sample" in self.tools:
+         with open(self.filename+".folded","w") as handle:
+            for stack, count in sorted(self.samples.items()):
+               handle.write(f"{stack} {count}\n")
+         # self time: innermost frame of the samples
+         inner=collections.Counter()
+         for stack, count in self.samples.items():
+            inner[stack.rsplit(";",1)[-1]]+=count
+         total=max(sum(inner.values()),1)
+         report+=["",f"samples - {self.sample_count} x {self.interval*1000:.0f} ms, folded stacks in {self.filename}.folded, top self time:"]
+         report+=[ f"  {count*100/total:>6.2f}% {frame}" for frame, count in inner.most_common(20) ]
+
+      with open(self.filename,"w") as handle:
+         handle.write("\n".join(report)+"\n")
+
+def write_zero(fd, offset, length):
+   # zero a range: hole punching inside the file, sparse extension past EOF.
+   size=os.fstat(fd).st_size
+   inside=max(0,min(length,size-offset))
+   if inside > 0 and punch_hole(fd,offset,inside) is False:
+      block=bytes(min(inside,4*1024*1024))
+      pos=offset
+      while pos < offset+inside:
+         pos+=os.pwrite(fd,block[:offset+inside-pos],pos)
+   if offset+length > size:
+      os.ftruncate(fd,offset+length)
+
+def hash_function(name):
+   # name -> (function data -> digest, digest size), optional modules are imported when used.
+   if name == "sha256":
+      return (lambda data: hashlib.sha256(data).digest()), 32
+   elif name == "sha512":
+      return (lambda data: hashlib.sha512(data).digest()), 64
+   elif name == "blake2b":
+      return (lambda data: hashlib.blake2b(data,digest_size=32).digest()), 32
+   elif name == "blake2s":
+      return (lambda data: hashlib.blake2s(data).digest()), 32
+   elif name == "blake3":
+      try:
+         import blake3
+      except ImportError:
+         raise Exception("hash algorithm blake3 needs the python module blake3")
+      return (lambda data: blake3.blake3(data).digest()), 32
+   elif name == "xxh3":
+      # not cryptographic - change detection only, pair it with --verify-algorithm
+      try:
+         import xxhash
+      except ImportError:
+         raise Exception("hash algorithm xxh3 needs the python module xxhash")
+      return xxhash.xxh3_128_digest, 16
+   else:
+      raise Exception(f"hash algorithm unknown: {name}")
+
+def hash_stream(name):
+   # name -> function () -> hash object (update(), digest()), for data hashed in pieces
+   if name in ("sha256","sha512","blake2s"):
+      return getattr(hashlib,name)
+   elif name == "blake2b":
+      return lambda: hashlib.blake2b(digest_size=32)
+   elif name == "blake3":
+      import blake3
+      return blake3.blake3
+   elif name == "xxh3":
+      import xxhash
+      return xxhash.xxh3_128
+   else:
+      raise Exception(f"hash algorithm unknown: {name}")
+
+def hash_zeros(new, length):
+   # digest of length zero bytes without allocating all of them
+   hasher=new()
+   block=bytes(min(length,8*1024*1024))
+   while length > 0:
+      hasher.update(memoryview(block)[:min(length,len(block))])
+      length-=len(block)
+   return hasher.digest()
+
+def compression_codec(name):
+   # name -> (frame type, function (data, level) -> payload, function payload -> data, default level),
+   # optional modules are imported when used.
+   if name == "zlib":
+      return 1, (lambda data, level: zlib.compress(data,level)), zlib.decompress, 6
+   elif name == "zstd":
+      try:
+         import zstandard
+      except ImportError:
+         raise Exception("compression zstd needs the python module zstandard")
+      # contexts are not thread safe, one per thread (and level)
+      contexts=threading.local()
+      def compress(data, level):
+         compressors=getattr(contexts,"compressors",False)
+         if compressors is False:
+            compressors=contexts.compressors={}
+         if level not in compressors:
+            compressors[level]=zstandard.ZstdCompressor(level=level)
+         return compressors[level].compress(data)
+      def decompress(payload):
+         decompressor=getattr(contexts,"decompressor",False)
+         if decompressor is False:
+            decompressor=contexts.decompressor=zstandard.ZstdDecompressor()
+         return decompressor.decompress(payload)
+      return 6, compress, decompress, 3
+   elif name == "lz4":
+      try:
+         import lz4.frame
+      except ImportError:
+         raise Exception("compression lz4 needs the python module lz4")
+      return 7, (lambda data, level: lz4.frame.compress(data,compression_level=level)), lz4.frame.decompress, 0
+   else:
+      raise Exception(f"compression unknown: {name}")
+
+def read_exact(handle, size):
+   # pipes and ssh channels return partial reads
+   data=bytearray()
+   while len(data) < size:
+      piece=handle.read(size-len(data))
+      if not piece:
+         raise Exception("stream ended early")
+      data+=piece
+   return data
+
+def read_into(handle, buffer, size):
+   # fills buffer[:size] from a file, pipe or ssh channel, returns the number of
+   # bytes read - short only at the end of the stream.
+   view=memoryview(buffer)[:size]
+   readinto=getattr(handle,"readinto",False)
+   pos=0
+   while pos < size:
+      if readinto is not False:
+         count=readinto(view[pos:])
+      else:
+         piece=handle.read(size-pos)
+         count=len(piece)
+         view[pos:pos+count]=piece
+      if not count:
+         break
+      pos+=count
+   return pos
+
+def copy_range(src_fd, dst_fd, src_offset, dst_offset, length):
+   # in kernel copy if possible (reflinks on btrfs/xfs), plain pread/pwrite otherwise.
+   while length > 0:
+      try:
+         copied=os.copy_file_range(src_fd,dst_fd,length,src_offset,dst_offset)
+      except (OSError,AttributeError):
+         copied=os.pwrite(dst_fd,os.pread(src_fd,min(length,4*1024*1024),src_offset),dst_offset)
+      if copied == 0:
+         raise Exception("source range ended early")
+      src_offset+=copied
+      dst_offset+=copied
+      length-=copied
+
+def punch_hole(fd, offset, length):
+   # fallocate(FALLOC_FL_PUNCH_HOLE|FALLOC_FL_KEEP_SIZE), False if not supported
+   import ctypes
+   try:
+      libc=ctypes.CDLL(None,use_errno=True)
+      libc.fallocate.argtypes=[ctypes.c_int,ctypes.c_int,ctypes.c_longlong,ctypes.c_longlong]
+      return libc.fallocate(fd,0x02|0x01,offset,length) == 0
+   except (OSError,AttributeError):
+      return False
+
+class chunk_reader():
+   """ reads chunks of a file as bytes-like objects, usable from several threads.
+
+   read_mode 0 = os.pread, one bytes object per chunk
+   read_mode 1 = os.preadv into preallocated buffers which are reused after release()
+   read_mode 2 = mmap, chunks are memoryview slices of the mapping (no copy at all)
+
+   io_mode decides what the reads leave in the page cache (huge images next to
+   production workloads):
+   io_mode 0 = buffered, up to the kernel
+   io_mode 1 = posix_fadvise, SEQUENTIAL + WILLNEED for readahead bytes ahead of the
+               reads, DONTNEED for what is behind them
+   io_mode 2 = O_DIRECT into aligned buffers (any read mode), no page cache at all.
+               falls back to io_mode 1 where the filesystem does not support it.
+
+   segment_size: largest read of the reused buffers, chunks above it are read in
+   segments with read_range().
+   """
+
+   def __init__(self, *, filename, chunk_size, read_mode=0, io_mode=0, readahead=64*1024*1024, metrics=False, segment_size=False):
+      self.chunk_size=chunk_size
+      self.buffer_size=min(chunk_size,segment_size or chunk_size)
+      self.metrics=metrics
+      self.read_mode=read_mode
+      self.io_mode=io_mode
+      self.readahead=readahead
+      self.fd=os.open(filename,os.O_RDONLY)
+      self.map=False
+      self.view=False
+      self.free_buffers=[]
+      # io_mode 1: end of the advised readahead, start of the range not dropped yet
+      self.advised=0
+      self.dropped=0
+      self.lock=threading.Lock()
+      # io stats
+      self.bytes_read=0
+      self.s_time=time.time()
+      self.direct_fd=-1
+      self.align=4096
+      if self.io_mode == 2:
+         try:
+            self.direct_fd=os.open(filename,os.O_RDONLY|os.O_DIRECT)
+         except (OSError, AttributeError):
+            # tmpfs and friends
+            self.io_mode=1
+      elif self.io_mode not in (0,1):
+         raise Exception(f"io mode unknown: {self.io_mode}")
+      if self.io_mode == 1:
+         os.posix_fadvise(self.fd,0,0,os.POSIX_FADV_SEQUENTIAL)
+      # last SEEK_DATA/SEEK_HOLE answers, saves syscalls on long extents
+      self.data_region=(0,0)
+      self.hole_region=(0,0)
+      if self.read_mode == 2:
+         if os.fstat(self.fd).st_size > 0:
+            self.map=mmap.mmap(self.fd,0,access=mmap.ACCESS_READ)
+            self.view=memoryview(self.map)
+      elif self.read_mode not in (0,1):
+         raise Exception(f"read mode unknown: {self.read_mode}")
+
+   def read(self, chunk):
+      # returns (data, token), token has to be handed back to release() once data is consumed.
+      return self.read_range(chunk*self.chunk_size,self.chunk_size)
+
+   def read_range(self, offset, length):
+      # same as read() for any range up to the buffer size, used by content defined
+      # chunks and segments of large chunks.
+      if self.metrics is False:
+         return self._read_range(offset,length)
+      start=self.metrics.clock()
+      data, token = self._read_range(offset,length)
+      self.metrics.add(phase="read",start=start,bytes_read=len(data))
+      return data, token
+
+   def _read_range(self, offset, length):
+      if self.io_mode == 2:
+         try:
+            return self.read_direct(offset,length)
+         except OSError as e:
+            if e.errno != errno.EINVAL:
+               raise
+            # unaligned end of file on some filesystems, page cache friendly at least
+            self.io_mode=1
+      if self.io_mode == 1:
+         self.advise(offset,length)
+      self.bytes_read+=length
+      if self.read_mode == 1:
+         try:
+            buffer=self.free_buffers.pop()
+         except IndexError:
+            # only allocated until the number of chunks in flight is reached.
+            buffer=bytearray(self.buffer_size)
+         length=os.preadv(self.fd,[memoryview(buffer)[:length]],offset)
+         return memoryview(buffer)[:length], buffer
+      elif self.read_mode == 2:
+         if self.view is False:
+            return b'', False
+         return self.view[offset:offset+length], False
+      else:
+         return os.pread(self.fd,length,offset), False
+
+   def read_direct(self, offset, length):
+      # aligned range around the wanted one, the buffer (anonymous mmap) is page aligned
+      start=offset-offset % self.align
+      end=-(-(offset+length)//self.align)*self.align
+      try:
+         buffer=self.free_buffers.pop()
+      except IndexError:
+         buffer=mmap.mmap(-1,-(-(self.buffer_size+self.align)//self.align)*self.align+self.align)
+      count=os.preadv(self.direct_fd,[memoryview(buffer)[:end-start]],start)
+      self.bytes_read+=end-start
+      return memoryview(buffer)[offset-start:max(offset-start,min(offset-start+length,count))], buffer
+
+   def advise(self, offset, length):
+      # keeps readahead bytes advised ahead of the reads, drops what is a window behind.
+      # reads of worker threads are a bit out of order, the window covers that.
+      end=offset+length
+      with self.lock:
+         if end+self.readahead//2 > self.advised:
+            start=max(self.advised,end)
+            os.posix_fadvise(self.fd,start,end+self.readahead-start,os.POSIX_FADV_WILLNEED)
+            self.advised=end+self.readahead
+         if offset-self.dropped >= 2*self.readahead:
+            os.posix_fadvise(self.fd,self.dropped,offset-self.readahead-self.dropped,os.POSIX_FADV_DONTNEED)
+            self.dropped=offset-self.readahead
+
+   def reused(self, data):
+      # True if data lives in a buffer which is handed out again after release()
+      return isinstance(data,memoryview) and isinstance(data.obj,(bytearray,mmap.mmap)) and data.obj is not self.map
+
+   def report(self):
+      # io mode and read throughput, for the summary of a run
+      age=max(time.time()-self.s_time,0.001)
+      return f"io mode[{('buffered','fadvise','direct')[self.io_mode]}] read[{self.bytes_read//(1024*1024)} MB] at {self.bytes_read/age/(1024*1024):.1f} MB/s"
+
+   def release(self, token):
+      if token is not False:
+         self.free_buffers.append(token)
+
+   def is_hole(self, chunk, length):
+      # True if the chunk holds no allocated data at all, read it as zeros without any io.
+      return self.is_hole_range(chunk*self.chunk_size,length)
+
+   def is_hole_range(self, offset, length):
+      if length <= 0 or not hasattr(os,"SEEK_DATA"):
+         return False
+      if self.data_region[0] <= offset and offset+length <= self.data_region[1]:
+         return False
+      if self.hole_region[0] <= offset and offset+length <= self.hole_region[1]:
+         return True
+      try:
+         data=os.lseek(self.fd,offset,os.SEEK_DATA)
+      except OSError as e:
+         if e.errno == errno.ENXIO:
+            # no data behind offset
+            self.hole_region=(offset,sys.maxsize)
+            return True
+         # filesystem without support
+         return False
+      if data > offset:
+         self.hole_region=(offset,data)
+         return data >= offset+length
+      self.data_region=(data,os.lseek(self.fd,data,os.SEEK_HOLE))
+      return False
+
+   def close(self):
+      try:
+         if self.view is not False:
+            self.view.release()
+         if self.map is not False:
+            self.map.close()
+      except BufferError:
+         # slices still referenced somewhere, gc will take care.
+         pass
+      self.view=False
+      self.map=False
+      if self.fd != -1:
+         if self.io_mode == 1:
+            # whatever is left of this run
+            os.posix_fadvise(self.fd,0,0,os.POSIX_FADV_DONTNEED)
+         os.close(self.fd)
+         self.fd=-1
+      if self.direct_fd != -1:
+         os.close(self.direct_fd)
+         self.direct_fd=-1
+
+class cdc_chunker():
+   """ content defined chunk boundaries, FastCDC-style normalized chunking.
+
+   each byte is mapped to one bit by a fixed table, a boundary is placed where the
+   bits of the last bytes match a fixed pattern - the long pattern until the average
+   size is reached, its shorter tail up to max_size. The boundary only depends on
+   the bytes of the chunk itself, so after an insert the boundaries sync up again.
+
+   scanning is done by bytes.translate/bytes.find, a per byte rolling hash loop in
+   python does ~5MB/s only.
+   """
+
+   def __init__(self, *, min_size, max_size):
+      if max_size <= min_size:
+         raise Exception(f"max chunk size {max_size} has to be larger than min chunk size {min_size}")
+      avg_bits=round((math.log2(min_size)+math.log2(max_size))/2)
+      self.min_size=min_size
+      self.max_size=max_size
+      self.avg_size=min(max(1 << avg_bits,min_size),max_size)
+      # same on every host - sender and receiver have to find the same boundaries.
+      self.table=bytes(hashlib.sha256(b"avahi-backup-cdc"+bytes([idx])).digest()[0] & 1 for idx in range(256))
+      seed=hashlib.sha256(b"avahi-backup-cdc-pattern").digest()
+      self.pattern_long=bytes((seed[idx >> 3] >> (idx & 7)) & 1 for idx in range(avg_bits+1))
+      self.pattern_short=self.pattern_long[2:]
+
+   def bits(self, data):
+      return data.translate(self.table)
+
+   def cut(self, bits, pos, end):
+      # length of the chunk starting at pos, bits[pos:end] is the translated data
+      # which has to reach at least max_size behind pos unless end is the end of file.
+      if end-pos <= self.min_size:
+         return end-pos
+      found=bits.find(self.pattern_long,pos+max(0,self.min_size-len(self.pattern_long)),min(end,pos+self.avg_size))
+      if found >= 0:
+         return found+len(self.pattern_long)-pos
+      found=bits.find(self.pattern_short,pos+self.avg_size-len(self.pattern_short),min(end,pos+self.max_size))
+      if found >= 0:
+         return found+len(self.pattern_short)-pos
+      # no boundary (e.g. runs of zeros)
+      return min(end-pos,self.max_size)
+
+class transfer_tuner():
+   """ codec and level per frame for --remote-transfer-mode 3.
+
+   every candidate (raw, codec:level) keeps a moving average of its compression time
+   and ratio per byte, the link of its write time per byte - writes block as soon as
+   the pipe/ssh window is full, so that is the real link throughput. a frame costs
+   about time + ratio*link per byte, the cheapest candidate is used. on a fast link
+   raw/lz4 wins, on a slow one the higher zstd levels. every probe_interval-th frame
+   tries another candidate, data and link change over time.
+   """
+
+   probe_interval = 16
+   weight = 0.2
+
+   def __init__(self, *, candidates):
+      self.lock=threading.Lock()
+      self.candidates=candidates
+      self.time={}
+      self.ratio={}
+      self.link=False
+      self.frames=0
+
+   def choose(self):
+      with self.lock:
+         self.frames+=1
+         for candidate in self.candidates:
+            if candidate not in self.ratio:
+               return candidate
+         if self.frames % self.probe_interval == 0:
+            return self.candidates[(self.frames//self.probe_interval) % len(self.candidates)]
+         link=self.link or 0.0
+         return min(self.candidates,key=lambda candidate: self.time[candidate]+self.ratio[candidate]*link)
+
+   def _average(self, old, new):
+      if old is False:
+         return new
+      return old+(new-old)*self.weight
+
+   def update_codec(self, candidate, length, compressed_length, seconds):
+      if length == 0:
+         return
+      with self.lock:
+         self.time[candidate]=self._average(self.time.get(candidate,False),seconds/length)
+         self.ratio[candidate]=self._average(self.ratio.get(candidate,False),compressed_length/length)
+
+   def update_link(self, length, seconds):
+      if length == 0:
+         return
+      with self.lock:
+         self.link=self._average(self.link,seconds/length)
+
+class hash_table():
+   """ chunk number -> raw digest, stored as packed table (hashfile format v2).
+
+   file layout:
+   - header (magic, version, digest size, chunk size, size, mtime, chunks, algorithm, length of inputfile)
+   - inputfile (utf-8)
+   - presence bitmap, one bit per chunk
+   - digest table, chunks * digest size bytes, indexed by chunk number
+
+   version 3 is used for content defined chunks: the header is followed by the max
+   chunk size and the digest table by the end offset of each chunk (8 bytes each).
+
+   tables loaded from a file are mmap-ed copy-on-write, so lookups and single
+   updates only touch the pages needed, save() writes back changed entries only.
+   """
+
+   magic=b"AVBHASH2"
+   version=2
+   version_cdc=3
+   header_format=">8sIIQQdQ16sI"
+   header_length=struct.calcsize(header_format)
+
+   def __init__(self, *, chunks=0, digest_size=32, algorithm="sha256", chunk_size=0, size=0, mtime=0, inputfile="", max_chunk_size=0):
+      self.chunks=chunks
+      self.max_chunk_size=max_chunk_size
+      self.digest_size=digest_size
+      self.algorithm=algorithm
+      self.chunk_size=chunk_size
+      self.size=size
+      self.mtime=mtime
+      self.inputfile=inputfile
+      self.bitmap=bytearray((chunks+7)//8)
+      self.table=bytearray(chunks*digest_size)
+      self.ends=bytearray(chunks*8 if max_chunk_size > 0 else 0)
+      self.count=0
+      # changed chunks since load, for writing back in place.
+      self.dirty=set()
+      self.filename=False
+      self.map=False
+
+   @classmethod
+   def _parse_header(cls, raw):
+      magic, version, digest_size, chunk_size, size, mtime, chunks, algorithm, inputfile_length = struct.unpack(cls.header_format,raw)
+      if magic != cls.magic or version not in (cls.version,cls.version_cdc):
+         raise Exception("not a v2 hashfile")
+      return {
+         "version": version,
+         "digest_size": digest_size,
+         "chunk_size": chunk_size,
+         "size": size,
+         "mtime": mtime,
+         "chunks": chunks,
+         "algorithm": algorithm.rstrip(b"\0").decode(),
+         "inputfile_length": inputfile_length
+      }
+
+   @classmethod
+   def _from_header(cls, header, inputfile):
+      table=cls.__new__(cls)
+      table.chunks=header["chunks"]
+      table.digest_size=header["digest_size"]
+      table.algorithm=header["algorithm"]
+      table.chunk_size=header["chunk_size"]
+      table.size=header["size"]
+      table.mtime=header["mtime"]
+      table.inputfile=inputfile.decode(errors="surrogateescape")
+      table.max_chunk_size=header.get("max_chunk_size",0)
+      table.dirty=set()
+      table.filename=False
+      table.map=False
+      return table
+
+   def _offsets(self):
+      bitmap_offset=self.header_length+(8 if self.max_chunk_size > 0 else 0)+len(self.inputfile.encode(errors="surrogateescape"))
+      table_offset=bitmap_offset+(self.chunks+7)//8
+      return bitmap_offset, table_offset
+
+   def _ends_offset(self):
+      return self._offsets()[1]+self.chunks*self.digest_size
+
+   @classmethod
+   def is_hashfile(cls, filename):
+      with open(filename,"rb") as handle:
+         return handle.read(len(cls.magic)) == cls.magic
+
+   @classmethod
+   def load(cls, filename):
+      # mmap the file, nothing of the table is read until it is used.
+      with open(filename,"rb") as handle:
+         header=cls._parse_header(handle.read(cls.header_length))
+         if header["version"] == cls.version_cdc:
+            header["max_chunk_size"]=int.from_bytes(handle.read(8),'big')
+         table=cls._from_header(header,handle.read(header["inputfile_length"]))
+         table.map=mmap.mmap(handle.fileno(),0,access=mmap.ACCESS_COPY)
+      bitmap_offset, table_offset = table._offsets()
+      ends_offset=table._ends_offset()
+      ends_length=table.chunks*8 if table.max_chunk_size > 0 else 0
+      if len(table.map) < ends_offset+ends_length:
+         raise Exception("hashfile truncated")
+      view=memoryview(table.map)
+      table.bitmap=view[bitmap_offset:table_offset]
+      table.table=view[table_offset:ends_offset]
+      table.ends=view[ends_offset:ends_offset+ends_length]
+      table.count=int.from_bytes(table.bitmap,'big').bit_count()
+      table.filename=filename
+      return table
+
+   @classmethod
+   def load_stream(cls, handle):
+      # read exactly one table from a stream (e.g. stdin), the stream stays open.
+      header=cls._parse_header(bytes(read_exact(handle,cls.header_length)))
+      if header["version"] == cls.version_cdc:
+         header["max_chunk_size"]=int.from_bytes(read_exact(handle,8),'big')
+      table=cls._from_header(header,bytes(read_exact(handle,header["inputfile_length"])))
+      table.bitmap=read_exact(handle,(table.chunks+7)//8)
+      table.table=read_exact(handle,table.chunks*table.digest_size)
+      table.ends=read_exact(handle,table.chunks*8 if table.max_chunk_size > 0 else 0)
+      table.count=int.from_bytes(table.bitmap,'big').bit_count()
+      return table
+
+   @classmethod
+   def from_dict(cls, hashes, **kwargs):
+      # migration from the v1.0.3 pickle format (chunk -> hexdigest)
+      chunks=max(hashes.keys())+1 if len(hashes) > 0 else 0
+      table=cls(chunks=chunks, **kwargs)
+      for chunk, hexdigest in hashes.items():
+         table[chunk]=bytes.fromhex(hexdigest)
+      return table
+
+   def _grow(self, chunk):
+      # content defined tables grow chunk by chunk, avoid a copy per chunk.
+      if self.max_chunk_size > 0:
+         self._resize(max(chunk+1,self.chunks*5//4))
+      else:
+         self._resize(chunk+1)
+
+   def _resize(self, chunks):
+      # leaves the mmap, the next save() writes a complete file.
+      bitmap=bytearray((chunks+7)//8)
+      bitmap[:len(self.bitmap)]=self.bitmap
+      table=bytearray(chunks*self.digest_size)
+      table[:len(self.table)]=self.table
+      if self.max_chunk_size > 0:
+         ends=bytearray(chunks*8)
+         ends[:len(self.ends)]=self.ends
+         self.ends=ends
+      self.bitmap=bitmap
+      self.table=table
+      self.chunks=chunks
+      self.map=False
+
+   def get(self, chunk, default=False):
+      if chunk < 0 or chunk >= self.chunks or not self.bitmap[chunk >> 3] & (1 << (chunk & 7)):
+         return default
+      offset=chunk*self.digest_size
+      return bytes(self.table[offset:offset+self.digest_size])
+
+   def span(self, chunk):
+      # (offset, length) of a content defined chunk, its predecessor has to be known.
+      start=0
+      if chunk > 0:
+         start=int.from_bytes(self.ends[(chunk-1)*8:chunk*8],'big')
+      return start, int.from_bytes(self.ends[chunk*8:(chunk+1)*8],'big')-start
+
+   def set_end(self, chunk, end):
+      if chunk >= self.chunks:
+         self._grow(chunk)
+      self.ends[chunk*8:(chunk+1)*8]=end.to_bytes(8,'big')
+      self.dirty.add(chunk)
+
+   def __getitem__(self, chunk):
+      digest=self.get(chunk,None)
+      if digest is None:
+         raise KeyError(chunk)
+      return digest
+
+   def __setitem__(self, chunk, digest):
+      if len(digest) != self.digest_size:
+         raise Exception(f"digest size mismatch {len(digest)} != {self.digest_size}")
+      if chunk >= self.chunks:
+         self._grow(chunk)
+      offset=chunk*self.digest_size
+      self.table[offset:offset+self.digest_size]=digest
+      if not self.bitmap[chunk >> 3] & (1 << (chunk & 7)):
+         self.bitmap[chunk >> 3]|=(1 << (chunk & 7))
+         self.count+=1
+      self.dirty.add(chunk)
+
+   def __delitem__(self, chunk):
+      if chunk < self.chunks and self.bitmap[chunk >> 3] & (1 << (chunk & 7)):
+         self.bitmap[chunk >> 3]&=~(1 << (chunk & 7)) & 0xff
+         self.count-=1
+         self.dirty.add(chunk)
+
+   def __contains__(self, chunk):
+      return self.get(chunk,None) is not None
+
+   def __len__(self):
+      return self.count
+
+   def present(self, chunks):
+      # number of known chunks below chunk number chunks
+      count=int.from_bytes(self.bitmap[:chunks >> 3],'big').bit_count()
+      if chunks & 7:
+         count+=(self.bitmap[chunks >> 3] & ((1 << (chunks & 7))-1)).bit_count()
+      return count
+
+   def keys(self):
+      for chunk in range(0,self.chunks):
+         if self.bitmap[chunk >> 3] & (1 << (chunk & 7)):
+            yield chunk
+
+   def items(self):
+      for chunk in self.keys():
+         yield chunk, self.get(chunk)
+
+   def save(self, filename, *, chunk_size, size, mtime, inputfile):
+      self.chunk_size=chunk_size
+      self.size=size
+      self.mtime=mtime
+      version=self.version_cdc if self.max_chunk_size > 0 else self.version
+      header=struct.pack(self.header_format,self.magic,version,self.digest_size,self.chunk_size,self.size,self.mtime,self.chunks,self.algorithm.encode(),len(inputfile.encode(errors="surrogateescape")))
+      if self.max_chunk_size > 0:
+         header+=self.max_chunk_size.to_bytes(8,'big')
+
+      if self.map is not False and self.filename == filename and inputfile == self.inputfile and os.path.isfile(filename):
+         # same geometry: write back changed entries, their bitmap bytes and the header.
+         bitmap_offset, table_offset = self._offsets()
+         ends_offset=self._ends_offset()
+         fd=os.open(filename,os.O_WRONLY)
+         try:
+            for chunk in sorted(self.dirty):
+               offset=chunk*self.digest_size
+               os.pwrite(fd,self.table[offset:offset+self.digest_size],table_offset+offset)
+               if self.max_chunk_size > 0:
+                  os.pwrite(fd,self.ends[chunk*8:(chunk+1)*8],ends_offset+chunk*8)
+            for idx in sorted(set(chunk >> 3 for chunk in self.dirty)):
+               os.pwrite(fd,self.bitmap[idx:idx+1],bitmap_offset+idx)
+            os.pwrite(fd,header,0)
+         finally:
+            os.close(fd)
+      else:
+         # complete file, replaced atomically.
+         self.inputfile=inputfile
+         with open(filename+".tmp","wb") as handle:
+            handle.write(header)
+            handle.write(inputfile.encode(errors="surrogateescape"))
+            handle.write(self.bitmap)
+            handle.write(self.table)
+            handle.write(self.ends)
+         os.replace(filename+".tmp",filename)
+      self.dirty=set()
+
+class merkle_tree():
+   """ hash tree above the chunk digests of a hash_table, compared top-down.
+
+   level 0 are the chunk digests (missing chunks count as zero digest), every node
+   above is the sha256 over up to fanout digests of the level below. both sides
+   build their tree over the same number of leaves, so the trees have the same
+   shape and a differing node means a differing chunk below it.
+   """
+
+   def __init__(self, table, *, leaves, fanout=64, first=0):
+      self.fanout=fanout
+      self.digest_size=table.digest_size
+      self.leaves=leaves
+      ds=self.digest_size
+      available=min(table.chunks,leaves)
+      if first > 0:
+         # resumed transfer: leaves before first are settled, zero on both sides
+         level=bytearray(available*ds)
+         for chunk, digest in table.items():
+            if first <= chunk < available:
+               level[chunk*ds:(chunk+1)*ds]=digest
+      elif table.present(available) == available:
+         # all there, use the table without a copy
+         level=memoryview(table.table)[:available*ds]
+      else:
+         level=bytearray(available*ds)
+         for chunk, digest in table.items():
+            if chunk < available:
+               level[chunk*ds:(chunk+1)*ds]=digest
+      self.levels=[level]
+      count=leaves
+      while count > 1:
+         group=fanout*ds
+         nodes=[]
+         for idx in range(0,count*ds,group):
+            piece=level[idx:idx+group]
+            missing=min(group,count*ds-idx)-len(piece)
+            if missing > 0:
+               # leaves behind the end of this table
+               piece=bytes(piece)+bytes(missing)
+            nodes.append(hashlib.sha256(piece).digest())
+         level=b''.join(nodes)
+         count=len(nodes)
+         self.levels.append(level)
+
+   def depth(self):
+      return len(self.levels)
+
+   def count(self, level):
+      if level == 0:
+         return self.leaves
+      return len(self.levels[level])//self.digest_size
+
+   def node(self, level, idx):
+      digest=bytes(self.levels[level][idx*self.digest_size:(idx+1)*self.digest_size])
+      if len(digest) < self.digest_size:
+         return bytes(self.digest_size)
+      return digest
+
+   def children(self, level, idx, limit):
+      # children which cover at least one of the first limit leaves, the rest
+      # would be cut off anyway.
+      first=idx*self.fanout
+      span=self.fanout**(level-1)
+      return range(first,min(first+self.fanout,self.count(level-1),(limit+span-1)//span))
+
+class io_governor():
+   """ paces hashing and delta transfer by the load of the host, shared by all threads.
+
+   --max-rate caps the bytes/s. with --psi-io/--psi-cpu SLOW:PAUSE the "some avg10"
+   of /proc/pressure/<resource> is sampled once a second: above SLOW the allowed rate
+   is halved, below it grows again by a quarter until the cap (or no limit) is back,
+   above PAUSE io stops until the pressure drops below SLOW. io also stops as long as
+   one of the --pause-process processes runs. every decision is logged to stderr.
+   """
+
+   # lowest rate when slowing down, progress has to be made anyway
+   floor=1024*1024
+
+   def __init__(self, *, max_rate=False, psi_io=False, psi_cpu=False, processes=()):
+      self.max_rate=max_rate
+      self.limits={}
+      # (slow, pause) of pressure_limits()
+      for name, value in (("io",psi_io),("cpu",psi_cpu)):
+         if value is False:
+            continue
+         if os.path.isfile(f"/proc/pressure/{name}") is False:
+            self.log(f"no /proc/pressure/{name} (kernel without PSI), {name} pressure is not watched")
+            continue
+         self.limits[name]=value
+      # compiled patterns of process_pattern()
+      self.processes=list(processes)
+      self.state="run"
+      self.rate=max_rate
+      self.allowance=0
+      self.lock=threading.Lock()
+      now=time.monotonic()
+      self.last=now
+      # first io checks right away
+      self.next_sample=now
+      self.next_process_check=0
+      self.blocked=False
+      # throughput since the last sample, base for slowing down without a cap
+      self.window_start=now
+      self.window_bytes=0
+      self.log(f"start max-rate[{max_rate or '-'}] pressure limits{self.limits} pause processes{[ item.pattern for item in self.processes ]}")
+
+   def log(self, msg):
+      os.write(sys.stderr.fileno(),f"[{'governor':>20}]: {time.strftime('%H:%M:%S')} {msg}\n".encode())
+
+   def pressure(self, name):
+      # "some avg10=1.23 avg60=... total=..." -> 1.23
+      with open(f"/proc/pressure/{name}") as handle:
+         return float(handle.readline().split()[1].split("=")[1])
+
+   def blacklisted(self, now):
+      # name of a running --pause-process, checked every 5 seconds (every second while blocked).
+      # like pgrep: pattern search in the process name. comm is cut to 15 characters,
+      # the name of the executable from cmdline is searched as well.
+      if len(self.processes) == 0 or now < self.next_process_check:
+         return self.blocked
+      self.blocked=False
+      for pid in os.listdir("/proc"):
+         if pid.isdigit():
+            try:
+               with open(f"/proc/{pid}/comm") as handle:
+                  names=[handle.read().strip()]
+               with open(f"/proc/{pid}/cmdline","rb") as handle:
+                  names.append(os.path.basename(handle.read().split(b"\0")[0].decode(errors="replace")))
+            except OSError:
+               continue
+            for pattern in self.processes:
+               if any(pattern.search(name) for name in names):
+                  self.blocked=names[0]
+                  break
+            if self.blocked is not False:
+               break
+      self.next_process_check=now+(1 if self.blocked is not False else 5)
+      return self.blocked
+
+   def sample(self, now):
+      measured=self.window_bytes/max(now-self.window_start,0.001)
+      self.window_start=now
+      self.window_bytes=0
+      self.next_sample=now+1
+      pressure={ name: self.pressure(name) for name in self.limits }
+      process=self.blacklisted(now)
+      state=self.state
+      rate=self.rate
+      if process is not False:
+         state, reason = "pause", f"process[{process}]"
+      elif any(pressure[name] >= pause for name, (slow, pause) in self.limits.items()):
+         state, reason = "pause", "pressure"
+      elif any(pressure[name] >= slow for name, (slow, pause) in self.limits.items()):
+         state, reason = "slow", "pressure"
+         rate=max(self.floor,int((self.rate or measured or self.floor*2)/2))
+      elif self.state != "run" and self.rate is False:
+         # paused without being slowed down before, no reason to creep back
+         state, reason = "run", "recover"
+      elif self.state != "run":
+         state, reason = "slow", "recover"
+         rate=int(max(self.rate,self.floor)*1.25)
+         if self.max_rate is not False and rate >= self.max_rate:
+            state, rate = "run", self.max_rate
+         elif self.max_rate is False and rate > 2*max(measured,self.floor):
+            # not the limit anymore
+            state, rate = "run", False
+      if state != self.state or rate != self.rate:
+         self.log(f"{self.state} -> {state} ({reason}) rate[{rate or '-'}] measured[{int(measured)}] pressure{pressure}")
+         self.state=state
+         self.rate=rate
+
+   def throttle(self, length):
+      # called before length bytes are read or written, sleeps as needed
+      with self.lock:
+         now=time.monotonic()
+         if now >= self.next_sample:
+            self.sample(now)
+         while self.state == "pause":
+            # all threads wait here
+            time.sleep(1)
+            now=time.monotonic()
+            self.sample(now)
+            self.last=now
+         if self.rate is not False:
+            # token bucket with a second of burst
+            self.allowance=min(self.allowance+(now-self.last)*self.rate,self.rate)
+            self.last=now
+            self.allowance-=length
+            if self.allowance < 0:
+               time.sleep(-self.allowance/self.rate)
+         self.window_bytes+=length
+
+class relocation_plan():
+   """ moved chunks of fixed size deltas against a reference table (verify_against, or
+   the receiver digests of the hash tree negotiation).
+
+   the receiver patches in place and frames are shipped in chunk order, so a chunk of
+   the reference can be copied as long as it was not written yet. if a later chunk is
+   known to need the old content of a chunk which is about to be written, it is
+   staged at the receiver first (overlapping moves, swaps).
+   """
+
+   def __init__(self, *, reference, table):
+      self.reference=reference
+      # digest -> chunks of the reference
+      self.sources={}
+      for chunk, digest in reference.items():
+         self.sources.setdefault(digest,[]).append(chunk)
+      # old contents needed at other places, as far as the new hashes are known already
+      self.wanted=set()
+      for chunk, digest in table.items():
+         if digest in self.sources and reference.get(chunk,False) != digest:
+            self.wanted.add(digest)
+      # chunks written at the receiver, staged chunks and digest -> chunk holding it for good
+      self.written=set()
+      self.staged={}
+      self.final={}
+
+   def source(self, chunk, digest):
+      # -> (source chunk, staged) or False if the data has to be shipped
+      if digest in self.final:
+         return self.final[digest], False
+      for source in self.sources.get(digest,()):
+         if source != chunk and source not in self.written:
+            return source, False
+      if digest in self.staged:
+         return self.staged[digest], True
+      return False
+
+   def needs_stage(self, chunk):
+      # old content of chunk is wanted later and would be gone with the next write
+      digest=self.reference.get(chunk,False)
+      if digest is False or digest not in self.wanted or digest in self.final or digest in self.staged:
+         return False
+      for source in self.sources[digest]:
+         if source != chunk and source not in self.written:
+            return False
+      return True
+
+   def stage(self, chunk):
+      self.staged[self.reference.get(chunk)]=chunk
+
+   def write(self, chunk, digest=False):
+      self.written.add(chunk)
+      if digest is not False:
+         self.final.setdefault(digest,chunk)
+
+class chunk_index():
+   """ digest -> (file, offset, length) over all files of the server (--chunk-index).
+
+   filled from hashfiles, a file is only used as long as it has the size and mtime
+   its hashes were taken with. zero chunks are left out, they are shipped as zero
+   frames anyway.
+   """
+
+   def __init__(self, filename):
+      self.filename=filename
+      self.db=sqlite3.connect(filename)
+      self.db.execute("CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, algorithm TEXT, size INTEGER, mtime REAL, hashfile TEXT, hashfile_mtime REAL)")
+      self.db.execute("CREATE TABLE IF NOT EXISTS chunks (digest BLOB, file INTEGER, offset INTEGER, length INTEGER)")
+      self.db.execute("CREATE INDEX IF NOT EXISTS chunks_digest ON chunks (digest)")
+      self.db.execute("CREATE INDEX IF NOT EXISTS chunks_file ON chunks (file)")
+      self.db.commit()
+
+   def add_table(self, *, table, inputfile, size, mtime, hashfile="", hashfile_mtime=0):
+      # (re)places all chunks of inputfile
+      zero_digests={}
+      def rows(file_id):
+         for chunk, digest in table.items():
+            if table.max_chunk_size > 0:
+               offset, length = table.span(chunk)
+            else:
+               offset=chunk*table.chunk_size
+               length=min(table.chunk_size,size-offset)
+            if length <= 0:
+               continue
+            if length not in zero_digests:
+               zero_digests[length]=hash_zeros(hash_stream(table.algorithm),length)
+            if digest != zero_digests[length]:
+               yield (digest,file_id,offset,length)
+      with self.db:
+         self.db.execute("DELETE FROM chunks WHERE file IN (SELECT id FROM files WHERE path=?)",(inputfile,))
+         self.db.execute("DELETE FROM files WHERE path=?",(inputfile,))
+         file_id=self.db.execute("INSERT INTO files (path, algorithm, size, mtime, hashfile, hashfile_mtime) VALUES (?,?,?,?,?,?)",(inputfile,table.algorithm,size,mtime,hashfile,hashfile_mtime)).lastrowid
+         self.db.executemany("INSERT INTO chunks (digest, file, offset, length) VALUES (?,?,?,?)",rows(file_id))
+
+   def scan(self, directory):
+      # index all hashfiles below directory, unchanged hashfiles are skipped.
+      known={ hashfile: hashfile_mtime for hashfile, hashfile_mtime in self.db.execute("SELECT hashfile, hashfile_mtime FROM files") }
+      added=0
+      for root, dirs, files in os.walk(directory):
+         for name in files:
+            hashfile=os.path.join(root,name)
+            try:
+               if not hash_table.is_hashfile(hashfile):
+                  continue
+               hashfile_mtime=os.stat(hashfile).st_mtime
+               if known.get(hashfile,False) == hashfile_mtime:
+                  continue
+               table=hash_table.load(hashfile)
+            except Exception:
+               # journals, partial writes, other files
+               continue
+            self.add_table(table=table,inputfile=table.inputfile,size=table.size,mtime=table.mtime,hashfile=hashfile,hashfile_mtime=hashfile_mtime)
+            added+=1
+      return added
+
+   def lookup(self, digest, *, algorithm, exclude=False):
+      # -> [(file, offset, length)] of files which did not change since indexed
+      found=[]
+      for path, size, mtime, offset, length in self.db.execute("SELECT files.path, files.size, files.mtime, chunks.offset, chunks.length FROM chunks JOIN files ON files.id=chunks.file WHERE chunks.digest=? AND files.algorithm=?",(digest,algorithm)):
+         if path == exclude:
+            continue
+         try:
+            stats=os.stat(path)
+         except OSError:
+            continue
+         if stats.st_size == size and stats.st_mtime == mtime:
+            found.append((path,offset,length))
+      return found
+
+   def close(self):
+      self.db.close()
+
+class state_store():
+   """ state of the backup runs (--state): the queues and the time of the last
+   complete remote patching of every hashfile (last-ok).
+
+   sqlite, every change is one small transaction and lookups go by key - no more
+   sourcing and rewriting a whole "declare -p" file per change. those files of older
+   versions are taken over by import_file().
+   """
+
+   def __init__(self, filename):
+      self.filename=filename
+      os.makedirs(os.path.dirname(os.path.abspath(filename)),exist_ok=True)
+      # several backup jobs may share the store, wait for the others instead of failing
+      self.db=sqlite3.connect(filename,timeout=60)
+      self.db.execute("PRAGMA journal_mode=WAL")
+      self.db.execute("CREATE TABLE IF NOT EXISTS queue (name TEXT, inputfile TEXT, entry TEXT, queued REAL, left INTEGER, PRIMARY KEY (name, inputfile))")
+      self.db.execute("CREATE TABLE IF NOT EXISTS last_ok (key TEXT PRIMARY KEY, time REAL)")
+      self.db.commit()
+
+   def close(self):
+      self.db.close()
+
+   def queue(self, name):
+      # inputfile -> entry
+      entries={}
+      for inputfile, entry, queued, left in self.db.execute("SELECT inputfile, entry, queued, left FROM queue WHERE name=?",(name,)):
+         entries[inputfile]=json.loads(entry)
+         entries[inputfile]["queued"]=queued
+         if left is not None:
+            entries[inputfile]["left"]=left
+      return entries
+
+   def queue_add(self, name, inputfile, entry):
+      # a requeued file keeps its place in line, returns the time it was queued first
+      entry=dict(entry)
+      queued=entry.pop("queued",time.time())
+      entry.pop("left",None)
+      with self.db:
+         self.db.execute("INSERT INTO queue (name, inputfile, entry, queued) VALUES (?,?,?,?) ON CONFLICT (name, inputfile) DO UPDATE SET entry=excluded.entry",(name,inputfile,json.dumps(entry),queued))
+         return self.db.execute("SELECT queued FROM queue WHERE name=? AND inputfile=?",(name,inputfile)).fetchone()[0]
+
+   def queue_left(self, name, inputfile, left):
+      with self.db:
+         self.db.execute("UPDATE queue SET left=? WHERE name=? AND inputfile=?",(None if left is False else left,name,inputfile))
+
+   def queue_remove(self, name, inputfile):
+      with self.db:
+         self.db.execute("DELETE FROM queue WHERE name=? AND inputfile=?",(name,inputfile))
+
+   def last_ok(self, key):
+      row=self.db.execute("SELECT time FROM last_ok WHERE key=?",(key,)).fetchone()
+      if row is None:
+         return False
+      return row[0]
+
+   def set_last_ok(self, keys, when=False):
+      when=when or time.time()
+      with self.db:
+         self.db.executemany("INSERT OR REPLACE INTO last_ok (key, time) VALUES (?,?)",[ (key,when) for key in keys ])
+
+   def import_file(self, filename):
+      # "declare -p" files of the bash code (HASHER_QUEUE, REMOTE_QUEUE, HASHER_DELTA_LAST_OK)
+      # and the json queue files of 1.12/1.13. returns the number of imported entries.
+      with open(filename) as handle:
+         text=handle.read()
+      if text.startswith("declare -A "):
+         variable, items = self._from_bash(filename,text)
+      elif text.strip() != "":
+         variable=False
+         items=json.loads(text).items()
+      else:
+         return 0
+      count=0
+      queued=os.stat(filename).st_mtime
+      with self.db:
+         for key, value in items:
+            if variable == "HASHER_DELTA_LAST_OK":
+               self.db.execute("INSERT OR REPLACE INTO last_ok (key, time) VALUES (?,?)",(key,float(value)))
+            else:
+               if variable is not False:
+                  value=self._from_bash_entry(value)
+               name="remote" if value.get("remote-hostname",False) is not False else "hasher"
+               left=value.pop("left",False)
+               queued_first=value.pop("queued",queued)
+               self.db.execute("INSERT OR REPLACE INTO queue (name, inputfile, entry, queued, left) VALUES (?,?,?,?,?)",(name,key,json.dumps(value),queued_first,None if left is False else left))
+            count+=1
+      return count
+
+   def _from_bash(self, filename, text):
+      # bash itself reads the array, key quoting differs between bash versions
+      import subprocess
+      variable=text[len("declare -A "):].split("=",1)[0]
+      listing=subprocess.run(["bash","-c",'source "$1" && declare -n array="$2" && for key in "${!array[@]}"; do printf "%s\\0%s\\0" "${key}" "${array[${key}]}"; done',"-",filename,variable],stdout=subprocess.PIPE,check=True).stdout.decode().split("\0")
+      return variable, zip(listing[0::2],listing[1::2])
+
+   def _from_bash_entry(self, value):
+      import shlex
+      old=json.loads(value.replace("'",'"'))
+      if "args" in old:
+         # remote queue: filehasher.py arguments of the remote patching
+         options=parser.parse_known_args(shlex.split(old["args"]))[0]
+         entry={ "chunk-size": options.min_chunk_size, "hashfile": options.hashfile }
+         for item in hash_queue.remote_keys:
+            entry[item]=getattr(options,item.replace("-","_"))
+      else:
+         entry={ "chunk-size": int(old["chunk-size"]), "hashfile": old.get("hashfile",False) or False }
+      return entry
+
+class hash_queue():
+   """ files whose hashing or remote patching did not complete in time (--queue).
+
+   one named queue of the state store, inputfile -> entry (chunk-size, hashfile,
+   remote-* for remote patching, queued = first time queued, left = estimated bytes
+   still to do). changes go to the store right away.
+   """
+
+   remote_keys=("remote-hostname","remote-src-filename","remote-username","remote-ssh-key")
+
+   def __init__(self, store, name):
+      self.store=store
+      self.name=name
+      self.entries=store.queue(name)
+
+   def __len__(self):
+      return len(self.entries)
+
+   def remove(self, inputfile):
+      self.store.queue_remove(self.name,inputfile)
+      self.entries.pop(inputfile,None)
+
+   def left(self, inputfile, left):
+      self.store.queue_left(self.name,inputfile,left)
+      self.entries[inputfile]["left"]=left
+
+   def weight(self, inputfile):
+      # bytes still to do, a day in the queue doubles it
+      entry=self.entries[inputfile]
+      left=entry.get("left",False)
+      if left is False:
+         try:
+            left=os.stat(inputfile).st_size
+         except OSError:
+            left=0
+      return max(left,1)*(1+max(time.time()-entry.get("queued",time.time()),0)/86400)
+
+   def order(self):
+      # heaviest first, they get their share even if the budget runs out
+      return sorted(self.entries,key=self.weight,reverse=True)
+
+class verify_record():
+   """ time of the last verification of every chunk (--spot-check), next to the hashfile.
+
+   epoch seconds, 0 = never verified or patched since. bound to chunk size, size and
+   mtime of the inputfile, a file changed by anything but patching starts over.
+   """
+
+   magic=b"AVBVRFY1"
+   header_format=">8sQQq"
+
+   def __init__(self, filename, *, chunks, chunk_size, stats):
+      self.filename=filename
+      self.chunk_size=chunk_size
+      # inputfile state the times belong to
+      self.state=(stats.st_size,stats.st_mtime_ns)
+      self.times=array.array("I")
+      try:
+         with open(filename,"rb") as handle:
+            magic, stored_chunk_size, size, mtime_ns = struct.unpack(self.header_format,handle.read(struct.calcsize(self.header_format)))
+            if (magic,stored_chunk_size,size,mtime_ns) == (self.magic,chunk_size,stats.st_size,stats.st_mtime_ns):
+               self.times.frombytes(handle.read())
+               if sys.byteorder == "little":
+                  self.times.byteswap()
+      except (OSError, struct.error, ValueError):
+         pass
+      self.resize(chunks)
+
+   def resize(self, chunks):
+      if len(self.times) > chunks:
+         del self.times[chunks:]
+      else:
+         self.times.extend(array.array("I",bytes(4*(chunks-len(self.times)))))
+
+   def unverified(self, chunks):
+      # patched chunks are verified again first
+      for chunk in chunks:
+         if chunk < len(self.times):
+            self.times[chunk]=0
+
+   def save(self, stats):
+      times=array.array("I",self.times)
+      if sys.byteorder == "little":
+         times.byteswap()
+      with open(self.filename+".tmp","wb") as handle:
+         handle.write(struct.pack(self.header_format,self.magic,self.chunk_size,stats.st_size,stats.st_mtime_ns))
+         times.tofile(handle)
+      os.replace(self.filename+".tmp",self.filename)
+      self.state=(stats.st_size,stats.st_mtime_ns)
+
+class hash_journal():
+   """ append-only journal of (chunk, digest) records next to a hashfile.
+
+   add() only queues a record, a background checkpointer appends the queued
+   records in batches. A killed run loses at most the last batch and the next
+   run replays the journal on top of the hashfile. A clean save_hash folds the
+   journal into the hashfile and removes it.
+
+   The header binds the journal to the inputfile state (chunk size, size, mtime,
+   name) and the hash algorithm the records were hashed from. Records of content defined chunks carry
+   the end offset of the chunk as well.
+   """
+
+   magic=b"AVBJRNL3"
+   header_format=">8s16sIQQQdI"
+
+   def __init__(self, filename, *, interval=1.0, batch=1024):
+      self.filename=filename
+      self.interval=interval
+      self.batch=batch
+      self.pending=[]
+      # reentrant, the signal handler may flush while the main thread is in add()
+      self.lock=threading.RLock()
+      self.wakeup=threading.Event()
+      self.stopped=False
+      self.thread=False
+      self.handle=False
+      self.header=False
+      self.valid_length=0
+
+   def _header(self, *, algorithm, digest_size, chunk_size, max_chunk_size, size, mtime, inputfile):
+      inputfile=inputfile.encode(errors="surrogateescape")
+      return struct.pack(self.header_format,self.magic,algorithm.encode(),digest_size,chunk_size,max_chunk_size,size,mtime,len(inputfile))+inputfile
+
+   def replay(self, table, *, chunk_size, size, mtime, inputfile):
+      # apply journal records to table, returns the number of records applied.
+      self.header=self._header(algorithm=table.algorithm,digest_size=table.digest_size,chunk_size=chunk_size,max_chunk_size=table.max_chunk_size,size=size,mtime=mtime,inputfile=inputfile)
+      self.valid_length=0
+      if not os.path.isfile(self.filename):
+         return 0
+      count=0
+      record_length=8+table.digest_size+(8 if table.max_chunk_size > 0 else 0)
+      with open(self.filename,"rb") as handle:
+         if handle.read(len(self.header)) != self.header:
+            # written for another state of the inputfile
+            handle.close()
+            os.remove(self.filename)
+            return 0
+         while True:
+            raw=handle.read(record_length*4096)
+            # a torn record at the end is ignored
+            for offset in range(0,len(raw)-record_length+1,record_length):
+               chunk=int.from_bytes(raw[offset:offset+8],'big')
+               table[chunk]=raw[offset+8:offset+8+table.digest_size]
+               if table.max_chunk_size > 0:
+                  table.set_end(chunk,int.from_bytes(raw[offset+8+table.digest_size:offset+record_length],'big'))
+               count+=1
+            if len(raw) < record_length*4096:
+               break
+      self.valid_length=len(self.header)+count*record_length
+      return count
+
+   def add(self, chunk, digest, end=False):
+      with self.lock:
+         if end is False:
+            self.pending.append(chunk.to_bytes(8,'big')+digest)
+         else:
+            self.pending.append(chunk.to_bytes(8,'big')+digest+end.to_bytes(8,'big'))
+         if len(self.pending) >= self.batch:
+            self.wakeup.set()
+      if self.thread is False and self.stopped is False:
+         self.thread=threading.Thread(target=self._checkpointer,daemon=True)
+         self.thread.start()
+
+   def _checkpointer(self):
+      while self.stopped is False:
+         self.wakeup.wait(self.interval)
+         self.wakeup.clear()
+         self.flush()
+
+   def flush(self):
+      with self.lock:
+         records=self.pending
+         self.pending=[]
+         if len(records) == 0 or self.header is False:
+            return
+         if self.handle is False:
+            if self.valid_length > 0:
+               # continue a replayed journal, cut a torn record first
+               self.handle=open(self.filename,"r+b")
+               self.handle.truncate(self.valid_length)
+               self.handle.seek(self.valid_length)
+            else:
+               self.handle=open(self.filename,"wb")
+               self.handle.write(self.header)
+         self.handle.write(b''.join(records))
+         self.handle.flush()
+         os.fdatasync(self.handle.fileno())
+
+   def stop(self):
+      # stop the checkpointer and write what is queued. runs in the signal handler:
+      # no join, the checkpointer may wait for the lock the interrupted main thread
+      # holds in add(). flush() takes the reentrant lock and writes all of it.
+      self.stopped=True
+      self.wakeup.set()
+      self.flush()
+
+   def discard(self):
+      # hashfile holds everything now
+      self.stopped=True
+      self.wakeup.set()
+      if self.thread is not False:
+         self.thread.join()
+      with self.lock:
+         self.pending=[]
+         if self.handle is not False:
+            self.handle.close()
+            self.handle=False
+         self.valid_length=0
+         if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+   def restart(self):
+      # start over, e.g. for a full refresh of all hashes
+      self.discard()
+      self.stopped=False
+      self.thread=False
+
 class FileHasher():
 
-   chunk_file_version = "v1.0.3"
+   chunk_file_version = "v2.0.0"
+   chunk_file_version_legacy = "v1.0.3"
    patch_file_version = "v1.0.0"
-   patch_file_version_int = 1
-
-   def __init__(self,* , inputfile=False, hashfile=False, chunk_size=8192, hash_method="flat", debug=False):
+   patch_file_version_int = 8
+   # frame types carrying chunk data: raw, zlib, zstd, lz4
+   data_frame_types = (0,1,6,7)
+   merkle_magic = b"AVBMRKL3"
+   merkle_fanout = 64
+   # fixed chunks above this size are read, hashed and shipped in segments (frame types
+   # 12/13), memory does not grow with --min-chunk-size
+   segment_size = 8*1024*1024
+   # in-flight chunks/frames of the worker pools are bounded by this many bytes
+   window_bytes = 256*1024*1024
+
+   def __init__(self,* , inputfile=False, hashfile=False, chunk_size=8192, max_chunk_size=False, hash_algorithm="sha256", verify_algorithm=False, transfer_mode=0, compression="zstd,lz4,zlib", compress_threads=0, hash_method="flat", read_mode=0, io_mode=0, readahead=64*1024*1024, debug=False):
 
       # defaults
-      self.threads=[]
-      self.lock_reading=threading.Lock()
+      self.pool=False
+      # hashing workers of several files (--queue), not shut down by this one
+      self.shared_pool=False
+      # hashing stops at this time.time() (--queue), the rest is hashed next time
+      self.deadline=False
+      self.hash_stopped=False
       self.lock_update_idx=threading.Lock()
       self.lock_delta_file=threading.Lock()
       self.lock_delta_stream=threading.Lock()
-      self.hash_obj={}
+      self.hash_obj=hash_table()
       self.mtime=0
       self.save_hashes=False
       self._debug=debug
@@ -200,6 +1874,87 @@ class FileHasher():
       self.verify_reference=False
       self.remote_delta_header_sent=False
       self.remote_delta_mode=False
+      self.read_mode=read_mode
+      # page cache behaviour of reads and patch writes, see chunk_reader
+      self.io_mode=io_mode
+      self.readahead=readahead
+      self.written_unsettled=0
+      # pacing by host load (--max-rate, --psi-io, ...), see io_governor
+      self.governor=False
+      # counters and phase timers (--metrics), the cli shares one over all files
+      self.metrics=null_metrics()
+      self.reader=False
+      self.journal=False
+      self.patching=False
+      self.zero_digests={}
+      self.zero_chunk=False
+      # receiver: digest -> chunks of other local files (--chunk-index), for reference frames
+      self.chunk_index=False
+      self.local_references={}
+      # sender: moved chunks within the file, see relocation_plan
+      self.relocation=False
+      # receiver: limits of one transfer (--time-budget/--byte-budget/--chunk-limit), the
+      # sender pauses the stream and the next run resumes at the recorded chunk.
+      self.time_budget=False
+      self.byte_budget=False
+      self.chunk_limit=False
+      self.resume_state=False
+      self.resume_chunk=False
+      # receiver: last verification of the chunks (--spot-check), patched chunks are
+      # marked unverified at save_hash
+      self.verified=False
+      self.patched_chunks=[]
+      # receiver: new file of a content defined patch while it is assembled
+      self.assembly=False
+      # sender: bytes of written frames
+      self.bytes_sent=0
+      # protocol streams of the remote side, the agent serves sockets too
+      self.stream_in=sys.stdin.buffer
+      self.stream_out=sys.stdout.fileno()
+      # change detection digest, stored in the hashfile
+      self.hash_algorithm=hash_algorithm
+      self.hash_function, self.digest_size = hash_function(hash_algorithm)
+      self.hash_stream=hash_stream(hash_algorithm)
+      # optional strong digest of transferred chunks (two-tier), False = frames carry the detection digest only
+      self.verify_algorithm=verify_algorithm
+      self.verify_function=False
+      if self.verify_algorithm is not False:
+         self.verify_function=hash_function(self.verify_algorithm)[0]
+      # frame compression, see compress_frame(). zlib frames are always readable.
+      self.transfer_mode=transfer_mode
+      self.compression=[]
+      frame_type, compress, decompress, default_level = compression_codec("zlib")
+      self.compressors={ "zlib": (frame_type,compress,default_level) }
+      self.decompressors={ frame_type: decompress }
+      for item in compression.split(","):
+         name, _, level = item.partition(":")
+         if level != "" and not level.lstrip("-").isdigit():
+            raise Exception(f"compression level of {item} is not a number (name:level, e.g. zstd:3)")
+         try:
+            frame_type, compress, decompress, default_level = compression_codec(name)
+         except Exception as e:
+            # not installed here, the remaining codecs are used
+            self.debug(type="INFO:init",msg=f"compression {name} skipped: {e}")
+            continue
+         self.compressors[name]=(frame_type,compress,default_level)
+         self.decompressors[frame_type]=decompress
+         self.compression.append((name,int(level) if level != "" else False))
+      if self.transfer_mode not in (0,1,2,3):
+         raise Exception(f"remote transfer mode unknown: {self.transfer_mode}")
+      if self.transfer_mode in (2,3) and len(self.compression) == 0:
+         raise Exception(f"no usable compression in: {compression}")
+      # frames in flight to the compression pool, 1 = compress inline
+      self.compress_threads=compress_threads
+      self.frame_pool=False
+      self.frame_window=1
+      self.pending_frames=collections.deque()
+      self.tuner=False
+      if self.transfer_mode == 3:
+         levels={ "zstd": (1,3,9), "lz4": (0,), "zlib": (1,6) }
+         candidates=[("raw",0)]
+         for name, level in self.compression:
+            candidates+=[ (name,level) ] if level is not False else [ (name,level) for level in levels[name] ]
+         self.tuner=transfer_tuner(candidates=candidates)
 
       # get inputfile, stats and check if exists.
       if inputfile is not False:
@@ -216,6 +1971,13 @@ class FileHasher():
       self.chunk_size=chunk_size
       self.max_chk=math.ceil(self.inputfile_stats.st_size/self.chunk_size)
       self.debug(type="INFO:init",msg="chunk_size["+str(self.chunk_size)+"] max_chk["+str(self.max_chk)+"]")
+      # content defined chunking, chunks between chunk_size and max_chunk_size
+      self.max_chunk_size=max_chunk_size
+      self.chunker=False
+      self.verify_index=False
+      if self.max_chunk_size is not False:
+         self.chunker=cdc_chunker(min_size=self.chunk_size,max_size=self.max_chunk_size)
+         self.debug(type="INFO:init",msg=f"content defined chunks min[{self.chunk_size}] avg[{self.chunker.avg_size}] max[{self.max_chunk_size}]")
 
       if hashfile is False:
          # new
@@ -233,36 +1995,229 @@ class FileHasher():
          # no useful hashes available.
          self.save_hashes=True
          self.loaded_hashes=self.loaded_hash_error
-         self.hash_obj={}
+         self.hash_obj=self._new_table()
       else:
          # useful hashes
          self.loaded_hashes="loaded"
          self.hash_obj=data["hashes"]
+         if data.get("migrated",False) is True:
+            # rewrite in current format
+            self.loaded_hashes="loaded(migrated)"
+            self.save_hashes=True
+
+      # progress of runs which did not end cleanly
+      self.journal=hash_journal(self.hashfile+".journal")
+      replayed=self.journal.replay(self.hash_obj,chunk_size=self.chunk_size,size=self.inputfile_stats.st_size,mtime=self.inputfile_stats.st_mtime,inputfile=self.inputfile_abspath)
+      if replayed > 0:
+         self.debug(type="INFO:init",msg=f"replayed {replayed} journal records")
+         self.loaded_hashes=self.loaded_hashes+" - journal["+str(replayed)+"]"
+         self.save_hashes=True
       
       self.debug(type="INFO:init",msg="Done.")
 
+   def _new_table(self):
+      if self.max_chunk_size is False:
+         return hash_table(chunks=self.max_chk,digest_size=self.digest_size,algorithm=self.hash_algorithm)
+      # number of content defined chunks is not known upfront
+      return hash_table(chunks=0,digest_size=self.digest_size,algorithm=self.hash_algorithm,max_chunk_size=self.max_chunk_size)
+
    def _refresh_inputfile_stats(self):
       self.inputfile_stats = os.stat(self.inputfile)
       self.mtime=self.inputfile_stats.st_mtime
       # print(self.inputfile_stats)
 
-   def _read_one_chunk(self,file_object,*, chunk_size=8192,seek_chunk=-1,lock=True):
+   def chunk_length(self, chunk):
+      return max(0,min(self.chunk_size,self.inputfile_stats.st_size-chunk*self.chunk_size))
+
+   def zero_digest(self, length):
+      digest=self.zero_digests.get(length,False)
+      if digest is False:
+         digest=hash_zeros(self.hash_stream,length)
+         self.zero_digests[length]=digest
+      return digest
+
+   def digest(self, piece):
+      # zero chunks are detected by memcmp, which is a lot cheaper than hashing them.
+      # cheap probes first, real data fails there.
+      start=self.metrics.clock()
+      digest=False
+      if len(piece) > 0 and len(piece) <= 64*1024*1024 and piece[0] == 0 and piece[-1] == 0 and piece[len(piece) >> 1] == 0:
+         if self.zero_chunk is False or len(self.zero_chunk) < len(piece):
+            self.zero_chunk=bytes(max(len(piece),min(self.chunk_size,self.segment_size)))
+         if piece == memoryview(self.zero_chunk)[:len(piece)]:
+            digest=self.zero_digest(len(piece))
+      if digest is False:
+         digest=self.hash_function(piece)
+      self.metrics.add(phase="hash",start=start,bytes_hashed=len(piece),chunks_hashed=1)
+      return digest
+
+   def segmented(self, chunk):
+      # True if the (fixed) chunk is read, hashed and shipped in segments
+      return self.max_chunk_size is False and self.chunk_length(chunk) > self.segment_size
+
+   def digest_range(self, offset, length):
+      # digest of a large chunk, hashed segment by segment - one segment in memory
+      hasher=self.hash_stream()
+      pos=0
+      while pos < length:
+         piece, token = self.reader.read_range(offset+pos,min(self.segment_size,length-pos))
+         if len(piece) == 0:
+            raise Exception("inputfile got shorter while hashing")
+         start=self.metrics.clock()
+         hasher.update(piece)
+         self.metrics.add(phase="hash",start=start,bytes_hashed=len(piece))
+         pos+=len(piece)
+         self.reader.release(token)
+      self.metrics.add(chunks_hashed=1)
+      return hasher.digest()
+
+   def fd_digest(self, fd, offset, length):
+      # digest of a range of an open file (large chunks at the receiver), hashed
+      # segment by segment - one segment in memory
+      hasher=self.hash_stream()
+      pos=0
+      while pos < length:
+         piece=os.pread(fd,min(self.segment_size,length-pos),offset+pos)
+         if len(piece) == 0:
+            break
+         start=self.metrics.clock()
+         hasher.update(piece)
+         self.metrics.add(phase="hash",start=start,bytes_hashed=len(piece))
+         pos+=len(piece)
+      return hasher.digest()
+
+   def copy_range(self, *, source_fd, source_offset, length, target_fd, target_offset, digest=False):
+      # copy of a large chunk segment by segment. with digest the copy is hashed on
+      # the way -> False if it does not match (source changed since it was checked)
+      hasher=self.hash_stream() if digest is not False else False
+      pos=0
+      while pos < length:
+         piece=os.pread(source_fd,min(self.segment_size,length-pos),source_offset+pos)
+         if len(piece) == 0:
+            break
+         if hasher is not False:
+            hasher.update(piece)
+         os.pwrite(target_fd,piece,target_offset+pos)
+         pos+=len(piece)
+      return hasher is False or (pos == length and hasher.digest() == digest)
+
+   def window(self, threads):
+      # in-flight items of a pool, two per thread as long as window_bytes allows
+      return max(2,min(threads*2,self.window_bytes//min(self.chunk_size,self.segment_size)))
+
+   def patch_header(self, *, hash_length):
+      # number of chunks (unused), version, chunk size, max chunk size (0=fixed chunks), length of hash,
+      # hash algorithm, verify algorithm (empty=none), length of stats, stats
+      stats=pickle.dumps(self.inputfile_stats, protocol=pickle.HIGHEST_PROTOCOL)
+      a=0
+      return a.to_bytes(8,'big')+self.patch_file_version_int.to_bytes(8,'big')+self.chunk_size.to_bytes(8,'big') \
+         +(self.max_chunk_size or 0).to_bytes(8,'big')+hash_length.to_bytes(8,'big') \
+         +self.hash_algorithm.encode().ljust(16,b"\0")+(self.verify_algorithm or "").encode().ljust(16,b"\0") \
+         +len(stats).to_bytes(8,'big')+stats
+
+   def read_patch_header(self, patch_data_file):
+      header={}
+      header["chunks"]=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
+      header["version"]=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
+      if header["version"] != self.patch_file_version_int:
+         # rest of the header is not readable
+         raise Exception(f"patch version mismatch {header['version']}/{self.patch_file_version_int}.")
+      header["chunk_size"]=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
+      header["max_chunk_size"]=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
+      header["hash_length"]=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
+      header["algorithm"]=self.read_patch_stream(patch_data_file,16).rstrip(b"\0").decode()
+      header["verify_algorithm"]=self.read_patch_stream(patch_data_file,16).rstrip(b"\0").decode()
+      stats_length=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
+      header["stats"]=pickle.loads(self.read_patch_stream(patch_data_file,stats_length))
+      return header
+
+   def frame_data(self, *, frame_hash_digest, frame_compressed, frame_data_raw, verify_function=False, verify_length=0):
+      # payload of a data frame -> checked chunk data
+      if verify_length > 0:
+         verify_digest=bytes(frame_data_raw[:verify_length])
+         frame_data_raw=frame_data_raw[verify_length:]
+      if frame_compressed == 0:
+         data=frame_data_raw
+      elif frame_compressed in self.decompressors:
+         data=self.decompressors[frame_compressed](frame_data_raw)
+      else:
+         raise Exception(f"Delta Frame with unknown compression type {frame_compressed}")
+      if verify_length > 0 and verify_function(data) != verify_digest:
+         raise Exception("Delta Frame verify digest does not match shipped data.")
+      data_hash=self.digest(data)
+      self.debug(type="INFO:patch",msg=lambda: f"  - digest write[{data_hash.hex()}]")
+      if data_hash != frame_hash_digest:
+         raise Exception("Delta Frame hash does not match shipped data.")
+      return data
 
-      try:
-         if lock is True:
-            self.lock_reading.acquire()
-         if seek_chunk != -1:
-            file_object.seek(seek_chunk*chunk_size)
-         data = file_object.read(chunk_size)
-         if lock is True:
-            self.lock_reading.release()
-         return bytes(data)
-      except:
-         if lock is True:
-            self.lock_reading.release()
-         return False
+   def frame_reference(self, *, frame_hash_digest):
+      # data of a reference frame from the first local file which still has it. chunks
+      # above a segment are only checked here, apply() copies them segment by segment
+      # from the returned (path, offset, length).
+      for path, offset, length in self.local_references.get(frame_hash_digest,[]):
+         try:
+            fd=os.open(path,os.O_RDONLY)
+            try:
+               if length > self.segment_size:
+                  found=(path,offset,length) if self.fd_digest(fd,offset,length) == frame_hash_digest else False
+               else:
+                  data=os.pread(fd,length,offset)
+                  found=data if self.digest(data) == frame_hash_digest else False
+            finally:
+               os.close(fd)
+         except OSError:
+            continue
+         if found is not False:
+            return found
+         self.debug(type="INFO:patch",msg=lambda: f"  - reference {path}[{offset}+{length}] changed")
+      raise Exception(f"Delta Frame references local data {frame_hash_digest.hex()} which is not available anymore.")
+
+   def ship_frame(self, *, chunk, new_hash, data=None, local_delta_file=False, remote_delta=False, zero_length=False, copy_chunk=False, reference=False, move=False, stage=False, segment=False, segmented=False):
+      # data/zero/copy frame to the delta file and/or the remote stream
+      if data is None and zero_length is False and copy_chunk is False and reference is False and move is False and stage is False and segmented is False and self.segmented(chunk):
+         self.ship_segments(chunk=chunk,new_hash=new_hash,local_delta_file=local_delta_file,remote_delta=remote_delta)
+         return
+      if stage is False and segment is False:
+         self.metrics.add(chunks_transferred=1)
+      if local_delta_file is not False:
+         with self.lock_delta_file:
+            # establish file handle for delta file if not done already.
+            if self.local_delta_file_handle is False:
+               self.debug(type="INFO:ship_frame",msg=f"    - write to delta file: {local_delta_file}")
+               self.local_delta_file_handle=open(local_delta_file,"wb")
+               self.local_delta_file_handle.write(self.patch_header(hash_length=len(new_hash)))
+
+         self.send_patch_frame(handle=self.local_delta_file_handle,chunk=chunk,data_of_chunk=data,hash_of_chunk=new_hash,lock=self.lock_delta_file,zero_length=zero_length,copy_chunk=copy_chunk,reference=reference,move=move,stage=stage,segment=segment,segmented=segmented)
 
-   def update_hash_idx(self, *, chunk, new_hash,data=None,local_delta_file=False,remote_delta=False):
+      if remote_delta is not False:
+         self.debug(type="INFO:ship_frame",msg="    - remote_delta: send frame")
+         self.send_patch_frame(handle=sys.stdout.fileno(),chunk=chunk,data_of_chunk=data,hash_of_chunk=new_hash,lock=self.lock_delta_stream,zero_length=zero_length,copy_chunk=copy_chunk,reference=reference,move=move,stage=stage,segment=segment,segmented=segmented)
+
+   def ship_segments(self, *, chunk, new_hash, local_delta_file=False, remote_delta=False):
+      # large chunk: one data frame per segment (digest of the segment, offset in the
+      # chunk), compressed in the frame pool like any other frame, then the end frame
+      # with the digest of the chunk. the chunk is read again here, it must not have
+      # changed since it was hashed.
+      hasher=self.hash_stream()
+      length=self.chunk_length(chunk)
+      pos=0
+      while pos < length:
+         self.pace(min(self.segment_size,length-pos))
+         data, token = self.reader.read_range(chunk*self.chunk_size+pos,min(self.segment_size,length-pos))
+         if len(data) == 0:
+            raise Exception("inputfile got shorter while shipping")
+         start=self.metrics.clock()
+         hasher.update(data)
+         digest=self.hash_function(data)
+         self.metrics.add(phase="hash",start=start)
+         self.ship_frame(chunk=chunk,new_hash=digest,data=data,local_delta_file=local_delta_file,remote_delta=remote_delta,segment=pos)
+         self.reader.release(token)
+         pos+=len(data)
+      if hasher.digest() != new_hash:
+         raise Exception(f"inputfile changed while shipping chunk {chunk}")
+      self.ship_frame(chunk=chunk,new_hash=new_hash,local_delta_file=local_delta_file,remote_delta=remote_delta,segmented=True)
+
+   def update_hash_idx(self, *, chunk, new_hash,data=None,end=False,local_delta_file=False,remote_delta=False):
 
 
       # send header if remote_delta
@@ -272,15 +2227,7 @@ class FileHasher():
             # always locked to be sequential - for the first header.
             if self.remote_delta_header_sent is False:
                self.debug(type="INFO:update_hash_idx",msg=f"    - remote_delta: send header")
-               a=0
-               self.send2stdout(a.to_bytes(8,'big'))                             # number of chunks in file
-               self.send2stdout(self.patch_file_version_int.to_bytes(8,'big'))   # chunk file version
-               self.send2stdout(self.chunk_size.to_bytes(8,'big'))               # chunk_size
-               self.send2stdout(len(bytes.fromhex(new_hash)).to_bytes(8,'big'))  # length of hash
-               stats=pickle.dumps(self.inputfile_stats, protocol=pickle.HIGHEST_PROTOCOL)
-               self.send2stdout(len(stats).to_bytes(8,'big'))                    # length of hash
-               self.send2stdout(stats)                                           # stats.
-
+               self.send2stdout(self.patch_header(hash_length=len(new_hash)))
                self.remote_delta_header_sent=True
 
       # update hash idx
@@ -288,53 +2235,72 @@ class FileHasher():
       old_hash=self.hash_obj.get(chunk,False)
       if old_hash is False or old_hash != new_hash:
          # only add and flag as updated if there is a real change.
-         self.debug(type="INFO:update_hash_idx",msg=f"- update {chunk} [{self.chunk_size*chunk}-{self.chunk_size*(chunk+1)}/{self.inputfile_stats.st_size}] with new[{new_hash}] old[{old_hash}]- length {self.hash_obj.__len__()}")
+         self.debug(type="INFO:update_hash_idx",msg=lambda: f"- update {chunk} [{self.chunk_size*chunk}-{self.chunk_size*(chunk+1)}/{self.inputfile_stats.st_size}] with new[{new_hash.hex()}] old[{old_hash}]- length {self.hash_obj.__len__()}")
          self.lock_update_idx.acquire()
          self.hash_obj[chunk]=new_hash
+         if end is not False:
+            self.hash_obj.set_end(chunk,end)
          self.lock_update_idx.release()
+         if self.patching is False:
+            self.journal.add(chunk,new_hash,end)
          self.save_hashes=True
       else:
-         self.debug(type="INFO:update_hash_idx",msg=f"- same   {chunk} with [{new_hash}]")
+         self.debug(type="INFO:update_hash_idx",msg=lambda: f"- same   {chunk} with [{new_hash.hex()}]")
 
       # verify if so
-      if self.verify_reference is not False:
+      if self.verify_reference is not False and self.max_chunk_size is not False:
+         # content defined chunks are matched by content, not by position.
+         offset, length = self.hash_obj.span(chunk)
+         reference_chunk=self.verify_index.get(new_hash,False)
+         if new_hash == self.zero_digest(length):
+            self.debug(type="INFO:update_hash_idx",msg=lambda: f"  - verify [{offset}+{length}] zero")
+            self.mismatched_idx_hashes[chunk]=new_hash
+            self.ship_frame(chunk=chunk,new_hash=new_hash,local_delta_file=local_delta_file,remote_delta=remote_delta,zero_length=length)
+         elif reference_chunk is not False:
+            # receiver has this content already, somewhere.
+            self.debug(type="INFO:update_hash_idx",msg=lambda: f"  - verify [{offset}+{length}] available as reference chunk[{reference_chunk}]")
+            self.ship_frame(chunk=chunk,new_hash=new_hash,local_delta_file=local_delta_file,remote_delta=remote_delta,copy_chunk=reference_chunk)
+         else:
+            self.debug(type="INFO:update_hash_idx",msg=lambda: f"  - verify [{offset}+{length}] hash[{new_hash.hex()}] - mismatch")
+            self.mismatched_idx_hashes[chunk]=new_hash
+            token=False
+            if data is None and (local_delta_file is not False or remote_delta is not False):
+               data, token = self.reader.read_range(offset,length)
+            self.ship_frame(chunk=chunk,new_hash=new_hash,data=data,local_delta_file=local_delta_file,remote_delta=remote_delta)
+            self.reader.release(token)
+
+      elif self.verify_reference is not False:
          reference_hash=self.verify_reference.get(chunk,False)
          if reference_hash is False or reference_hash != new_hash:
             # mismatch
-            self.debug(type="INFO:update_hash_idx",msg=f"  - verify input hash[{new_hash}] reference hash[{reference_hash}] - mismatch")
+            self.debug(type="INFO:update_hash_idx",msg=lambda: f"  - verify input hash[{new_hash.hex()}] reference hash[{reference_hash}] - mismatch")
             self.mismatched_idx_hashes[chunk]=new_hash
-            if local_delta_file is not False or remote_delta is not False:
-               # get data if needed
-               if data is None:
-                  data=self._read_one_chunk(self.inputfile_handle,chunk_size=self.chunk_size,seek_chunk=chunk,lock=True)
-
-            if local_delta_file is not False:
-               with self.lock_delta_file:
-                  # TODO: if data=none read
-                  # establish file handle for delta file if not done already.
-                  if self.local_delta_file_handle is False:
-                     self.debug(type="INFO:update_hash_idx",msg=f"    - write to delta file: {local_delta_file}")
-                     self.local_delta_file_handle=open(local_delta_file,"wb")
-                     # write header
-                     # current version works with stable chunks sizes, future adaptive chunks would reduce transfer size.
-                     # write header
-                     a=0
-                     self.local_delta_file_handle.write(a.to_bytes(8,'big'))                             # number of chunks in file
-                     self.local_delta_file_handle.write(self.patch_file_version_int.to_bytes(8,'big'))   # chunk file version
-                     self.local_delta_file_handle.write(self.chunk_size.to_bytes(8,'big'))               # chunk_size
-                     self.local_delta_file_handle.write(len(bytes.fromhex(new_hash)).to_bytes(8,'big'))  # length of hash
-                     stats=pickle.dumps(self.inputfile_stats, protocol=pickle.HIGHEST_PROTOCOL)
-                     self.local_delta_file_handle.write(len(stats).to_bytes(8,'big'))                    # length of hash
-                     self.local_delta_file_handle.write(stats)                                           # stats.
-                                          
-                  # write to delta to handle
-               
-               self.send_patch_frame(handle=self.local_delta_file_handle,chunk=chunk,data_of_chunk=data,hash_of_chunk=new_hash,lock=self.lock_delta_file)
-
-            if remote_delta is not False:
-
-               self.debug(type="INFO:update_hash_idx",msg=f"    - remote_delta: send frame")
-               self.send_patch_frame(handle=sys.stdout.fileno(),chunk=chunk,data_of_chunk=data,hash_of_chunk=new_hash,lock=self.lock_delta_stream)
+            token=False
+            zero_length=False
+            move=False
+            if new_hash == self.zero_digest(self.chunk_length(chunk)):
+               # zero chunk, no data to read or ship
+               zero_length=self.chunk_length(chunk)
+            elif local_delta_file is not False or remote_delta is not False:
+               if self.relocation is not False:
+                  move=self.relocation.source(chunk,new_hash)
+               # get data if needed, large chunks are read segment by segment when shipped
+               if data is None and move is False and self.segmented(chunk) is False:
+                  self.pace(self.chunk_length(chunk))
+                  data, token = self.reader.read(chunk)
+
+            if self.relocation is not False:
+               if self.relocation.needs_stage(chunk):
+                  # old content is the source of a later chunk
+                  self.debug(type="INFO:update_hash_idx",msg=lambda: f"  - stage [{chunk}] before it is written")
+                  self.ship_frame(chunk=chunk,new_hash=reference_hash,local_delta_file=local_delta_file,remote_delta=remote_delta,stage=True)
+                  self.relocation.stage(chunk)
+               self.relocation.write(chunk,new_hash if zero_length is False else False)
+            if move is not False:
+               self.debug(type="INFO:update_hash_idx",msg=lambda: f"  - moved from [{move[0]}] staged[{move[1]}]")
+               data=None
+            self.ship_frame(chunk=chunk,new_hash=new_hash,data=data,local_delta_file=local_delta_file,remote_delta=remote_delta,zero_length=zero_length,move=move)
+            self.reader.release(token)
 
          else:
             #self.debug(type="INFO:update_hash_idx",msg=f"  - verify input hash[{new_hash}] reference hash[{reference_hash}] - match")
@@ -343,41 +2309,40 @@ class FileHasher():
             pass
 
    def send2stdout(self,data):
-      os.write(sys.stdout.fileno(), data)
+      # os.write may write partially on pipes, continue with the remaining view.
+      data=memoryview(data)
+      while len(data) > 0:
+         written=os.write(self.stream_out, data)
+         data=data[written:]
       #sys.stdout.buffer.write(data)
       
 
-   def hash_thread(self, *, cpu=-1,Read_file=False, local_delta_file=False,remote_delta=False):
-
-      self.debug(type="INFO:hash_thread",msg=f"- hashing thread cpu[{cpu}] - start")
-
-      with open(self.inputfile,"rb") as f:
-         while self.active is True or len(self.chunk_buffer[cpu]) > 0:
-            # process buffer
-            for chunk in list(self.chunk_buffer[cpu]):
-               #print(f"- processing cpu[{cpu}] chunk[{chunk}]")
-               if Read_file is True:
-                  self.debug(type="INFO:hash_thread",msg=f"- reading cpu[{cpu}] chunk[{chunk}] length[{len(self.chunk_buffer[cpu])}]")
-                  s_time=time.time_ns()
-                  piece=self._read_one_chunk(f,chunk_size=self.chunk_size,seek_chunk=chunk,lock=False)
-                  self.time_avg_ns_read[cpu]=((time.time_ns()-s_time) + self.time_avg_ns_read[cpu]) / 2
-
-               else:
-                  self.debug(type="INFO:hash_thread",msg=f"- processing cpu[{cpu}] chunk[{chunk}] length[{len(self.chunk_buffer[cpu])}]")
-                  piece=self.chunk_buffer[cpu].get(chunk,False)
-
-               if piece is not False:
-                  del self.chunk_buffer[cpu][chunk]
-                  data=hashlib.sha256(piece)
-                  self.update_hash_idx(chunk=chunk,new_hash=data.hexdigest(),data=piece,local_delta_file=local_delta_file,remote_delta=remote_delta)
-               else:
-                  raise Exception("hash_thread: i should handle data, but i have none? confusing.")
-
-            time.sleep(0.001)
-
-      self.debug(type="INFO:hash_thread",msg=f"- hashing thread cpu[{cpu}] - end")
+   def hash_chunk(self, *, chunk, piece=None, token=False):
+      # worker part of thread-mode 1/2, os.pread(v) and hashlib release the GIL
+      # so the workers really run in parallel.
+      if piece is None and self.segmented(chunk):
+         return None, self.digest_range(chunk*self.chunk_size,self.chunk_length(chunk)), False
+      if piece is None:
+         piece, token = self.reader.read(chunk)
+      return piece, self.digest(piece), token
+
+   def _finish_pending(self, item, *, read_speed, local_delta_file=False, remote_delta=False):
+      # consumer part of thread-mode 1/2, always called in chunk order.
+      chunk, job, old_data = item
+      if job is False:
+         # already hashed, only verify
+         self.update_hash_idx(chunk=chunk,new_hash=old_data,local_delta_file=local_delta_file,remote_delta=remote_delta)
+         return
+      try:
+         data_chunk, data_hash, token = job.result()
+         self.update_hash_idx(chunk=chunk,new_hash=data_hash,data=data_chunk,local_delta_file=local_delta_file,remote_delta=remote_delta)
+         self.reader.release(token)
+         if self.remote_delta_mode is False:
+            read_speed.update_run(self.chunk_size)
+      except:
+         self.debug(type="INFO:hash_file",msg=f"  - chunk[{chunk}] failed -> exception")
 
-   def hash_file(self, *, incremental=True,threading_mode=0,verify_hash_file=False,local_delta_file=False,remote_delta=False):
+   def hash_file(self, *, incremental=True,threading_mode=0,threads=0,verify_hash_file=False,local_delta_file=False,remote_delta=False,quiet=False):
       # update stats
       self._refresh_inputfile_stats()
       # defaults for def handshake
@@ -391,7 +2356,8 @@ class FileHasher():
       self.count_compressed_frames=0
       self.count_uncompressed_frames=0
       self.remote_delta_header_sent=False
-      if remote_delta is False:
+      self.hash_stopped=False
+      if remote_delta is False and quiet is False:
          self.remote_delta_mode=False
       else:
          self.remote_delta_mode=True
@@ -400,298 +2366,457 @@ class FileHasher():
 
       # TODO: Revisit incremental with the new index missing scheme.
       if incremental is False:
-         self.hash_obj={}
+         self.hash_obj=self._new_table()
+         self.journal.restart()
       # load hash to verify against if given
       if verify_hash_file is not False:
          self.debug(type="INFO:hash_file",msg=f"- verify reference: {verify_hash_file}")
          loaded=self.load_hash(hashfile=verify_hash_file,extended_tests=False)
          if loaded is not False:
             self.verify_reference=loaded["hashes"]
+            if self.max_chunk_size is not False:
+               # digest -> chunk of the reference, for matching by content
+               self.verify_index={ digest: chunk for chunk, digest in self.verify_reference.items() }
+            elif self.verify_algorithm is False and (local_delta_file is not False or remote_delta is not False):
+               # chunks moved within the file are copied by the receiver (not with a
+               # detection only hash, two-tier)
+               self.relocation=relocation_plan(reference=self.verify_reference,table=self.hash_obj)
          else:
             raise Exception("unable to load verification hashes")
          # TODO: conclude how to change this into a full compare, but incremental updating
          #incremental=False
       else:
          self.verify_reference=False
+         self.relocation=False
 
       # hash
 
       self.chk=int(0)
-      with open(self.inputfile,"rb") as f:
-         # make this a obj attribute
-         self.inputfile_handle=f
-
+      self.reader=chunk_reader(filename=self.inputfile,chunk_size=self.max_chunk_size or self.chunk_size,read_mode=self.read_mode,io_mode=self.io_mode,readahead=self.readahead,metrics=self.metrics,segment_size=self.segment_size if self.max_chunk_size is False else False)
+      # also on errors: the agent and --queue reuse the FileHasher
+      try:
          if incremental is True:
             self.chk=len(self.hash_obj)-1
             if self.chk < 0:
                self.chk=0
             self.debug(type="INFO:hash_file",msg=f"- Incremental starting with chunk {self.chk}")
             self.loaded_hashes=self.loaded_hashes+" - inc["+str(self.chk)+"-"+str(self.max_chk-1)+"]"
-            f.seek(self.chk*self.chunk_size)
          else:
             self.debug(type="INFO:hash_file",msg="- Full...")
-            f.seek(0)
 
          read_speed=speed(max_size=self.inputfile_stats.st_size,start_chunk=self.chk)
 
          self.debug(type="INFO:hash_file",msg="- Threading mode: "+str(threading_mode))
 
-         if threading_mode == 0:
+         if self.max_chunk_size is not False:
+            # boundaries depend on the previous one, no threading here.
+            self._hash_file_cdc(verify_hash_file=verify_hash_file,read_speed=read_speed,local_delta_file=local_delta_file,remote_delta=remote_delta)
+
+         elif threading_mode == 0:
             # non-threading mode
 
             for chunk in range(0,self.max_chk):
                old_data=self.hash_obj.get(chunk,False)
                if old_data is False:
                   # missing hash
-                  self.debug(type="INFO:hash_file",msg=f"- missing chunk[{chunk}]")
+                  if self.out_of_time():
+                     break
+                  self.debug(type="INFO:hash_file",msg=lambda: f"- missing chunk[{chunk}]")
                   try:
-                     data_chunk=self._read_one_chunk(f,chunk_size=self.chunk_size,seek_chunk=chunk)
-                     data_hash=hashlib.sha256(data_chunk)
-                     self.update_hash_idx(chunk=chunk,new_hash=data_hash.hexdigest(),data=data_chunk,local_delta_file=local_delta_file,remote_delta=remote_delta)
+                     if self.reader.is_hole(chunk,self.chunk_length(chunk)):
+                        # sparse region, no io
+                        self.metrics.add(chunks_skipped=1)
+                        data_chunk, token, data_hash = None, False, self.zero_digest(self.chunk_length(chunk))
+                     elif self.segmented(chunk):
+                        self.pace(self.chunk_length(chunk))
+                        data_chunk, token, data_hash = None, False, self.digest_range(chunk*self.chunk_size,self.chunk_length(chunk))
+                     else:
+                        self.pace(self.chunk_length(chunk))
+                        data_chunk, token = self.reader.read(chunk)
+                        data_hash=self.digest(data_chunk)
+                     self.update_hash_idx(chunk=chunk,new_hash=data_hash,data=data_chunk,local_delta_file=local_delta_file,remote_delta=remote_delta)
+                     self.reader.release(token)
                      if self.remote_delta_mode is False:
                         read_speed.update_run(self.chunk_size)
                   except:
                      self.debug(type="INFO:hash_file",msg="  - failed -> exception")
                      pass
                elif verify_hash_file is not False:
+                  self.metrics.add(chunks_skipped=1)
                   self.update_hash_idx(chunk=chunk,new_hash=old_data,local_delta_file=local_delta_file,remote_delta=remote_delta)
                else:
                   #self.debug(type="INFO:hash_file",msg=f"- already chunk[{chunk}] = {self.hash_obj[chunk]}")
-                  pass
+                  self.metrics.add(chunks_skipped=1)
 
          elif threading_mode == 1 or threading_mode == 2:
-            # 1 = read+hash, 2 = hash
-
-            # BROKEN-doest not build all chunks.
-
-            self.chunk_buffer={}
-            self.thread={}
-            self.active=True
-
-            max_cpu_count=multiprocessing.cpu_count()
-            cpu_count=max_cpu_count
-
-            self.time_avg_ns_read={}
-            self.time_avg_ns_hash={}
-            for cpu in range(0,cpu_count):
-               self.chunk_buffer[cpu]={}
-               self.time_avg_ns_read[cpu]=0
-               self.time_avg_ns_hash[cpu]=0
-               if threading_mode == 1:
-                  self.thread[cpu]=threading.Thread(target=self.hash_thread,kwargs={"cpu":cpu, "Read_file":True, "local_delta_file": local_delta_file, "remote_delta": remote_delta })
-               else:
-                  self.thread[cpu]=threading.Thread(target=self.hash_thread,kwargs={"cpu":cpu, "Read_file":False, "local_delta_file": local_delta_file, "remote_delta": remote_delta })
-               self.thread[cpu].start()
-
-            next_cpu=0
-            target_bw_s=10*1024*1024*1024 #  10GiB/s
-            chunks_per_s=target_bw_s / self.chunk_size
-            time_per_chunk=1/chunks_per_s
-            self.debug(type="INFO:hash_file",msg=f"- time per chunk at target bw: {time_per_chunk} sec")
-            # purely artificially chosen limits, a little bit tuned while development.
-            max_queue_length=32
-            min_queue_length=8
-            # default sensor values
-            immune_count=0
-            sensor=cpu_count
-            self.chunk_buffer[sensor]=[]
-            # chunk cycling.
-            for chunk in range(0,self.max_chk):
-
-               old_data=self.hash_obj.get(chunk,False)
-               if old_data is False:
-
-                  self.debug(type="INFO:hash_file",msg=f"- missing chunk[{chunk}]")
-
-                  # wait a glimpse of time to not overload unneeded the system.
-                  time.sleep(time_per_chunk/cpu_count) # keep back to not overload queues
-
-                  # missing hash - guidance or data for threads
-                  if threading_mode == 1:
-                     self.chunk_buffer[next_cpu][chunk]=True
-                     # if queue length is over the limit then reduce the active filled threads
-                  else:
-                     s_time=time.time_ns()
-                     self.chunk_buffer[next_cpu][chunk]=self._read_one_chunk(f,chunk_size=self.chunk_size,seek_chunk=chunk)
-                     self.time_avg_ns_read[next_cpu]=((time.time_ns()-s_time) + self.time_avg_ns_read[next_cpu]) / 2
-
-                  # eval on performance and tune
-                  # idea:
-                  # - if queue length is max then the system (io or/and cpu) is too slow.
-                  #   - therefore reduce pressure by increasing time_per_chunk 
-                  # - if read times are too spread the io system is overloaded
-                  #   - reduce threads.
-
-                  
-                  # - get max queue length
-                  current_min_queue_length=False
-                  current_max_queue_length=0
-                  current_avg_read=False
-                  current_min_avg_read=False
-                  current_max_avg_read=0
-                  # understand if the avg time to read of a cpu is higher than the avg_read time
-                  for cpu in range(0,cpu_count):
-                     # get avg read
-                     avg_read=self.time_avg_ns_read[cpu]
-                     if current_avg_read is False:
-                        current_avg_read=avg_read
+            # 1 = read+hash in worker threads, 2 = read here + hash in worker threads
+            # results are consumed in chunk order, so update_hash_idx (and with it the
+            # delta file/stream) sees exactly the same sequence as in threading mode 0.
+
+            if threads == 0:
+               threads=multiprocessing.cpu_count()
+            # in-flight window, bounds memory to window * min(chunk size, segment size)
+            window=self.window(threads)
+            self.debug(type="INFO:hash_file",msg=f"- worker threads[{threads}] window[{window}]")
+
+            pending=collections.deque()
+            if self.shared_pool is not False:
+               self.pool=self.shared_pool
+            else:
+               self.pool=concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+            try:
+               for chunk in range(0,self.max_chk):
+                  old_data=self.hash_obj.get(chunk,False)
+                  if old_data is False:
+                     if self.out_of_time():
+                        break
+                     self.debug(type="INFO:hash_file",msg=lambda: f"- missing chunk[{chunk}]")
+                     if self.reader.is_hole(chunk,self.chunk_length(chunk)):
+                        # sparse region, no io - handled like an already known hash
+                        self.metrics.add(chunks_skipped=1)
+                        pending.append((chunk,False,self.zero_digest(self.chunk_length(chunk))))
+                     elif threading_mode == 1 or self.segmented(chunk):
+                        # large chunks are read by the worker, segment by segment
+                        self.pace(self.chunk_length(chunk))
+                        pending.append((chunk,self.pool.submit(self.hash_chunk,chunk=chunk),False))
                      else:
-                        current_avg_read=(avg_read + current_avg_read ) /2
-                     # get min and max
-                     if avg_read > current_max_avg_read:
-                        current_max_avg_read=avg_read
-                     if avg_read < current_min_avg_read or current_min_avg_read is False:
-                        current_min_avg_read=avg_read
-                     # get queue length
-                     queue_length=len(self.chunk_buffer[cpu])
-                     if queue_length > current_max_queue_length:
-                        current_max_queue_length=queue_length
-                     if queue_length < min_queue_length or current_min_queue_length is False:
-                        # the cpu with the smallest queue wins the next task
-                        current_min_queue_length=queue_length
-                        next_cpu=cpu
-                  if current_min_avg_read == 0:
-                     current_min_avg_read=0
-                     avg_read_spread=1
+                        self.pace(self.chunk_length(chunk))
+                        piece, token = self.reader.read(chunk)
+                        pending.append((chunk,self.pool.submit(self.hash_chunk,chunk=chunk,piece=piece,token=token),False))
+                  elif verify_hash_file is not False:
+                     self.metrics.add(chunks_skipped=1)
+                     pending.append((chunk,False,old_data))
                   else:
-                     avg_read_spread=current_max_avg_read/current_min_avg_read
-                  #debug#print(f"- cpu[{cpu_count:>2}] queue_length: {current_min_queue_length:>2}-{current_max_queue_length:>2} -- read [{current_min_avg_read:>12.2f}/{current_max_avg_read:>12.2f}:{avg_read_spread:>3.1f}] -- {time_per_chunk:>12f} sec - read[{current_avg_read:>12.2f}]\r",end="")
-
-                  # if time_per_chunk is too small the chunk size is too small or the machine too fast.
-                  if time_per_chunk < current_avg_read/1e9 and current_min_queue_length > min_queue_length:
-                     #debug#print("- limit chunk time to avg read")
-                     time_per_chunk=current_avg_read/1e9
-
-                  # - correction of chunk time - we fill the cpu queue faster than processing.
-                  if current_max_queue_length >= max_queue_length:
-                     # not larger than 250 ms
-                     time.sleep(time_per_chunk) # do extra wait.
-                     # correct
-                     if time_per_chunk < 0.250:
-                        time_per_chunk=time_per_chunk*1.1
-                        ##print(f"- new time per chunk: {time_per_chunk} sec (increasing)")
-                     else:
-                        time_per_chunk=0.250
-
-                  elif current_min_queue_length < min_queue_length and immune_count == 0:
-                     # queue becomes smaller than the min limit, we can put more load in the queue.
-                     time_per_chunk=time_per_chunk*0.9
-                     ##print(f"- new time per chunk: {time_per_chunk} sec (decreasing)")
-#                     if cpu_count < max_cpu_count:
-#                        max_queue_length=max_queue_length*1.1
-#                        #min_queue_length=max_queue_length
-#                        print("- adding active queues...")
-#                        cpu_count=cpu_count+1
-#                        immune_count=int(2*max_queue_length)
-
-                  elif avg_read_spread > 2 and len(self.chunk_buffer[sensor]) == 0:
-                     # if time becomes to high, the io-system is to slow, therefore reduce threads                     
-                     sensor=cpu_count-1
-                     if cpu_count > 1:
-                        if avg_read_spread > 20:
-                           # drop dramatic if spread is too high
-                           cpu_count=int(cpu_count/2)
-                        else:
-                           # proceed slowly to lower threads.
-                           cpu_count=cpu_count-1
-                        # mark active +1 one as sensor cpu for the queue overload 
-                        # so self.chunk_buffer[sensor] is 0,(cpu_count-1), therefore cpu_count is the first in the old segment.
-                        sensor=cpu_count
-
-#                     print(f"- cut down threads: {cpu_count}")
-                  elif avg_read_spread < 1.5:
-                     # ok so add more active threads, if not already all involved
-                     if cpu_count < max_cpu_count:
-                        cpu_count=cpu_count+1
-                        sensor=cpu_count
-
-                  #print(f"- sensor: {cpu_count}/{sensor} {len(self.chunk_buffer[sensor])}")
-
-                  if immune_count > 0:
-                     # decrease the immune count, out-dated, as sensor is used now
-                     immune_count=immune_count-1
-
-                  if self.remote_delta_mode is False:
-                     read_speed.update_run(self.chunk_size)
-
-               elif verify_hash_file is not False:
-                  self.update_hash_idx(chunk=chunk,new_hash=old_data,local_delta_file=local_delta_file)
-
+                     self.metrics.add(chunks_skipped=1)
+                     continue
+
+                  # hand over finished chunks in order
+                  while len(pending) > 0 and (len(pending) >= window or pending[0][1] is False or pending[0][1].done()):
+                     self._finish_pending(pending.popleft(),read_speed=read_speed,local_delta_file=local_delta_file,remote_delta=remote_delta)
+
+               while len(pending) > 0:
+                  self._finish_pending(pending.popleft(),read_speed=read_speed,local_delta_file=local_delta_file,remote_delta=remote_delta)
+            finally:
+               if self.pool is self.shared_pool:
+                  # other files go on with the pool, just drop what is left of this one
+                  for item in pending:
+                     if item[1] is not False:
+                        item[1].cancel()
+                  concurrent.futures.wait([ item[1] for item in pending if item[1] is not False ])
                else:
-                  #self.debug(type="INFO:hash_file",msg=f"- already chunk[{chunk}] = {self.hash_obj[chunk]}")
-                  pass
+                  self.pool.shutdown(wait=True,cancel_futures=True)
+               self.pool=False
 
-            self.active=False
-
-            for cpu in range(0,multiprocessing.cpu_count()):
-               self.thread[cpu].join()
-            
          else:
             raise Exception("threading mode unknown")
-            
-      if self.remote_delta_mode is True:
-         self.send_patch_frame(handle=sys.stdout.fileno(),chunk=0,data_of_chunk=b'',hash_of_chunk=hashlib.sha256(b'').hexdigest(),lock=self.lock_delta_stream,eof=True)
+
+      finally:
+         self.reader.close()
+      io_report=self.reader.report()
+
+      if remote_delta is not False:
+         self.send_patch_frame(handle=sys.stdout.fileno(),chunk=0,data_of_chunk=b'',hash_of_chunk=bytes(self.digest_size),lock=self.lock_delta_stream,eof=True)
+
+      if self.local_delta_file_handle is not False:
+         # content defined patches are only applied if the end frame was seen.
+         self.send_patch_frame(handle=self.local_delta_file_handle,chunk=0,data_of_chunk=b'',hash_of_chunk=bytes(self.digest_size),lock=self.lock_delta_file,eof=True)
+         self.local_delta_file_handle.close()
+         self.local_delta_file_handle=False
 
       if self.remote_delta_mode is False:
          print(f"\33[2K\r",end='\r')
+         if self.io_mode != 0:
+            print(f"- {io_report}")
          print(len(self.mismatched_idx_hashes.keys()))
 
-   def send_patch_frame(self, *, handle=False,chunk=-1,hash_of_chunk=False,data_of_chunk=False,lock=False,eof=False):
-
-      if handle is not False and hash_of_chunk is not False and data_of_chunk is not False and chunk != -1 and lock is not False:
-         self.debug(type="INFO:send_patch_frame",msg=f"...send patch frame for chunk[{chunk}] data[{len(data_of_chunk)}]")
-
-         if len(data_of_chunk) > 0:
-            if (self.count_compressed_frames+self.count_uncompressed_frames) > 10 and (self.count_compressed_frames/(self.count_compressed_frames+self.count_uncompressed_frames)) < 0.1:
-               # > 10 frames processed but less than 10% compressed -> turn compression off.
-               compression_off=True
+   def _hash_file_cdc(self, *, verify_hash_file=False, read_speed, local_delta_file=False, remote_delta=False):
+      size=self.inputfile_stats.st_size
+      chunk=0
+      offset=0
+      # known chunks, boundaries come from the hashfile.
+      while offset < size:
+         old_data=self.hash_obj.get(chunk,False)
+         if old_data is False:
+            break
+         start, length = self.hash_obj.span(chunk)
+         if verify_hash_file is not False:
+            self.update_hash_idx(chunk=chunk,new_hash=old_data,end=start+length,local_delta_file=local_delta_file,remote_delta=remote_delta)
+         offset=start+length
+         chunk+=1
+      self.metrics.add(chunks_skipped=chunk)
+
+      self.debug(type="INFO:hash_file",msg=f"- content defined chunks from chunk[{chunk}] offset[{offset}]")
+      # rest of the file, read in blocks of several max chunks.
+      block=max(self.max_chunk_size*4,8*1024*1024)
+      window=b''
+      bits=b''
+      window_offset=offset
+      while offset < size:
+         if self.out_of_time():
+            break
+         limit=min(self.max_chunk_size,size-offset)
+         if self.reader.is_hole_range(offset,limit):
+            # zeros never match the boundary pattern, the chunk is max size.
+            self.metrics.add(chunks_skipped=1)
+            length=limit
+            data=None
+            data_hash=self.zero_digest(length)
+            window=b''
+            window_offset=offset+length
+         else:
+            pos=offset-window_offset
+            if pos+limit > len(window):
+               # keep the not consumed tail, translate once per block.
+               self.pace(block)
+               if self.reader.io_mode == 1:
+                  self.reader.advise(offset+len(window)-pos,block)
+               start=self.metrics.clock()
+               fresh=os.pread(self.reader.fd,block,offset+len(window)-pos)
+               self.metrics.add(phase="read",start=start,bytes_read=len(fresh))
+               window=window[pos:]+fresh
+               bits=self.chunker.bits(window)
+               window_offset=offset
+               pos=0
+            length=self.chunker.cut(bits,pos,min(len(window),size-window_offset))
+            if length <= 0:
+               raise Exception("inputfile got shorter while hashing")
+            data=memoryview(window)[pos:pos+length]
+            data_hash=self.digest(data)
+         self.debug(type="INFO:hash_file",msg=lambda: f"- chunk[{chunk}] offset[{offset}] length[{length}]")
+         self.update_hash_idx(chunk=chunk,new_hash=data_hash,data=data,end=offset+length,local_delta_file=local_delta_file,remote_delta=remote_delta)
+         if self.remote_delta_mode is False:
+            read_speed.update_run(self.chunker.avg_size)
+         offset+=length
+         chunk+=1
+
+   def spot_check(self, *, sample, candidates=4):
+      # hashes a sample of the chunks and compares it with the hashfile. sample: number
+      # of chunks or "P%". one chunk per stratum of the file, of some random candidates
+      # the one verified longest ago (never/patched first). -> report dict
+      if not self.loaded_hashes.startswith("loaded") or len(self.hash_obj) == 0:
+         raise Exception(f"no hashes of this file state to check against ({self.loaded_hashes})")
+      chunks=len(self.hash_obj) if self.max_chunk_size is not False else self.max_chk
+      if str(sample).endswith("%"):
+         count=math.ceil(chunks*float(sample[:-1])/100)
+      else:
+         count=int(sample)
+      count=max(1,min(count,chunks))
+      if self.verified is False:
+         self.verified=verify_record(self.hashfile+".verified",chunks=chunks,chunk_size=self.chunk_size,stats=self.inputfile_stats)
+      times=self.verified.times
+      now=int(time.time())
+
+      picks=[]
+      for stratum in range(0,count):
+         first=stratum*chunks//count
+         last=max((stratum+1)*chunks//count,first+1)
+         picks.append(min(random.sample(range(first,last),min(candidates,last-first)),key=lambda chunk: times[chunk]))
+
+      report={ "inputfile": self.inputfile, "chunks": chunks, "sampled": 0, "mismatched": [], "unhashed": 0 }
+      self.reader=chunk_reader(filename=self.inputfile,chunk_size=self.max_chunk_size or self.chunk_size,read_mode=self.read_mode,io_mode=self.io_mode,readahead=self.readahead,metrics=self.metrics,segment_size=self.segment_size if self.max_chunk_size is False else False)
+      try:
+         for chunk in picks:
+            stored=self.hash_obj.get(chunk,False)
+            if stored is False:
+               # hashing of the file not complete
+               report["unhashed"]+=1
+               continue
+            if self.max_chunk_size is not False:
+               offset, length = self.hash_obj.span(chunk)
             else:
-               compression_off=False
-
-            data_compressed=b''
-            if compression_off is False:
-               data_compressed=zlib.compress(data_of_chunk)
-            if len(data_compressed) < len(data_of_chunk)*0.9 and compression_off is False:
-               self.debug(type="INFO:send_patch_frame",msg=f"   - compressed [zlib]")
-               compressed=1
-               self.count_compressed_frames+=1
-               data_to_write=data_compressed
+               offset, length = chunk*self.chunk_size, self.chunk_length(chunk)
+            self.pace(length)
+            if self.segmented(chunk):
+               digest=self.digest_range(offset,length)
             else:
-               self.debug(type="INFO:send_patch_frame",msg=f"   - uncompressed")
-               self.count_uncompressed_frames+=1
-               compressed=0
-               data_to_write=data_of_chunk
-         elif eof is False:
-            # progress chunk
-            compressed=2
-            data_to_write=b''
-         else:
-            # end chunk
-            compressed=3
-            data_to_write=b''
-         
-         data_length=len(data_to_write)
-         self.debug(type="INFO:send_patch_frame",msg=f"   - frame length {data_length}")
-
-         # DONE: conclude how to store
-         # https://stackoverflow.com/questions/7856196/how-to-translate-from-a-hexdigest-to-a-digest-and-vice-versa
-         # h.digest().hex()
-         # bytes.fromhex(h.hexdigest())
-#         with lock:
-#            handle.write(chunk.to_bytes(8,'big'))              # chunk number
-#            handle.write(bytes.fromhex(hash_of_chunk))         # hash
-#            handle.write(compressed.to_bytes(1,'big'))         # compressed ? 0=no, 1=zlib
-#            handle.write(data_length.to_bytes(8,'big'))        # data_frame length
-#            handle.write(data_to_write)                        # data
-
-         data_raw=chunk.to_bytes(8,'big')+bytes.fromhex(hash_of_chunk)+compressed.to_bytes(1,'big')+data_length.to_bytes(8,'big')+data_to_write
-         # TODO: conclude if lock is needed, write is most likely thread safe.
-         #with lock:
+               data, token = self.reader.read_range(offset,length)
+               digest=self.digest(data)
+               self.reader.release(token)
+            report["sampled"]+=1
+            if digest == stored:
+               times[chunk]=now
+            else:
+               print(f"- chunk {chunk} [{offset}+{length}] does not match the hashfile")
+               report["mismatched"].append(chunk)
+               times[chunk]=0
+      finally:
+         self.reader.close()
+      self.verified.save(self.inputfile_stats)
+
+      # no mismatch in n random chunks: with 95% confidence less than 1-0.05^(1/n)
+      # of the chunks differ (~3/n)
+      sampled=max(report["sampled"],1)
+      if len(report["mismatched"]) == 0:
+         report["bad_fraction_95"]=round(1-0.05**(1/sampled),6)
+      else:
+         report["bad_fraction"]=round(len(report["mismatched"])/sampled,6)
+      report["verified_30d"]=round(sum(1 for stamp in times if stamp > now-30*86400)/chunks,6)
+      report["never_verified"]=times.count(0)
+      return report
 
-         if self.remote_delta_mode is False:
-            handle.write(data_raw)
+   def send_patch_frame(self, *, handle=False,chunk=-1,hash_of_chunk=False,data_of_chunk=False,lock=False,eof=False,zero_length=False,copy_chunk=False,reference=False,move=False,stage=False,pause=False,segment=False,segmented=False):
+
+      if reference is True or move is not False or stage is True or segmented is True:
+         data_of_chunk=b''
+      if handle is not False and hash_of_chunk is not False and data_of_chunk is not False and chunk != -1 and lock is not False:
+         self.debug(type="INFO:send_patch_frame",msg=lambda: f"...send patch frame for chunk[{chunk}] data[{'zero' if zero_length is not False else 'copy' if copy_chunk is not False else len(data_of_chunk)}]")
+
+         if copy_chunk is False and zero_length is False and len(data_of_chunk) > 0 and self.compress_threads != 1:
+            # data frames are compressed in the pool, the hashing thread goes on.
+            if self.frame_pool is False:
+               threads=self.compress_threads or multiprocessing.cpu_count()
+               self.frame_window=self.window(threads)
+               self.frame_pool=concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+               self.debug(type="INFO:send_patch_frame",msg=f"- compression threads[{threads}] window[{self.frame_window}]")
+            if self.reader is not False and self.reader.reused(data_of_chunk):
+               # reused read buffers (read mode 1, io mode 2) are handed back before the frame is built
+               data_of_chunk=bytes(data_of_chunk)
+            frame=self.frame_pool.submit(self.build_patch_frame,chunk=chunk,hash_of_chunk=hash_of_chunk,data_of_chunk=data_of_chunk,segment=segment)
          else:
-            self.send2stdout(data=data_raw)
+            frame=self.build_patch_frame(chunk=chunk,hash_of_chunk=hash_of_chunk,data_of_chunk=data_of_chunk,eof=eof,zero_length=zero_length,copy_chunk=copy_chunk,reference=reference,move=move,stage=stage,pause=pause,segment=segment,segmented=segmented)
+         # frames leave in the order they were sent, whatever finishes first.
+         self.pending_frames.append((handle,lock,frame))
+         self.write_frames(final=eof)
+
+   def write_frames(self, *, final=False):
+      # writes finished frames from the head of the queue, waits for the head if the
+      # window is full (bounds memory) or all frames are needed (end of stream).
+      while len(self.pending_frames) > 0:
+         handle, lock, frame = self.pending_frames[0]
+         if isinstance(frame,concurrent.futures.Future):
+            if final is False and len(self.pending_frames) < self.frame_window and frame.done() is False:
+               break
+            frame=frame.result()
+         self.pending_frames.popleft()
+         frame_header, data_to_write = frame
+         # frames of concurrent writers must not interleave.
+         with lock:
+            start=self.metrics.clock()
+            if self.remote_delta_mode is False:
+               handle.write(frame_header)
+               handle.write(data_to_write)
+               self.metrics.add(phase="write",start=start,bytes_written=len(frame_header)+len(data_to_write))
+            else:
+               self.send2stdout(data=frame_header)
+               self.send2stdout(data=data_to_write)
+               self.metrics.add(phase="network",start=start,bytes_sent=len(frame_header)+len(data_to_write))
+            self.bytes_sent+=len(frame_header)+len(data_to_write)
+            if self.tuner is not False:
+               self.tuner.update_link(len(frame_header)+len(data_to_write),self.metrics.elapsed(start))
+      if final is True and self.frame_pool is not False:
+         self.frame_pool.shutdown(wait=True)
+         self.frame_pool=False
+
+   def build_patch_frame(self, *, chunk, hash_of_chunk, data_of_chunk, eof=False, zero_length=False, copy_chunk=False, reference=False, move=False, stage=False, pause=False, segment=False, segmented=False):
+      # -> (frame header, payload), runs in the compression pool for data frames
+      if segmented is True:
+         # all segments of the chunk are shipped, digest of the whole chunk
+         self.debug(type="INFO:send_patch_frame",msg="   - end of segments")
+         compressed=13
+         data_to_write=b''
+      elif pause is True:
+         # end of a stream which is continued at chunk next time (budget)
+         self.debug(type="INFO:send_patch_frame",msg="   - pause")
+         compressed=11
+         data_to_write=b''
+      elif stage is True:
+         # receiver keeps the current content of chunk (digest: reference) aside
+         self.debug(type="INFO:send_patch_frame",msg="   - stage")
+         compressed=10
+         data_to_write=b''
+      elif move is not False:
+         # receiver copies the chunk from another chunk of the target (or its stage)
+         self.debug(type="INFO:send_patch_frame",msg=lambda: f"   - move from [{move[0]}] staged[{move[1]}]")
+         compressed=9
+         data_to_write=move[0].to_bytes(8,'big')+(1 if move[1] else 0).to_bytes(1,'big')
+      elif reference is True:
+         # receiver has the content in another local file (chunk index), the digest says which.
+         self.debug(type="INFO:send_patch_frame",msg="   - local reference")
+         compressed=8
+         data_to_write=b''
+      elif copy_chunk is not False:
+         # content is available at the receiver, ship its chunk number only.
+         self.debug(type="INFO:send_patch_frame",msg=lambda: f"   - copy of receiver chunk [{copy_chunk}]")
+         compressed=5
+         data_to_write=copy_chunk.to_bytes(8,'big')
+      elif zero_length is not False:
+         # all zero chunk, only the length is shipped - receiver punches a hole / extends.
+         self.debug(type="INFO:send_patch_frame",msg=lambda: f"   - zero [{zero_length}]")
+         compressed=4
+         data_to_write=zero_length.to_bytes(8,'big')
+      elif len(data_of_chunk) > 0:
+         start=self.metrics.clock()
+         compressed, data_to_write = self.compress_frame(data_of_chunk)
+         self.metrics.add(phase="compress",start=start,bytes_raw=len(data_of_chunk),bytes_compressed=len(data_to_write))
+      elif eof is False:
+         # progress chunk
+         compressed=2
+         data_to_write=b''
+      else:
+         # end chunk
+         compressed=3
+         data_to_write=b''
+      
+      data_length=len(data_to_write)
+      self.debug(type="INFO:send_patch_frame",msg=lambda: f"   - frame length {data_length}")
+
+      # DONE: conclude how to store
+      # https://stackoverflow.com/questions/7856196/how-to-translate-from-a-hexdigest-to-a-digest-and-vice-versa
+      # h.digest().hex()
+      # bytes.fromhex(h.hexdigest())
+#      with lock:
+#         handle.write(chunk.to_bytes(8,'big'))              # chunk number
+#         handle.write(bytes.fromhex(hash_of_chunk))         # hash
+#         handle.write(compressed.to_bytes(1,'big'))         # compressed ? 0=no, 1=zlib
+#         handle.write(data_length.to_bytes(8,'big'))        # data_frame length
+#         handle.write(data_to_write)                        # data
+
+      # header and payload are written separately, so the payload (a memoryview of
+      # the read buffer) is not copied once more.
+      verify_digest=b''
+      if self.verify_function is not False and compressed in self.data_frame_types:
+         # two-tier: strong digest of the uncompressed data leads the payload
+         verify_digest=self.verify_function(data_of_chunk)
+      if segment is not False:
+         # segment of a large chunk (12): offset in the chunk and the frame type of the
+         # data lead the payload
+         verify_digest=segment.to_bytes(8,'big')+compressed.to_bytes(1,'big')+verify_digest
+         compressed=12
+      frame_header=chunk.to_bytes(8,'big')+hash_of_chunk+compressed.to_bytes(1,'big')+(len(verify_digest)+data_length).to_bytes(8,'big')+verify_digest
+      return frame_header, data_to_write
+
+   def compress_frame(self, data):
+      # -> (frame type, payload) according to --remote-transfer-mode
+      if self.transfer_mode == 1:
+         return 0, data
+      if self.transfer_mode == 0:
+         # legacy: zlib as long as it pays
+         if (self.count_compressed_frames+self.count_uncompressed_frames) > 10 and (self.count_compressed_frames/(self.count_compressed_frames+self.count_uncompressed_frames)) < 0.1:
+            # > 10 frames processed but less than 10% compressed -> turn compression off.
+            self.count_uncompressed_frames+=1
+            return 0, data
+         name, level = "zlib", zlib.Z_DEFAULT_COMPRESSION
+      elif self.transfer_mode == 2:
+         name, level = self.compression[0]
+      else:
+         name, level = self.tuner.choose()
+         if name == "raw":
+            self.tuner.update_codec((name,level),len(data),len(data),0.0)
+            self.debug(type="INFO:send_patch_frame",msg="   - uncompressed [auto]")
+            return 0, data
+
+      frame_type, compress, default_level = self.compressors[name]
+      start=time.perf_counter()
+      payload=compress(data,default_level if level is False else level)
+      if self.tuner is not False:
+         self.tuner.update_codec((name,level),len(data),len(payload),time.perf_counter()-start)
+      if len(payload) < len(data)*0.9:
+         self.debug(type="INFO:send_patch_frame",msg=lambda: f"   - compressed [{name}:{level}]")
+         self.count_compressed_frames+=1
+         return frame_type, payload
+      self.debug(type="INFO:send_patch_frame",msg="   - uncompressed")
+      self.count_uncompressed_frames+=1
+      return 0, data
 
    def send_data(self,*, handle=False, data=False):
 
@@ -721,6 +2846,194 @@ class FileHasher():
          data["type"]="null"
       return data
 
+   def merkle_negotiate(self, *, handle_in, handle_out):
+      # receiver side of --remote-patching: offer the nodes of the own hash tree level
+      # by level, the sender answers which differ and sends the delta for the differing
+      # chunks afterwards (read by patch()).
+      # with a chunk index the sender offers the digests it would ship, chunks of other
+      # local files are taken from disk then. not with a detection only hash (two-tier).
+      offer=self.chunk_index is not False and self.verify_algorithm is False
+      # an interrupted transfer of the same source continues at the recorded chunk,
+      # the sender checks that its file did not change since.
+      marker=self.load_resume_marker()
+      resume=marker.get("chunk",0)
+      handle_out.write(self.merkle_magic+self.chunk_size.to_bytes(8,'big')+self.max_chk.to_bytes(8,'big')+self.hash_obj.digest_size.to_bytes(4,'big')+self.merkle_fanout.to_bytes(4,'big')+self.hash_algorithm.encode().ljust(16,b"\0")+(1 if offer else 0).to_bytes(1,'big') \
+         +resume.to_bytes(8,'big')+marker.get("source_size",0).to_bytes(8,'big')+marker.get("source_mtime_ns",0).to_bytes(8,'big') \
+         +int((self.time_budget or 0)*1000).to_bytes(8,'big')+(self.byte_budget or 0).to_bytes(8,'big')+(self.chunk_limit or 0).to_bytes(8,'big'))
+      handle_out.flush()
+      reply=read_exact(handle_in,len(self.merkle_magic)+17)
+      if reply[:len(self.merkle_magic)] != self.merkle_magic or reply[-1] != 0:
+         raise Exception("remote does not accept the hash tree negotiation (chunk size/hash algorithm mismatch)")
+      remote_chunks=int.from_bytes(reply[len(self.merkle_magic):len(self.merkle_magic)+8],'big')
+      resume=int.from_bytes(reply[len(self.merkle_magic)+8:len(self.merkle_magic)+16],'big')
+      if resume > 0:
+         print(f"- resume at chunk[{resume}]")
+      tree=merkle_tree(self.hash_obj,leaves=max(self.max_chk,remote_chunks),fanout=self.merkle_fanout,first=resume)
+      level=tree.depth()-1
+      frontier=[0] if tree.leaves > 0 else []
+      offered=0
+      while len(frontier) > 0:
+         handle_out.write(len(frontier).to_bytes(8,'big')+b''.join(tree.node(level,idx) for idx in frontier))
+         handle_out.flush()
+         offered+=len(frontier)
+         bitmap=read_exact(handle_in,(len(frontier)+7)//8)
+         differing=[ idx for pos, idx in enumerate(frontier) if bitmap[pos >> 3] & (1 << (pos & 7)) ]
+         self.debug(type="INFO:merkle_negotiate",msg=f"- level[{level}] offered[{len(frontier)}] differing[{len(differing)}]")
+         if level == 0:
+            break
+         frontier=[ child for idx in differing for child in tree.children(level,idx,remote_chunks) ]
+         level-=1
+      print(f"- hash tree: depth[{tree.depth()}] chunks[{tree.leaves}] offered[{offered}] hashes")
+      if offer is True:
+         count=int.from_bytes(read_exact(handle_in,8),'big')
+         digests=read_exact(handle_in,count*self.digest_size)
+         bitmap=bytearray((count+7)//8)
+         self.local_references={}
+         for pos in range(0,count):
+            digest=bytes(digests[pos*self.digest_size:(pos+1)*self.digest_size])
+            # the target is patched in place, its own chunks may be overwritten before use
+            found=self.chunk_index.lookup(digest,algorithm=self.hash_algorithm,exclude=self.inputfile_abspath)
+            if len(found) > 0:
+               self.local_references[digest]=found
+               bitmap[pos >> 3]|=(1 << (pos & 7))
+         handle_out.write(bitmap)
+         handle_out.flush()
+         print(f"- chunk index: offered[{count}] available locally[{len(self.local_references)}]")
+
+   def remote_sync(self, *, handle_in, handle_out, threads=0):
+      # receiver side of one file, the remote process serves it (--merkle-delta,
+      # --verify-against - --remote-delta or --agent)
+      if self.max_chunk_size is False:
+         # compare hash trees top-down, only hashes of differing subtrees are exchanged.
+         self.merkle_negotiate(handle_in=handle_in,handle_out=handle_out)
+      else:
+         # content defined chunks are matched by content - the whole hash table is needed.
+         with open(self.hashfile,"rb") as handle:
+            handle_out.write(handle.read())
+         handle_out.flush()
+      return self.patch(delta_stream_handle=handle_in,threads=threads)
+
+   def merkle_serve(self, *, handle_in):
+      # sender side, counterpart of merkle_negotiate(), the own hash table has to be complete.
+      hello=read_exact(handle_in,len(self.merkle_magic)+89)
+      chunk_size=int.from_bytes(hello[len(self.merkle_magic):len(self.merkle_magic)+8],'big')
+      remote_chunks=int.from_bytes(hello[len(self.merkle_magic)+8:len(self.merkle_magic)+16],'big')
+      digest_size=int.from_bytes(hello[len(self.merkle_magic)+16:len(self.merkle_magic)+20],'big')
+      fanout=int.from_bytes(hello[len(self.merkle_magic)+20:len(self.merkle_magic)+24],'big')
+      algorithm=bytes(hello[len(self.merkle_magic)+24:len(self.merkle_magic)+40]).rstrip(b"\0").decode()
+      offer=hello[len(self.merkle_magic)+40] & 1
+      resume, source_size, source_mtime_ns, time_budget, byte_budget, chunk_limit = ( int.from_bytes(hello[idx:idx+8],'big') for idx in range(len(self.merkle_magic)+41,len(self.merkle_magic)+89,8) )
+      accepted=hello[:len(self.merkle_magic)] == self.merkle_magic and chunk_size == self.chunk_size and digest_size == self.hash_obj.digest_size and algorithm == self.hash_algorithm and fanout > 1
+      if source_size != self.inputfile_stats.st_size or source_mtime_ns != self.inputfile_stats.st_mtime_ns:
+         # changed since the interrupted transfer, start over
+         resume=0
+      self.send2stdout(self.merkle_magic+self.max_chk.to_bytes(8,'big')+resume.to_bytes(8,'big')+(0 if accepted else 1).to_bytes(1,'big'))
+      if accepted is False:
+         raise Exception("hash tree negotiation refused (chunk size/hash algorithm mismatch)")
+      self.time_budget=time_budget/1000 if time_budget > 0 else False
+      self.byte_budget=byte_budget if byte_budget > 0 else False
+      self.chunk_limit=chunk_limit if chunk_limit > 0 else False
+      start=time.time()
+
+      tree=merkle_tree(self.hash_obj,leaves=max(self.max_chk,remote_chunks),fanout=fanout,first=resume)
+      level=tree.depth()-1
+      frontier=[0] if tree.leaves > 0 else []
+      differing=[]
+      leaves={}
+      while len(frontier) > 0:
+         count=int.from_bytes(read_exact(handle_in,8),'big')
+         if count != len(frontier):
+            raise Exception(f"hash tree negotiation out of sync at level {level}")
+         offered=read_exact(handle_in,count*tree.digest_size)
+         bitmap=bytearray((count+7)//8)
+         differing=[]
+         for pos, idx in enumerate(frontier):
+            if offered[pos*tree.digest_size:(pos+1)*tree.digest_size] != tree.node(level,idx):
+               bitmap[pos >> 3]|=(1 << (pos & 7))
+               differing.append(idx)
+               if level == 0:
+                  # chunk digest of the receiver, source of moved chunks
+                  leaves[idx]=bytes(offered[pos*tree.digest_size:(pos+1)*tree.digest_size])
+         self.send2stdout(bitmap)
+         if level == 0:
+            break
+         frontier=[ child for idx in differing for child in tree.children(level,idx,self.max_chk) ]
+         level-=1
+      # chunks behind the end of this file are cut by the receiver (stats)
+      chunks=[ chunk for chunk in differing if chunk < self.max_chk ]
+      local=set()
+      if offer:
+         # receiver has a chunk index, it answers which digests it has on disk
+         offered=[ chunk for chunk in chunks if self.hash_obj[chunk] != self.zero_digest(self.chunk_length(chunk)) ]
+         self.send2stdout(len(offered).to_bytes(8,'big')+b''.join(self.hash_obj[chunk] for chunk in offered))
+         bitmap=read_exact(handle_in,(len(offered)+7)//8)
+         local={ chunk for pos, chunk in enumerate(offered) if bitmap[pos >> 3] & (1 << (pos & 7)) }
+      self.send_delta(chunks=chunks,local=local,start=start,leaves=leaves)
+
+   def receiver_table(self, leaves):
+      # hash table of the receiver: differing chunks as offered, all others match.
+      # missing chunks are offered as zero digest.
+      table=hash_table(chunks=self.max_chk,digest_size=self.hash_obj.digest_size,algorithm=self.hash_algorithm,chunk_size=self.chunk_size)
+      missing=bytes(self.hash_obj.digest_size)
+      for chunk, digest in self.hash_obj.items():
+         digest=leaves.get(chunk,digest)
+         if digest != missing:
+            table[chunk]=digest
+      return table
+
+   def send_delta(self, *, chunks, local=set(), start=False, leaves=False):
+      # patch stream on stdout for the given chunks, in chunk order. beyond the budget
+      # or the chunk limit the stream ends with a pause frame naming the next chunk.
+      # with the chunk digests of the receiver (leaves) chunks moved within the file
+      # are copied there (not with a detection only hash, two-tier).
+      self.remote_delta_mode=True
+      self.count_compressed_frames=0
+      self.count_uncompressed_frames=0
+      self.bytes_sent=0
+      if start is False:
+         start=time.time()
+      self.relocation=False
+      if leaves is not False and self.verify_algorithm is False and len(chunks) > 0:
+         self.relocation=relocation_plan(reference=self.receiver_table(leaves),table=self.hash_obj)
+      self.reader=chunk_reader(filename=self.inputfile,chunk_size=self.chunk_size,read_mode=self.read_mode,io_mode=self.io_mode,readahead=self.readahead,metrics=self.metrics,segment_size=self.segment_size)
+      self.send2stdout(self.patch_header(hash_length=self.hash_obj.digest_size))
+      try:
+         for sent, chunk in enumerate(chunks):
+            if (self.time_budget is not False and time.time()-start >= self.time_budget) or (self.byte_budget is not False and self.bytes_sent >= self.byte_budget) \
+               or (self.chunk_limit is not False and sent >= self.chunk_limit):
+               self.debug(type="INFO:send_delta",msg=f"- budget used up, pause at chunk[{chunk}] sent[{self.bytes_sent}] chunks[{sent}]")
+               self.send_patch_frame(handle=sys.stdout.fileno(),chunk=chunk,data_of_chunk=b'',hash_of_chunk=bytes(self.digest_size),lock=self.lock_delta_stream,eof=True,pause=True)
+               return
+            new_hash=self.hash_obj[chunk]
+            zero=new_hash == self.zero_digest(self.chunk_length(chunk))
+            move=False
+            if self.relocation is not False:
+               if zero is False:
+                  move=self.relocation.source(chunk,new_hash)
+               if self.relocation.needs_stage(chunk):
+                  # old content is the source of a later chunk
+                  self.ship_frame(chunk=chunk,new_hash=self.relocation.reference[chunk],remote_delta=True,stage=True)
+                  self.relocation.stage(chunk)
+               self.relocation.write(chunk,new_hash if zero is False else False)
+            if zero is True:
+               self.ship_frame(chunk=chunk,new_hash=new_hash,remote_delta=True,zero_length=self.chunk_length(chunk))
+            elif move is not False:
+               self.debug(type="INFO:send_delta",msg=lambda: f"- [{chunk}] moved from [{move[0]}] staged[{move[1]}]")
+               self.ship_frame(chunk=chunk,new_hash=new_hash,remote_delta=True,move=move)
+            elif chunk in local:
+               # receiver copies it from one of its files
+               self.ship_frame(chunk=chunk,new_hash=new_hash,remote_delta=True,reference=True)
+            elif self.segmented(chunk):
+               self.ship_frame(chunk=chunk,new_hash=new_hash,remote_delta=True)
+            else:
+               self.pace(self.chunk_length(chunk))
+               data, token = self.reader.read(chunk)
+               self.ship_frame(chunk=chunk,new_hash=new_hash,data=data,remote_delta=True)
+               self.reader.release(token)
+      finally:
+         self.reader.close()
+      self.send_patch_frame(handle=sys.stdout.fileno(),chunk=0,data_of_chunk=b'',hash_of_chunk=bytes(self.digest_size),lock=self.lock_delta_stream,eof=True)
+
    def verify_against(self,*, hash_filename, write_delta_file=False, chunk_limit=False, remote_delta=False):
 
       self.debug(type="INFO:verify_against",msg="Start - hash_filename["+str(hash_filename)+"] write_delta_file["+str(write_delta_file)+"] chunk_limit["+str(chunk_limit)+"]")
@@ -777,22 +3090,21 @@ class FileHasher():
                   if read_speed is False:
                      read_speed=speed(max_size=self.inputfile_stats.st_size,start_chunk=self.chk)
                   if source_file is False:
-                     source_file=open(self.inputfile,"rb")
-                     source_file.seek(0)
+                     source_file=chunk_reader(filename=self.inputfile,chunk_size=self.chunk_size,io_mode=self.io_mode,readahead=self.readahead,metrics=self.metrics)
                   # we need to hash the file again.
                   # TODO: make that method agnostic.
                   if remote_delta is False:
                      read_speed.update_run(self.chunk_size)
-                  source_file.seek(self.chk*self.chunk_size)
-                  data_chunk=source_file.read(self.chunk_size)
+                  piece, token = source_file.read(self.chk)
+                  data_chunk=bytes(piece)
+                  source_file.release(token)
                   # calc hash
-                  data_hash=hashlib.sha256(data_chunk)
-                  # convert to string
-                  self.hash_obj[self.chk]=data_hash.hexdigest()
+                  self.hash_obj[self.chk]=self.digest(data_chunk)
+                  self.journal.add(self.chk,self.hash_obj[self.chk])
                   #
                   input_hash=self.hash_obj[self.chk]
                   self.save_hashes=True
-                  self.debug(type="INFO:verify_against",msg="read inputfile chk["+str(self.chk)+"] hash["+str(input_hash)+"]")
+                  self.debug(type="INFO:verify_against",msg=lambda: "read inputfile chk["+str(self.chk)+"] hash["+str(input_hash)+"]")
    #               print(f"new hash {self.hash_obj[self.chk]} for chk {self.chk}")
 
                # compare
@@ -800,19 +3112,19 @@ class FileHasher():
                   match=match+1
                else:
                   mismatch=mismatch+1
-                  self.debug(type="INFO:verify_against",msg="delta at chk["+str(self.chk)+"] SRC["+str(input_hash)+"] VERIFY["+str(compare_hash)+"]")
+                  self.debug(type="INFO:verify_against",msg=lambda: "delta at chk["+str(self.chk)+"] SRC["+str(input_hash)+"] VERIFY["+str(compare_hash)+"]")
                   
                   if write_delta_file is not False or remote_delta is not False:
                      if source_file is False:
-                        source_file=open(self.inputfile,"rb")
-                        source_file.seek(0)
+                        source_file=chunk_reader(filename=self.inputfile,chunk_size=self.chunk_size,io_mode=self.io_mode,readahead=self.readahead,metrics=self.metrics)
                      self.mismatched_idx.append(self.chk)
                      self.mismatched_idx_hashes[self.chk]=input_hash
                      # seek source file
                      if data_chunk is False:
-                        self.debug(type="INFO:verify_against",msg="re-read inputfile chk["+str(self.chk)+"] hash["+str(input_hash)+"]")
-                        source_file.seek(self.chk*self.chunk_size)
-                        data_chunk=source_file.read(self.chunk_size)
+                        self.debug(type="INFO:verify_against",msg=lambda: "re-read inputfile chk["+str(self.chk)+"] hash["+str(input_hash)+"]")
+                        piece, token = source_file.read(self.chk)
+                        data_chunk=bytes(piece)
+                        source_file.release(token)
                      
                      if write_delta_file is not False:
                         delta_file.write(data_chunk)
@@ -824,7 +3136,7 @@ class FileHasher():
                         }
                         self.send_msg(type="chunk",data=send_data)
 
-                     self.debug(type="INFO:verify_against",msg="write delta file chk["+str(self.chk)+"] data-length["+str(len(data_chunk))+"]")
+                     self.debug(type="INFO:verify_against",msg=lambda: "write delta file chk["+str(self.chk)+"] data-length["+str(len(data_chunk))+"]")
 
          #print(f"\33[2K\r",end='\r')
          print(f"verify [#{loaded_hashes}:{hash_filename}] loaded - M[#{match}:!#{mismatch}]")
@@ -853,8 +3165,7 @@ class FileHasher():
          close_file=True
 
       target_file.seek(chunk * self.chunk_size)
-      data_hash=hashlib.sha256(chunk_data)
-      data_hash=data_hash.hexdigest()
+      data_hash=self.digest(chunk_data)
       if data_hash == chunk_hash:
          self.save_hashes=True
          self.hash_obj[chunk]=data_hash
@@ -865,6 +3176,29 @@ class FileHasher():
       if close_file == True:
          target_file.close()
 
+   def out_of_time(self):
+      # deadline of --queue or --batch-manifest reached, hashing stops and continues next run
+      if self.deadline is not False and time.time() >= self.deadline:
+         if self.hash_stopped is False:
+            self.debug(type="INFO:hash_file",msg="- deadline reached, stop hashing")
+         self.hash_stopped=True
+      return self.hash_stopped
+
+   def pace(self, length):
+      if self.governor is not False:
+         self.governor.throttle(length)
+
+   def settle_written(self, fd, length):
+      # io modes 1/2: patched data leaves the page cache once it is on disk, a window
+      # of readahead bytes at a time.
+      if self.io_mode == 0:
+         return
+      self.written_unsettled+=length
+      if self.written_unsettled >= self.readahead:
+         os.fdatasync(fd)
+         os.posix_fadvise(fd,0,0,os.POSIX_FADV_DONTNEED)
+         self.written_unsettled=0
+
    def apply_stats(self, *, stats=False):
 
       if stats is not False:
@@ -876,25 +3210,100 @@ class FileHasher():
          os.utime(self.inputfile,ns=(stats.st_atime_ns,stats.st_mtime_ns))
 
    def read_patch_stream(self,handle,size):
-
-      if self.remote_delta_mode is False:
-         # file
-         self.debug(type="INFO:read_patch_stream",msg=f"file mode {size}")
-         data=handle.read(size)         
-      else:
-         # ssh stdout
-         self.debug(type="INFO:read_patch_stream",msg=f"stream mode {size}")
-         data=b''
-         while len(data) < size:
-            data+=handle.read(size-len(data))
-         #while not handle.channel.exit_status_ready():
-         #   if handle.channel.recv_ready():
-         #      data=handle.channel.recv(size)
-         #      break
-      #self.debug(type="INFO:read_patch_stream",msg=f"data: {data}")
-      return data
-
-   def patch(self, *, delta_file=False,delta_stream_handle=False):
+      # exact read (short at the end of the stream) into a preallocated buffer, pipes
+      # and ssh channels deliver small pieces.
+      data=bytearray(size)
+      count=read_into(handle,data,size)
+      if count < size:
+         del data[count:]
+      return bytes(data)
+
+   def receive_frames(self, *, patch_data_file, hash_length, apply, threads=0, verify_function=False, verify_length=0, phase="read"):
+      # pipelined receiver, frames are handed to apply() strictly in stream order:
+      # - this thread reads frames into reused buffers (readinto)
+      # - worker threads decompress + verify data frames (codecs/hashlib release the GIL)
+      # - a writer thread calls apply(chunk, digest, type, payload, data)
+      # the bounded queue keeps at most window frames in memory. returns True if the
+      # end frame was seen. a pause frame (budget of the sender) ends the stream as
+      # incomplete, its chunk is left in self.resume_chunk. phase: metrics of the
+      # stream reads, "network" for ssh/pipes.
+      if threads == 0:
+         threads=multiprocessing.cpu_count()
+      window=self.window(threads)
+      self.debug(type="INFO:receive_frames",msg=f"- worker threads[{threads}] window[{window}]")
+
+      work=queue.Queue(maxsize=window)
+      free_buffers=[]
+      failed=[]
+
+      def writer():
+         while True:
+            item=work.get()
+            if item is None:
+               return
+            frame, job, buffer = item
+            try:
+               if len(failed) == 0:
+                  data=job.result() if job is not False else None
+                  apply(*frame,data)
+            except Exception as e:
+               failed.append(e)
+            free_buffers.append(buffer)
+
+      pool=concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+      thread=threading.Thread(target=writer,daemon=True)
+      thread.start()
+      frame_header=bytearray(8+hash_length+1+8)
+      complete=False
+      try:
+         while len(failed) == 0:
+            start=self.metrics.clock()
+            if read_into(patch_data_file,frame_header,len(frame_header)) < len(frame_header):
+               # stream ended without end frame
+               break
+            self.metrics.add(phase=phase,start=start,bytes_received=len(frame_header))
+            frame_chunk=int.from_bytes(frame_header[0:8],'big')
+            frame_hash_digest=bytes(frame_header[8:8+hash_length])
+            frame_compressed=frame_header[8+hash_length]
+            frame_data_length=int.from_bytes(frame_header[9+hash_length:],'big')
+            if frame_compressed == 3:
+               self.debug(type="INFO:patch",msg=f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{frame_data_length}] - end chunk")
+               complete=True
+               break
+            if frame_compressed == 11:
+               self.debug(type="INFO:patch",msg=f"- chunk {frame_chunk} - C[{frame_compressed}] - pause")
+               self.resume_chunk=frame_chunk
+               break
+            try:
+               buffer=free_buffers.pop()
+            except IndexError:
+               buffer=bytearray(frame_data_length)
+            if len(buffer) < frame_data_length:
+               buffer=bytearray(frame_data_length)
+            start=self.metrics.clock()
+            if read_into(patch_data_file,buffer,frame_data_length) < frame_data_length:
+               break
+            self.metrics.add(phase=phase,start=start,bytes_received=frame_data_length)
+            payload=memoryview(buffer)[:frame_data_length]
+            job=False
+            if frame_compressed == 8:
+               job=pool.submit(self.frame_reference,frame_hash_digest=frame_hash_digest)
+            elif frame_compressed in self.data_frame_types:
+               job=pool.submit(self.frame_data,frame_hash_digest=frame_hash_digest,frame_compressed=frame_compressed,frame_data_raw=payload,verify_function=verify_function,verify_length=verify_length)
+            elif frame_compressed == 12:
+               # segment of a large chunk, checked against the digest of the segment
+               job=pool.submit(self.frame_data,frame_hash_digest=frame_hash_digest,frame_compressed=payload[8],frame_data_raw=payload[9:],verify_function=verify_function,verify_length=verify_length)
+            work.put(((frame_chunk,frame_hash_digest,frame_compressed,payload),job,buffer))
+      finally:
+         work.put(None)
+         thread.join()
+         pool.shutdown(wait=True,cancel_futures=True)
+
+      if len(failed) > 0:
+         raise failed[0]
+      return complete
+
+   def patch(self, *, delta_file=False,delta_stream_handle=False,threads=0):
 
       if delta_file is False and delta_stream_handle is False:
          raise Exception("no delta file nor stream provided")
@@ -918,85 +3327,312 @@ class FileHasher():
 
       # TODO: think about if this patch, needs a remote_delta_mode = True ?
 
+      # left behind by a killed run of a content defined patch
+      if os.path.exists(self.inputfile+".patching"):
+         print(f"- remove stale {self.inputfile}.patching")
+         os.remove(self.inputfile+".patching")
+
       # 2) read header 
-      patch_file_number_of_chunks=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
-      patch_file_format_version=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
-      patch_file_chunk_size=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
-      patch_file_hash_length=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
-      patch_file_stats_length=int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
-      patch_file_stats_data=self.read_patch_stream(patch_data_file,patch_file_stats_length)
-
-      print(f"- patch/run: #ofChunks[{patch_file_number_of_chunks}] - version[{patch_file_format_version}/{self.patch_file_version_int}] - chunk size[{patch_file_chunk_size}/{self.chunk_size}] - hash length[{patch_file_hash_length}]")
-      if patch_file_format_version != self.patch_file_version_int or self.chunk_size != patch_file_chunk_size:
-         raise Exception("version/chunk size mismatch.")
+      header=self.read_patch_header(patch_data_file)
+      patch_file_hash_length=header["hash_length"]
+      patch_file_stats=header["stats"]
 
-      patch_file_stats=pickle.loads(patch_file_stats_data)
+      print(f"- patch/run: #ofChunks[{header['chunks']}] - version[{header['version']}/{self.patch_file_version_int}] - chunk size[{header['chunk_size']}/{self.chunk_size}] - hash length[{patch_file_hash_length}] - algorithm[{header['algorithm']}/{header['verify_algorithm'] or '-'}]")
+      if self.chunk_size != header["chunk_size"] or (self.max_chunk_size or 0) != header["max_chunk_size"]:
+         raise Exception("version/chunk size mismatch.")
+      if header["algorithm"] != self.hash_algorithm or patch_file_hash_length != self.digest_size:
+         raise Exception(f"hash algorithm mismatch {header['algorithm']}/{self.hash_algorithm}.")
+      # strong digest of data frames, set by the sender
+      verify_function=False
+      verify_length=0
+      if header["verify_algorithm"] != "":
+         verify_function, verify_length = hash_function(header["verify_algorithm"])
 
       counter={}
       counter['matching']=0
       counter['unneeded']=0
       counter['updated']=0
-
-      with open(self.inputfile, 'r+b') as target_file:
-         # 3) read patch frames and apply
-
-         while True:
-            try:
-               frame_chunk = int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
-               frame_hash_hexdigest = self.read_patch_stream(patch_data_file,patch_file_hash_length).hex()
-               frame_compressed = int.from_bytes(self.read_patch_stream(patch_data_file,1),'big')
-               frame_data_length = int.from_bytes(self.read_patch_stream(patch_data_file,8),'big')
-               if frame_data_length > 0:
-                  print(f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{frame_data_length}]")
-                  self.debug(type="INFO:patch",msg=f"  - digest patch[{frame_hash_hexdigest}]")
-                  frame_data_raw = self.read_patch_stream(patch_data_file,frame_data_length)
-
-                  old_hash=self.hash_obj.get(frame_chunk,False)
-                  if old_hash is False or old_hash != frame_hash_hexdigest:
-                     # uncompress if needed
-                     if frame_compressed == 0:
-                        frame_write_data=frame_data_raw
-                     elif frame_compressed == 1:
-                        frame_write_data=zlib.decompress(frame_data_raw)
-                     else:
-                        raise Exception(f"Delta Frame with unknown compression type {frame_compressed}")
-                     # hash
-                     frame_write_data_hash=hashlib.sha256(frame_write_data).hexdigest()
-                     self.debug(type="INFO:patch",msg=f"  - digest write[{frame_write_data_hash}]")
-                     if frame_hash_hexdigest != frame_write_data_hash:
-                        raise Exception("Delta Frame hash does not match shipped data.")
-                     # check if we need to write
-                     target_file.seek(frame_chunk*self.chunk_size)
-                     target_file.write(frame_write_data)
-                     self.update_hash_idx(chunk=frame_chunk,new_hash=frame_hash_hexdigest)
-                     counter['updated']+=1
-                     self.save_hashes=True
-                  else:
-                     counter['unneeded']+=1
-                     print(f"  - digest local[{frame_hash_hexdigest}] match")
+      counter['local']=0
+      counter['moved']=0
+
+      # the target changes its mtime while patching, journal records would not
+      # survive the state check, so hashes are saved at exit/signal instead.
+      self.patching=True
+
+      # frames from ssh/pipes are network time, from a delta file read time
+      phase="network" if delta_stream_handle is not False else "read"
+
+      if os.path.exists(self.hashfile+".verified"):
+         if self.max_chunk_size is not False:
+            # the new file is numbered anew, nothing of it is verified
+            os.unlink(self.hashfile+".verified")
+         elif self.verified is False:
+            self.verified=verify_record(self.hashfile+".verified",chunks=self.max_chk,chunk_size=self.chunk_size,stats=self.inputfile_stats)
+
+      if self.max_chunk_size is not False:
+         self._patch_cdc(patch_data_file=patch_data_file,hash_length=patch_file_hash_length,counter=counter,threads=threads,verify_function=verify_function,verify_length=verify_length,phase=phase)
+         if delta_file is not False:
+            patch_data_file.close()
+         self.apply_stats(stats=patch_file_stats)
+         self._refresh_inputfile_stats()
+         print(f"- Done. Updated[{counter['updated']}]/Copied[{counter['matching']}]")
+         return counter
+
+      # 3) read patch frames and apply
+      # frames come in chunk order, all chunks before the last applied one are done.
+      self.resume_chunk=False
+      self.resume_state={ "chunk": 0, "source_size": patch_file_stats.st_size, "source_mtime_ns": patch_file_stats.st_mtime_ns }
+      target_fd=os.open(self.inputfile,os.O_RDWR)
+      target_size=os.fstat(target_fd).st_size
+      # old contents of chunks which are moved after they got written (stage frames)
+      staging=self.inputfile+".staging"
+      staging_fd=False
+      staged={}
+
+      def apply(frame_chunk, frame_hash_digest, frame_compressed, payload, data):
+         nonlocal staging_fd
+         if frame_compressed == 2:
+            # progress chunk
+            counter['matching']+=1
+            self.debug(type="INFO:patch",msg=lambda: f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{len(payload)}] - progress chunk")
+            return
+         if frame_compressed == 12:
+            # segment of a large chunk, written where it belongs
+            offset=int.from_bytes(payload[0:8],'big')
+            if offset == 0 and frame_chunk in self.hash_obj:
+               # the chunk is mixed until its end frame, a broken run hashes it again
+               with self.lock_update_idx:
+                  del self.hash_obj[frame_chunk]
+               self.save_hashes=True
+            self.debug(type="INFO:patch",msg=lambda: f"- chunk {frame_chunk} - C[{frame_compressed}/{payload[8]}] - segment[{offset}+{len(data)}]")
+            self.pace(len(data))
+            start=self.metrics.clock()
+            os.pwrite(target_fd,data,frame_chunk*self.chunk_size+offset)
+            self.settle_written(target_fd,len(data))
+            self.metrics.add(phase="write",start=start,bytes_written=len(data))
+            return
+         if frame_compressed == 13:
+            # all segments written, the chunk has its new digest
+            print(f"- chunk {frame_chunk} - C[{frame_compressed}] - segments")
+            self.update_hash_idx(chunk=frame_chunk,new_hash=frame_hash_digest)
+            if self.verified is not False:
+               self.patched_chunks.append(frame_chunk)
+            counter['updated']+=1
+            self.save_hashes=True
+            self.resume_state["chunk"]=frame_chunk+1
+            return
+         if frame_compressed == 10:
+            # stage chunk, its current content is the source of a later move frame
+            length=max(0,min(self.chunk_size,target_size-frame_chunk*self.chunk_size))
+            data=False
+            if length > self.segment_size:
+               # large chunk, checked and copied segment by segment
+               if self.fd_digest(target_fd,frame_chunk*self.chunk_size,length) != frame_hash_digest:
+                  raise Exception(f"Delta Frame stages chunk {frame_chunk} which does not match.")
+            else:
+               data=os.pread(target_fd,length,frame_chunk*self.chunk_size)
+               if self.digest(data) != frame_hash_digest:
+                  raise Exception(f"Delta Frame stages chunk {frame_chunk} which does not match.")
+               length=len(data)
+            if staging_fd is False:
+               staging_fd=os.open(staging,os.O_RDWR|os.O_CREAT|os.O_TRUNC,0o600)
+            offset=os.lseek(staging_fd,0,os.SEEK_END)
+            if data is False:
+               self.copy_range(source_fd=target_fd,source_offset=frame_chunk*self.chunk_size,length=length,target_fd=staging_fd,target_offset=offset)
+            else:
+               os.pwrite(staging_fd,data,offset)
+            staged[frame_chunk]=(offset,length)
+            print(f"- chunk {frame_chunk} - C[{frame_compressed}] - staged[{length}]")
+            return
+         if frame_compressed == 4:
+            # zero chunk, payload is the length only
+            zero_length=int.from_bytes(payload,'big')
+            print(f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{len(payload)}] - zero[{zero_length}]")
+         elif frame_compressed in self.data_frame_types:
+            print(f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{len(payload)}]")
+            self.debug(type="INFO:patch",msg=lambda: f"  - digest patch[{frame_hash_digest.hex()}]")
+         elif frame_compressed == 8:
+            print(f"- chunk {frame_chunk} - C[{frame_compressed}] - local[{data[2] if type(data) is tuple else len(data)}]")
+         elif frame_compressed == 9:
+            source=int.from_bytes(payload[0:8],'big')
+            print(f"- chunk {frame_chunk} - C[{frame_compressed}] - move[{source}]{' staged' if payload[8] == 1 else ''}")
+         else:
+            raise Exception(f"Delta Frame with unknown compression type {frame_compressed}")
+
+         old_hash=self.hash_obj.get(frame_chunk,False)
+         if old_hash is not False and old_hash == frame_hash_digest:
+            counter['unneeded']+=1
+            print(f"  - digest local[{frame_hash_digest.hex()}] match")
+            return
+         if frame_compressed == 4:
+            if frame_hash_digest != self.zero_digest(zero_length):
+               raise Exception("Delta Frame hash does not match zero chunk.")
+            start=self.metrics.clock()
+            write_zero(target_fd,frame_chunk*self.chunk_size,zero_length)
+            self.settle_written(target_fd,zero_length)
+            self.metrics.add(phase="write",start=start,bytes_written=zero_length)
+         else:
+            # large moved/referenced chunks are copied from source_fd segment by segment
+            source_fd=False
+            if frame_compressed == 9:
+               # a move has the length of the new chunk
+               length=min(self.chunk_size,patch_file_stats.st_size-frame_chunk*self.chunk_size)
+               if payload[8] == 1:
+                  source_offset, staged_length = staged[source]
+                  source_fd, length = staging_fd, min(length,staged_length)
                else:
-                  if frame_compressed == 2:
-                     counter['matching']+=1
-                     # progress chunk
-                     #print(f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{frame_data_length}] - progress chunk")
-                     self.debug(type="INFO:patch",msg=f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{frame_data_length}] - progress chunk")
-                  else:
-                     # end
-                     self.debug(type="INFO:patch",msg=f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{frame_data_length}] - end chunk")
-                     #print(f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{frame_data_length}] - end chunk")
-                     break
-
-            except:
-               break
+                  source_fd, source_offset = target_fd, source*self.chunk_size
+               if length > self.segment_size:
+                  if self.fd_digest(source_fd,source_offset,length) != frame_hash_digest:
+                     raise Exception(f"Delta Frame moves chunk {source} which does not match.")
+               else:
+                  data=os.pread(source_fd,length,source_offset)
+                  if self.digest(data) != frame_hash_digest:
+                     raise Exception(f"Delta Frame moves chunk {source} which does not match.")
+                  source_fd=False
+               counter['moved']+=1
+            elif frame_compressed == 8 and type(data) is tuple:
+               # checked by frame_reference already
+               path, source_offset, length = data
+               source_fd=os.open(path,os.O_RDONLY)
+            if source_fd is False:
+               length=len(data)
+            self.pace(length)
+            start=self.metrics.clock()
+            if source_fd is False:
+               os.pwrite(target_fd,data,frame_chunk*self.chunk_size)
+            else:
+               if frame_chunk in self.hash_obj:
+                  # the chunk is mixed until it is copied, a broken run hashes it again
+                  with self.lock_update_idx:
+                     del self.hash_obj[frame_chunk]
+                  self.save_hashes=True
+               try:
+                  copied=self.copy_range(source_fd=source_fd,source_offset=source_offset,length=length,target_fd=target_fd,target_offset=frame_chunk*self.chunk_size,digest=frame_hash_digest if frame_compressed == 8 else False)
+               finally:
+                  if frame_compressed == 8:
+                     os.close(source_fd)
+               if copied is False:
+                  raise Exception(f"Delta Frame references local data {frame_hash_digest.hex()} which changed while copied.")
+            self.settle_written(target_fd,length)
+            self.metrics.add(phase="write",start=start,bytes_written=length)
+            if frame_compressed == 8:
+               counter['local']+=1
+         self.update_hash_idx(chunk=frame_chunk,new_hash=frame_hash_digest)
+         if self.verified is not False:
+            self.patched_chunks.append(frame_chunk)
+         counter['updated']+=1
+         self.save_hashes=True
+         self.resume_state["chunk"]=frame_chunk+1
 
-      patch_data_file.close()
+      try:
+         complete=self.receive_frames(patch_data_file=patch_data_file,hash_length=patch_file_hash_length,apply=apply,threads=threads,verify_function=verify_function,verify_length=verify_length,phase=phase)
+      finally:
+         self.settle_written(target_fd,self.readahead)
+         os.close(target_fd)
+         if staging_fd is not False:
+            os.close(staging_fd)
+            os.unlink(staging)
+
+      # streams may carry further files (--agent)
+      if delta_file is not False:
+         patch_data_file.close()
+
+      if complete is False and self.resume_chunk is not False:
+         # budget of this run used up, the marker lets the next run continue here.
+         self.resume_state["chunk"]=self.resume_chunk
+         self.save_resume_marker()
+         self.resume_state=False
+         counter['resume']=self.resume_chunk
+         print(f"- Paused. Updated[{counter['updated']}]/Local[{counter['local']}]/Moved[{counter['moved']}] - resume at chunk[{self.resume_chunk}]")
+         return counter
+      if complete is False:
+         # stats of the source would mark a half patched target as done.
+         raise Exception(f"patch stream ended early, Updated[{counter['updated']}] - stats not applied.")
 
       # apply/update metadata
       print(f"- truncate to "+str(patch_file_stats.st_size)+".")
       self.apply_stats(stats=patch_file_stats)
+      self.resume_state=False
+      self.remove_resume_marker()
 
       self._refresh_inputfile_stats()
-      print(f"- Done. Updated[{counter['updated']}]/Matching[{counter['matching']}]/Unneeded[{counter['unneeded']}]")
+      print(f"- Done. Updated[{counter['updated']}]/Local[{counter['local']}]/Moved[{counter['moved']}]/Matching[{counter['matching']}]/Unneeded[{counter['unneeded']}]")
+      return counter
+
+   def _patch_cdc(self, *, patch_data_file, hash_length, counter, threads=0, verify_function=False, verify_length=0, phase="read"):
+      # content defined chunks: the new file is assembled next to the target from
+      # ranges of the target and shipped data. it replaces the target only if the
+      # stream was complete, a broken transfer leaves the target as it was.
+      assembly=self.inputfile+".patching"
+      new_table=self._new_table()
+      # next chunk and its offset in the new file
+      position=[0,0]
+
+      # a full size copy, removed on every way out but the replace (and by
+      # checkpoint() in the signal path)
+      self.assembly=assembly
+      try:
+         # unbuffered: all writes go to the fd, fdatasync/fadvise of settle_written see all of them
+         with open(self.inputfile, 'rb') as target_file, open(assembly, 'wb', buffering=0) as new_file:
+
+            def apply(frame_chunk, frame_hash_digest, frame_compressed, payload, data):
+               expected, offset = position
+               if frame_chunk != expected:
+                  raise Exception(f"Delta Frame out of order, chunk {frame_chunk} instead of {expected}.")
+               start=self.metrics.clock()
+
+               if frame_compressed == 5:
+                  # copy of a local chunk
+                  local_chunk=int.from_bytes(payload,'big')
+                  if self.hash_obj.get(local_chunk,False) != frame_hash_digest:
+                     raise Exception(f"Delta Frame references local chunk {local_chunk} which is not known with this hash.")
+                  local_offset, length = self.hash_obj.span(local_chunk)
+                  self.debug(type="INFO:patch",msg=lambda: f"- chunk {frame_chunk} - copy local chunk {local_chunk} [{local_offset}+{length}]")
+                  copy_range(target_file.fileno(),new_file.fileno(),local_offset,offset,length)
+                  counter['matching']+=1
+               elif frame_compressed == 4:
+                  length=int.from_bytes(payload,'big')
+                  if frame_hash_digest != self.zero_digest(length):
+                     raise Exception("Delta Frame hash does not match zero chunk.")
+                  print(f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{len(payload)}] - zero[{length}]")
+                  write_zero(new_file.fileno(),offset,length)
+                  counter['updated']+=1
+               elif frame_compressed in self.data_frame_types:
+                  print(f"- chunk {frame_chunk} - C[{frame_compressed}] - L[{len(payload)}]")
+                  length=len(data)
+                  self.pace(length)
+                  start=self.metrics.clock()
+                  os.pwrite(new_file.fileno(),data,offset)
+                  counter['updated']+=1
+               else:
+                  raise Exception(f"Delta Frame with unknown compression type {frame_compressed}")
+
+               self.settle_written(new_file.fileno(),length)
+               self.metrics.add(phase="write",start=start,bytes_written=length)
+               new_table[expected]=frame_hash_digest
+               new_table.set_end(expected,offset+length)
+               position[0]=expected+1
+               position[1]=offset+length
+
+            complete=False
+            try:
+               complete=self.receive_frames(patch_data_file=patch_data_file,hash_length=hash_length,apply=apply,threads=threads,verify_function=verify_function,verify_length=verify_length,phase=phase)
+            finally:
+               if complete is True:
+                  os.fsync(new_file.fileno())
+
+         if complete is False:
+            raise Exception("patch stream ended early, target left unchanged.")
+
+         os.chmod(assembly,self.inputfile_stats.st_mode & 0o7777)
+         os.replace(assembly,self.inputfile)
+      finally:
+         if os.path.exists(assembly):
+            os.remove(assembly)
+         self.assembly=False
+      self.hash_obj=new_table
+      self.save_hashes=True
 
    def patch_old(self, *, delta_file=False):
 
@@ -1020,7 +3656,7 @@ class FileHasher():
                for idx in patch_chk_list:
                   chk_data=patch_data_file.read(self.chunk_size)
                   self.patch_chk(chunk=idx,chunk_data=chk_data,chunk_hash=patch_data["mismatch_idx_hashes"][idx])
-                  print(f"  - patch chk {idx} send[{self.hash_obj[idx]}] remote["+patch_data["mismatch_idx_hashes"][idx]+"]")
+                  print(f"  - patch chk {idx} send[{self.hash_obj[idx].hex()}] remote[{patch_data['mismatch_idx_hashes'][idx].hex()}]")
 
          # apply/update metadata
          print(f"- truncate to "+str(patch_data["stats"].st_size)+".")
@@ -1038,30 +3674,60 @@ class FileHasher():
             print(f"{self.loaded_hashes} - unchanged - hashfile[{len(self.hash_obj)}:{self.hashfile}] - chunk-size[{self.chunk_size}]")
 
    def debug(self,*,type="INFO",msg="-"):
-      if self._debug == True:
-         #print(f"[{type}]: {msg}")
-         os.write(sys.stderr.fileno(), f"[{type:>20}]: {msg}\n".encode())
+      # msg may be a callable, per chunk messages are only formatted with --debug
+      if self._debug is not True:
+         return
+      if callable(msg):
+         msg=msg()
+      os.write(sys.stderr.fileno(), f"[{type:>20}]: {msg}\n".encode())
 
    def load_hash(self,*, hashfile=False, extended_tests=False,type_patch_file=False):
 
       self.loaded_hash_error="-"
       if hashfile is not False:
          data=False
+         table=False
          if hashfile == "-":
-            # stdin is used
+            # stdin is used, only v2 is shipped over the wire.
             self.debug(type="INFO:load_hash",msg="Loading hashfile from stdin")
-            data=pickle.load(sys.stdin.buffer)
+            table=hash_table.load_stream(self.stream_in)
          elif os.path.isfile(hashfile):
             self.debug(type="INFO:load_hash",msg="Loading hashfile cwd["+os.getcwd()+"]"+hashfile)
-            with open(hashfile, 'rb') as handle:
+            if type_patch_file is False and hash_table.is_hashfile(hashfile):
                try:
-                  data = pickle.load(handle)
+                  table=hash_table.load(hashfile)
                except Exception as e:
-                  self.debug(type="INFO:load_hash",msg="unpickling of data failed.")
-                  self.loaded_hash_error=f"not-loaded(unpickling-{e})"
+                  self.debug(type="INFO:load_hash",msg="loading of v2 hashfile failed.")
+                  self.loaded_hash_error=f"not-loaded(v2-{e})"
                   return False
+            else:
+               with open(hashfile, 'rb') as handle:
+                  try:
+                     data = pickle.load(handle)
+                  except Exception as e:
+                     self.debug(type="INFO:load_hash",msg="unpickling of data failed.")
+                     self.loaded_hash_error=f"not-loaded(unpickling-{e})"
+                     return False
+
+         if table is not False:
+            data={
+               "version": self.chunk_file_version,
+               "inputfile": table.inputfile,
+               "chunk_size": table.chunk_size,
+               "size": table.size,
+               "mtime": table.mtime,
+               "algorithm": table.algorithm,
+               "max_chunk_size": table.max_chunk_size,
+               "hashes": table
+            }
+         elif data is not False and type_patch_file is False and data.get("version",False) == self.chunk_file_version_legacy:
+            # migrate v1.0.3 pickle
+            self.debug(type="INFO:load_hash",msg="migrate hashfile from "+self.chunk_file_version_legacy)
+            data["hashes"]=hash_table.from_dict(data["hashes"],chunk_size=data["chunk_size"])
+            data["version"]=self.chunk_file_version
+            data["algorithm"]="sha256"
+            data["migrated"]=True
 
-                  
          if data is not False:
             
             try:
@@ -1081,6 +3747,15 @@ class FileHasher():
                   self.debug(type="INFO:load_hash",msg="chunk_size mismatch self["+str(self.chunk_size)+"] file["+str(data["chunk_size"])+"]")
                   self.loaded_hash_error="not-loaded(wrong chunk-size)"
                   return False
+               if type_patch_file is False and data.get("max_chunk_size",0) != (self.max_chunk_size or 0):
+                  self.debug(type="INFO:load_hash",msg="max_chunk_size mismatch self["+str(self.max_chunk_size)+"] file["+str(data.get("max_chunk_size",0))+"]")
+                  self.loaded_hash_error="not-loaded(wrong chunk-size)"
+                  return False
+               # check algorithm
+               if type_patch_file is False and data.get("algorithm",self.hash_algorithm) != self.hash_algorithm:
+                  self.debug(type="INFO:load_hash",msg="algorithm mismatch self["+self.hash_algorithm+"] file["+str(data["algorithm"])+"]")
+                  self.loaded_hash_error="not-loaded(wrong-algorithm)"
+                  return False
                
                # extended checks
                if extended_tests is True:
@@ -1114,40 +3789,383 @@ class FileHasher():
       
       return False
 
+   def load_resume_marker(self):
+      # -> marker of an interrupted transfer or {} if there is none or the target changed since
+      try:
+         with open(self.hashfile+".resume") as handle:
+            marker=json.load(handle)
+      except (OSError, ValueError):
+         return {}
+      stats=os.stat(self.inputfile)
+      if marker.get("target_size") != stats.st_size or marker.get("target_mtime_ns") != stats.st_mtime_ns:
+         return {}
+      return marker
+
+   def save_resume_marker(self):
+      # next chunk of the interrupted transfer, the source it came from and the state of the target
+      stats=os.stat(self.inputfile)
+      marker=dict(self.resume_state,target_size=stats.st_size,target_mtime_ns=stats.st_mtime_ns)
+      with open(self.hashfile+".resume.tmp","w") as handle:
+         json.dump(marker,handle)
+      os.replace(self.hashfile+".resume.tmp",self.hashfile+".resume")
+      self.debug(type="INFO:save_resume_marker",msg=f"- {marker}")
+
+   def remove_resume_marker(self):
+      try:
+         os.unlink(self.hashfile+".resume")
+      except FileNotFoundError:
+         pass
+
+   def checkpoint(self):
+      # signal path: no rewrite of the hashfile, just persist the queued journal
+      # records. the next run replays them.
+      self.debug(type="INFO:checkpoint",msg=f"- start")
+      if self.pool is not False:
+         self.pool.shutdown(wait=False,cancel_futures=True)
+      if self.patching is True:
+         self.save_hash()
+         if self.resume_state is not False and self.resume_state["chunk"] > 0:
+            # killed while patching (timeout), applied chunks are not transferred again
+            self.save_resume_marker()
+      else:
+         self.journal.stop()
+      if self.assembly is not False and os.path.exists(self.assembly):
+         os.remove(self.assembly)
+      self.debug(type="INFO:checkpoint",msg=f"- end")
+
    def save_hash(self):
 
       self.debug(type="INFO:save_hash",msg=f"- start")
-      # mark inactive
-      self.active=False
-      for cpu in range(0,multiprocessing.cpu_count()):
-         try:
-            self.debug(type="INFO:save_hash",msg=f"  - join thread {cpu}.")
-            self.thread[cpu].join()
-         except:
-            self.debug(type="INFO:save_hash",msg=f"    - tried to join thread {cpu} failed.")
-     
+      # stop hashing workers, queued chunks are hashed next run.
+      if self.pool is not False:
+         self.debug(type="INFO:save_hash",msg=f"  - stop worker threads.")
+         self.pool.shutdown(wait=False,cancel_futures=True)
+
       if self.save_hashes == True:
-         data={}
-         data["inputfile"]=os.path.abspath(self.inputfile)
-         data["version"]=self.chunk_file_version
-         data["hashes"]=self.hash_obj
-         data["chunk_size"]=self.chunk_size
          self._refresh_inputfile_stats()
-         data["mtime"]=self.inputfile_stats.st_mtime
-         data["size"]=self.inputfile_stats.st_size
-         
-         # save
-         with open(self.hashfile, 'wb') as handle:
-            pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+         # save - changed entries only if the hashfile layout did not change.
+         self.hash_obj.save(self.hashfile,
+            inputfile=os.path.abspath(self.inputfile),
+            chunk_size=self.chunk_size,
+            size=self.inputfile_stats.st_size,
+            mtime=self.inputfile_stats.st_mtime)
 
-         self.debug(type="INFO:save_hash",msg=f"  - saved under {self.hash_file}")
+         self.debug(type="INFO:save_hash",msg=f"  - saved under {self.hashfile}")
+
+      # compacted into the hashfile
+      self.journal.discard()
+
+      if self.verified is not False:
+         self._refresh_inputfile_stats()
+      if self.verified is not False and (len(self.patched_chunks) > 0 or self.verified.state != (self.inputfile_stats.st_size,self.inputfile_stats.st_mtime_ns)):
+         # patched: new state of the file, the written chunks are checked first next time
+         self.verified.unverified(self.patched_chunks)
+         self.verified.resize(math.ceil(self.inputfile_stats.st_size/self.chunk_size))
+         self.verified.save(self.inputfile_stats)
+         self.patched_chunks=[]
 
 
       self.feedback()
       self.debug(type="INFO:save_hash",msg=f"- end")
 
 
-version="1.1.7"
+def chunk_index_add(index, FH):
+   # a patched target is a source of local chunks for the following files
+   stats=os.stat(FH.inputfile)
+   index.add_table(table=FH.hash_obj,inputfile=FH.inputfile_abspath,size=stats.st_size,mtime=stats.st_mtime,hashfile=FH.hashfile)
+
+class agent_session():
+   """ receiver side of the agent protocol over one ssh channel (filehasher.py --agent).
+
+   request: length (4) + json (version, remote file and options), length 0 ends the session.
+   reply: status (1, 0=served) + length (4) + message, then the exchange of
+   remote_sync() - hash tree or hash table, patch stream.
+   """
+
+   def __init__(self, ssh):
+      self.stdin, self.stdout, self.stderr = ssh.exec_command("filehasher.py --agent",get_pty=False)
+      # False once a stream broke, the position in the protocol is unknown then.
+      self.usable=True
+
+   def sync(self, FH, remote_file, *, threads=0):
+      # one file, returns the patch counters. a refused file leaves the session usable.
+      request=json.dumps({
+         "version": version,
+         "inputfile": remote_file,
+         "chunk_size": FH.chunk_size,
+         "max_chunk_size": FH.max_chunk_size,
+         "hash_algorithm": FH.hash_algorithm,
+         "verify_algorithm": FH.verify_algorithm,
+         "transfer_mode": FH.transfer_mode,
+         # the remote side compresses with codecs available here only
+         "compression": ",".join(name if level is False else name+":"+str(level) for name, level in FH.compression)
+      }).encode()
+      try:
+         self.stdin.write(len(request).to_bytes(4,'big')+request)
+         self.stdin.flush()
+         reply=read_exact(self.stdout,5)
+         message=bytes(read_exact(self.stdout,int.from_bytes(reply[1:5],'big'))).decode()
+      except Exception:
+         self.usable=False
+         raise
+      if reply[0] != 0:
+         raise Exception(f"remote: {message}")
+      try:
+         return FH.remote_sync(handle_in=self.stdout,handle_out=self.stdin,threads=threads)
+      except Exception:
+         self.usable=False
+         raise
+
+   def close(self):
+      if self.usable is True:
+         self.stdin.write((0).to_bytes(4,'big'))
+         self.stdin.flush()
+
+class hash_agent():
+   """ long-lived remote side of remote patching (--agent, --agent-listen).
+
+   every request names a file and its chunk/hash/transfer options. the FileHasher of
+   each (file, options) stays in memory, the least recently used ones are saved and
+   dropped beyond entries. an unchanged file (size, mtime, inode) is served from
+   memory - no hashfile is loaded and nothing is hashed again.
+   """
+
+   def __init__(self, *, entries=32, thread_mode=0, threads=0, read_mode=0, io_mode=0, readahead=64*1024*1024, compress_threads=0, governor=False, metrics=False, debug=False):
+      self.entries=entries
+      self.thread_mode=thread_mode
+      self.threads=threads
+      self.read_mode=read_mode
+      self.io_mode=io_mode
+      self.readahead=readahead
+      self.governor=governor
+      self.metrics=metrics
+      self.compress_threads=compress_threads
+      self._debug=debug
+      # request -> [FileHasher|False, lock], in order of use
+      self.cache=collections.OrderedDict()
+      self.lock=threading.Lock()
+
+   def debug(self,*,type="INFO",msg="-"):
+      # msg may be a callable like for FileHasher.debug
+      if self._debug is not True:
+         return
+      if callable(msg):
+         msg=msg()
+      os.write(sys.stderr.fileno(), f"[{type:>20}]: {msg}\n".encode())
+
+   def get(self, request):
+      # -> locked entry of the request, the FileHasher is (re)created if the file changed.
+      stats=os.stat(request["inputfile"])
+      key=json.dumps(request,sort_keys=True)
+      evicted=[]
+      with self.lock:
+         entry=self.cache.get(key,False)
+         if entry is False:
+            entry=[False,threading.Lock()]
+            self.cache[key]=entry
+         self.cache.move_to_end(key)
+         while len(self.cache) > self.entries:
+            evicted.append(self.cache.popitem(last=False)[1])
+      for old in evicted:
+         with old[1]:
+            if old[0] is not False:
+               self.debug(type="INFO:agent",msg=f"- drop {old[0].inputfile}")
+               old[0].save_hash()
+
+      entry[1].acquire()
+      try:
+         FH=entry[0]
+         if FH is False or (FH.inputfile_stats.st_size, FH.inputfile_stats.st_mtime_ns, FH.inputfile_stats.st_ino) != (stats.st_size, stats.st_mtime_ns, stats.st_ino):
+            self.debug(type="INFO:agent",msg=f"- load {request['inputfile']}")
+            entry[0]=FileHasher(inputfile=request["inputfile"], hashfile=False, chunk_size=request["chunk_size"], max_chunk_size=request["max_chunk_size"], hash_algorithm=request["hash_algorithm"], verify_algorithm=request["verify_algorithm"], transfer_mode=request["transfer_mode"], compression=request["compression"], compress_threads=self.compress_threads, read_mode=self.read_mode, io_mode=self.io_mode, readahead=self.readahead, debug=self._debug)
+            entry[0].governor=self.governor
+            if self.metrics is not False:
+               entry[0].metrics=self.metrics
+         else:
+            self.debug(type="INFO:agent",msg=f"- cached {request['inputfile']}")
+      except Exception:
+         entry[0]=False
+         entry[1].release()
+         raise
+      return entry
+
+   def _reply(self, out_fd, status, message=""):
+      data=memoryview(status.to_bytes(1,'big')+len(message.encode()).to_bytes(4,'big')+message.encode())
+      while len(data) > 0:
+         data=data[os.write(out_fd,data):]
+
+   def serve(self, handle_in, out_fd):
+      # requests until length 0 or the end of the stream
+      while True:
+         try:
+            length=int.from_bytes(read_exact(handle_in,4),'big')
+         except Exception:
+            return
+         if length == 0:
+            return
+         request=json.loads(bytes(read_exact(handle_in,length)))
+         if request.get("version",False) != version:
+            # --version of the installed file matched, but an agent service started
+            # before an update still runs the old code
+            self._reply(out_fd,1,f"agent runs version {version}, request of version {request.get('version','-')}")
+            continue
+         try:
+            entry=self.get(request)
+         except Exception as e:
+            self._reply(out_fd,1,f"{request.get('inputfile')}: {e}"[:512])
+            continue
+         FH=entry[0]
+         try:
+            FH.stream_in=handle_in
+            FH.stream_out=out_fd
+            try:
+               if FH.max_chunk_size is False:
+                  # complete the table, nothing to read if it is already
+                  FH.hash_file(incremental=True,threading_mode=self.thread_mode,threads=self.threads,quiet=True)
+            except Exception as e:
+               entry[0]=False
+               self._reply(out_fd,1,f"{request.get('inputfile')}: {e}"[:512])
+               continue
+            self._reply(out_fd,0)
+            try:
+               if FH.max_chunk_size is False:
+                  FH.merkle_serve(handle_in=handle_in)
+               else:
+                  FH.hash_file(incremental=True,threading_mode=self.thread_mode,threads=self.threads,verify_hash_file="-",remote_delta=True)
+               FH.save_hash()
+            except Exception:
+               # state of the FileHasher is unknown, load it again next time
+               entry[0]=False
+               raise
+         finally:
+            entry[1].release()
+
+   def listen(self, path):
+      # agent service, one thread per connection (e.g. --agent relayed from ssh)
+      os.makedirs(os.path.dirname(path),exist_ok=True)
+      if os.path.exists(path):
+         connection=agent_relay_connect(path)
+         if connection is not False:
+            connection.close()
+            raise Exception(f"agent already running on {path}")
+         # stale socket
+         os.remove(path)
+      server=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+      server.bind(path)
+      os.chmod(path,0o600)
+      server.listen(8)
+      print(f"- agent listening on {path} - cache entries[{self.entries}]",flush=True)
+      try:
+         while True:
+            connection, _ = server.accept()
+            threading.Thread(target=self._connection,args=(connection,),daemon=True).start()
+      finally:
+         server.close()
+         os.remove(path)
+
+   def _connection(self, connection):
+      try:
+         with connection.makefile("rb") as handle_in:
+            self.serve(handle_in,connection.fileno())
+      except Exception as e:
+         print(f"- agent connection failed: {e}",file=sys.stderr,flush=True)
+      finally:
+         connection.close()
+
+   def close(self):
+      # save everything still in memory
+      with self.lock:
+         entries=list(self.cache.values())
+         self.cache.clear()
+      for entry in entries:
+         locked=entry[1].acquire(timeout=10)
+         try:
+            if entry[0] is not False:
+               entry[0].save_hash()
+         finally:
+            if locked is True:
+               entry[1].release()
+
+def agent_relay_connect(path):
+   # -> connected socket of a running agent service or False
+   connection=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+   try:
+      connection.connect(path)
+      return connection
+   except OSError:
+      connection.close()
+      return False
+
+def agent_relay(connection):
+   # stdin/stdout (ssh) <-> agent service
+   def upstream():
+      try:
+         while True:
+            data=sys.stdin.buffer.read1(1024*1024)
+            if not data:
+               break
+            connection.sendall(data)
+         connection.shutdown(socket.SHUT_WR)
+      except OSError:
+         # agent closed the connection already
+         pass
+   threading.Thread(target=upstream,daemon=True).start()
+   while True:
+      data=connection.recv(1024*1024)
+      if not data:
+         break
+      data=memoryview(data)
+      while len(data) > 0:
+         data=data[os.write(sys.stdout.fileno(),data):]
+   connection.close()
+
+# remote_version_check and remote.hasher.version (bash) only accept the very same
+# version on both sides: bump it with every change of the remote command line
+# (--batch-serve, --agent, ...) or of the wire protocol.
+version="1.16.0"
+
+# one governor paces all files of this process
+governor=False
+if args.max_rate is not False or args.psi_io is not False or args.psi_cpu is not False or len(args.pause_process) > 0:
+   governor=io_governor(max_rate=args.max_rate,psi_io=args.psi_io,psi_cpu=args.psi_cpu,processes=args.pause_process)
+
+# same for the metrics, written at exit. without them the counters are not kept at all.
+if args.metrics is not False or args.profile is not False:
+   metrics=run_metrics()
+else:
+   metrics=null_metrics()
+metrics_labels={}
+if args.metrics is not False:
+   for label in args.metrics_label:
+      key, _, value = label.partition("=")
+      metrics_labels[key]=value
+   if args.batch_manifest is not False:
+      metrics_labels.setdefault("mode","batch")
+   elif args.queue is not False:
+      metrics_labels.setdefault("mode","queue")
+   elif args.remote_patching is True:
+      metrics_labels.setdefault("mode","remote")
+   elif args.agent is True or args.agent_listen is True:
+      metrics_labels.setdefault("mode","agent")
+   elif args.merkle_delta is True:
+      metrics_labels.setdefault("mode","merkle")
+   elif args.apply_delta_file is not False:
+      metrics_labels.setdefault("mode","patch")
+   elif args.delta_file is not False:
+      metrics_labels.setdefault("mode","delta")
+   elif args.verify_against is not False:
+      metrics_labels.setdefault("mode","verify")
+   elif args.spot_check is not False:
+      metrics_labels.setdefault("mode","spot-check")
+   else:
+      metrics_labels.setdefault("mode","hash")
+   atexit.register(save_metrics)
+
+profiler=False
+if args.profile is not False:
+   profiler=run_profiler(filename=args.profile,metrics=metrics,tools=[ tool for tool in args.profile_with.split(",") if tool != "" ],interval=args.profile_interval)
+   profiler.start()
+   atexit.register(profiler.stop)
 
 if args.version is True:
    print(f"{version}")
@@ -1155,73 +4173,299 @@ if args.version is True:
 elif args.show_hashes is not False:
    if os.path.isfile(args.show_hashes):
       #print(f"load hashes from: {args.show_hashes}")
-      with open(args.show_hashes, 'rb') as handle:
-         data = pickle.load(handle)
+      if hash_table.is_hashfile(args.show_hashes):
+         table=hash_table.load(args.show_hashes)
+         data={
+            "inputfile": table.inputfile,
+            "version": FileHasher.chunk_file_version,
+            "algorithm": table.algorithm,
+            "chunk_size": table.chunk_size,
+            "mtime": table.mtime,
+            "size": table.size,
+            "hashes": { chunk: digest.hex() for chunk, digest in table.items() }
+         }
+         if table.max_chunk_size > 0:
+            data["max_chunk_size"]=table.max_chunk_size
+            data["spans"]={ chunk: table.span(chunk) for chunk in table.keys() }
+      else:
+         with open(args.show_hashes, 'rb') as handle:
+            data = pickle.load(handle)
       import json
       print(json.dumps(data))
    else:
       raise Exception("can not load hash file")
 
+elif len(args.state_import) > 0 or args.queue_add is not False or args.queue_remove is not False or len(args.last_ok) > 0 or len(args.last_ok_set) > 0:
+   # small changes and lookups of the state store, all of one call in one process
+   if (args.queue_add is not False or args.queue_remove is not False) and args.inputfile is False:
+      raise Exception("--queue-add/--queue-remove need --inputfile")
+   store=state_store(args.state)
+   for filename in args.state_import:
+      count=store.import_file(filename)
+      os.replace(filename,filename+".imported")
+      print(f"- import {filename}: #{count} entries")
+   if args.queue_add is not False:
+      entry={ "chunk-size": args.min_chunk_size, "hashfile": args.hashfile }
+      if args.remote_patching is True:
+         for item in hash_queue.remote_keys:
+            entry[item]=getattr(args,item.replace("-","_"))
+      store.queue_add(args.queue_add,args.inputfile,entry)
+   if args.queue_remove is not False:
+      store.queue_remove(args.queue_remove,args.inputfile)
+   if len(args.last_ok_set) > 0:
+      store.set_last_ok(args.last_ok_set)
+   for key in args.last_ok:
+      last_ok=store.last_ok(key)
+      print(-1 if last_ok is False else int(max(time.time()-last_ok,0)))
+   store.close()
+
+elif args.queue is not False:
+   # files which did not complete in time, all in this process with one worker pool.
+   # the budget is shared by weight (bytes left, time in the queue), time a file does
+   # not use goes to the next ones.
+   store=state_store(args.state)
+   queue_file=hash_queue(store,args.queue)
+   print(f"- queue[{args.queue}] of {args.state} with #{len(queue_file)} entries, budget[{args.queue_budget} sec]")
+   atexit.register(save_hash_file)
+   signal.signal(signal.SIGTERM, sigterm_handler)
+   signal.signal(signal.SIGINT, sigterm_handler)
+   signal.signal(signal.SIGHUP, sigterm_handler)
+   signal.signal(signal.SIGPIPE, sigterm_handler)
+
+   pool=False
+   if args.thread_mode == 1 or args.thread_mode == 2:
+      pool=concurrent.futures.ThreadPoolExecutor(max_workers=args.threads or multiprocessing.cpu_count())
+   # (host, user, key) -> [ssh, agent_session]
+   sessions={}
+   deadline=time.time()+args.queue_budget
+   pending=queue_file.order()
+   total=len(pending)
+   count=0
+   while len(pending) > 0 and time.time() < deadline:
+      inputfile=pending.pop(0)
+      entry=queue_file.entries[inputfile]
+      share=(deadline-time.time())*queue_file.weight(inputfile)/sum(queue_file.weight(item) for item in [inputfile]+pending)
+      share=max(share,10)
+      count+=1
+      print(f"- item[{count}/{total}] time left[{deadline-time.time():.0f} sec] share[{share:.0f} sec]")
+      print(f"  - {inputfile}")
+      if not os.path.exists(inputfile):
+         print("  - missing. drop from queue.")
+         queue_file.remove(inputfile)
+         continue
+      FH=False
+      done=False
+      try:
+         FH=FileHasher(inputfile=inputfile, chunk_size=entry["chunk-size"], max_chunk_size=args.max_chunk_size, hash_algorithm=args.hash_algorithm, verify_algorithm=args.verify_algorithm, transfer_mode=args.remote_transfer_mode, compression=args.compression, compress_threads=args.compress_threads, hashfile=entry.get("hashfile",False),read_mode=args.read_mode,io_mode=args.io_mode,readahead=args.readahead,debug=args.debug)
+         FH.governor=governor
+         FH.metrics=metrics
+         FH.shared_pool=pool
+         # at least 10 sec per file, but never beyond --queue-budget
+         FH.deadline=min(time.time()+share,deadline)
+         FH.hash_file(incremental=True,threading_mode=args.thread_mode,threads=args.threads)
+         done=FH.hash_stopped is False
+         left=max(FH.inputfile_stats.st_size-len(FH.hash_obj)*FH.chunk_size,0)
+         if done is True and entry.get("remote-hostname",False) is not False:
+            key=(entry["remote-hostname"],entry.get("remote-username",False),entry.get("remote-ssh-key",False))
+            if key not in sessions or sessions[key][1].usable is False:
+               ssh=remote_connect(hostname=key[0],username=key[1],ssh_key=key[2])
+               remote_version_check(ssh)
+               sessions[key]=[ssh,agent_session(ssh)]
+            FH.time_budget=max(FH.deadline-time.time(),0.001)
+            FH.chunk_limit=args.chunk_limit
+            counter=sessions[key][1].sync(FH,entry["remote-src-filename"],threads=args.threads)
+            done="resume" not in counter
+            left=max(FH.inputfile_stats.st_size-counter.get("resume",0)*FH.chunk_size,0)
+      except Exception as e:
+         print(f"  ! failed: {e}")
+         done=False
+         left=entry.get("left",False)
+      finally:
+         if FH is not False:
+            FH.save_hash()
+            FH=False
+      if done is True:
+         print("  - complete. drop from queue.")
+         queue_file.remove(inputfile)
+      else:
+         print("  - not complete. keep.")
+         queue_file.left(inputfile,left)
+
+   for ssh, session in sessions.values():
+      session.close()
+      ssh.close()
+   if pool is not False:
+      pool.shutdown(wait=True)
+   store.close()
+   print(f"- queue[{args.queue}] with #{len(queue_file)} entries left")
+   exit(0 if len(queue_file) == 0 else 1)
+
+elif args.remote_patching is True and args.batch_manifest is not False:
+   # many files over one ssh session and one remote process (--agent)
+   import contextlib
+   print("- Remote patching (batch)...",file=sys.stderr)
+   with (sys.stdin if args.batch_manifest == "-" else open(args.batch_manifest)) as handle:
+      manifest=[ json.loads(line) for line in handle if line.strip() != "" ]
+   report=sys.stdout if args.batch_report == "-" else open(args.batch_report,"a")
+   # regular output must not mix with the report
+   chatter=sys.stderr if report is sys.stdout else sys.stdout
+   atexit.register(save_hash_file)
+   signal.signal(signal.SIGTERM, sigterm_handler)
+   signal.signal(signal.SIGINT, sigterm_handler)
+   signal.signal(signal.SIGHUP, sigterm_handler)
+   signal.signal(signal.SIGPIPE, sigterm_handler)
+
+   index=False
+   if args.chunk_index is not False:
+      index=chunk_index(args.chunk_index)
+   ssh=False
+   session=False
+   # set once the ssh session or the remote agent could not be set up
+   connect_error=False
+   failed=0
+   paused=0
+   deadline=time.time()+args.time_budget if args.time_budget is not False else False
+   for item in manifest:
+      result={ "inputfile": item.get("inputfile",False), "remote-src-filename": item.get("remote-src-filename",False), "status": "error" }
+      s_time=time.time()
+      FH=False
+      try:
+         with contextlib.redirect_stdout(chatter):
+            if session is not False and session.usable is False:
+               # remote agent is gone or out of sync, no further file can be served
+               result["status"]="not-run"
+               raise Exception("remote session lost")
+            if connect_error is not False:
+               result["status"]="not-run"
+               raise Exception(connect_error)
+            if deadline is not False and time.time() >= deadline:
+               result["status"]="not-run"
+               raise Exception("time budget used up")
+            FH=FileHasher(inputfile=item["inputfile"], chunk_size=args.min_chunk_size, max_chunk_size=args.max_chunk_size, hash_algorithm=args.hash_algorithm, verify_algorithm=args.verify_algorithm, transfer_mode=args.remote_transfer_mode, compression=args.compression, compress_threads=args.compress_threads, hashfile=item.get("hashfile",args.hashfile),read_mode=args.read_mode,io_mode=args.io_mode,readahead=args.readahead,debug=args.debug)
+            FH.governor=governor
+            FH.metrics=metrics
+            # a large target never hashed before must not take the whole run
+            FH.deadline=deadline
+            FH.hash_file(incremental=True,threading_mode=args.thread_mode,threads=args.threads)
+            FH.save_hash()
+            if FH.hash_stopped is True:
+               result["status"]="paused"
+               result["stage"]="hash"
+               raise Exception("time budget used up while hashing")
+            FH.chunk_index=index
+            FH.time_budget=max(deadline-time.time(),0.001) if deadline is not False else False
+            FH.byte_budget=args.byte_budget
+            FH.chunk_limit=args.chunk_limit
+            if session is False:
+               try:
+                  ssh=remote_connect()
+                  remote_version_check(ssh)
+                  session=agent_session(ssh)
+               except Exception as e:
+                  # every item gets its report line, the remaining ones as not-run
+                  connect_error=f"remote connection failed: {e}"
+                  raise Exception(connect_error)
+            counter=session.sync(FH,item["remote-src-filename"],threads=args.threads)
+            if index is not False:
+               chunk_index_add(index,FH)
+         result.update(counter)
+         # paused: budget used up, the next run resumes
+         result["status"]="paused" if "resume" in counter else "ok"
+         paused+=1 if "resume" in counter else 0
+      except Exception as e:
+         if result["status"] == "paused":
+            # hashing continues next run
+            paused+=1
+         else:
+            failed+=1
+         result["error"]=str(e)
+      finally:
+         if FH is not False:
+            with contextlib.redirect_stdout(chatter):
+               FH.save_hash()
+            FH=False
+      result["seconds"]=round(time.time()-s_time,3)
+      print(json.dumps(result),file=report,flush=True)
+
+   if session is not False:
+      session.close()
+   if ssh is not False:
+      ssh.close()
+   if index is not False:
+      index.close()
+   exit(0 if failed == 0 and paused == 0 else 1)
+
 elif args.remote_patching is True:
    print("- Remote patching...")
    # local file setup
-   FH=FileHasher(inputfile=args.inputfile, chunk_size=args.min_chunk_size, hashfile=args.hashfile,debug=args.debug)
+   FH=FileHasher(inputfile=args.inputfile, chunk_size=args.min_chunk_size, max_chunk_size=args.max_chunk_size, hash_algorithm=args.hash_algorithm, verify_algorithm=args.verify_algorithm, transfer_mode=args.remote_transfer_mode, compression=args.compression, compress_threads=args.compress_threads, hashfile=args.hashfile,read_mode=args.read_mode,io_mode=args.io_mode,readahead=args.readahead,debug=args.debug)
+   FH.governor=governor
+   FH.metrics=metrics
    atexit.register(save_hash_file)
    signal.signal(signal.SIGTERM, sigterm_handler)
    signal.signal(signal.SIGINT, sigterm_handler)
    signal.signal(signal.SIGHUP, sigterm_handler)
    signal.signal(signal.SIGPIPE, sigterm_handler)
    # hash file
-   FH.hash_file(incremental=True,threading_mode=args.thread_mode)
+   FH.hash_file(incremental=True,threading_mode=args.thread_mode,threads=args.threads)
    FH.save_hash()
+   if args.chunk_index is not False:
+      FH.chunk_index=chunk_index(args.chunk_index)
+   FH.time_budget=args.time_budget
+   FH.byte_budget=args.byte_budget
+   FH.chunk_limit=args.chunk_limit
 
-   # remote connection
-   import paramiko
-   ssh = paramiko.SSHClient()
-   ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+   # remote connection, the agent keeps the remote hash table in memory if it runs as service
    try:
-      if args.remote_password is False:
-         private_key = paramiko.RSAKey.from_private_key_file(args.remote_ssh_key)
-         ssh.connect(args.remote_hostname, username=args.remote_username, pkey=private_key, look_for_keys=False,compress=False)
-      else:
-         ssh.connect(args.remote_hostname, username=args.remote_username, password=args.remote_password,compress=False)
+      ssh=remote_connect()
    except Exception as e:
-      print(f"SSH-Connect failed: {e}")
+      print(e)
+      exit(1)
+   remote_version_check(ssh)
+   session=agent_session(ssh)
+   counter=session.sync(FH,args.remote_src_filename,threads=args.threads)
+   session.close()
+   ssh.close()
+   if FH.chunk_index is not False:
+      chunk_index_add(FH.chunk_index,FH)
+      FH.chunk_index.close()
+   if "resume" in counter:
+      # budget used up, complete next time
       exit(1)
 
-   # skip version check if already done. set FILEHASHER_SKIP_VERSION
-   if os.environ.get("FILEHASHER_SKIP_VERSION",False) is False:
-      ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command("filehasher.py --version")
-      remote_version=ssh_stdout.readline().strip()
-   else:
-      remote_version=version
-
-   if remote_version == version:
-      # local and remote version match
-      with open(FH.hashfile,"rb") as handle:
-         FH.debug(type="INFO:ssh.exec_command",msg="filehasher.py --inputfile \""+args.remote_src_filename+"\" --min-chunk-size "+str(FH.chunk_size)+" --verify-against - --remote-delta")
-
-#         ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command("filehasher.py --inputfile \""+args.remote_src_filename+"\" --min-chunk-size "+str(FH.chunk_size)+" --verify-against - --remote-delta --thread-mode 1",get_pty=False)
-         ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command("filehasher.py --inputfile \""+args.remote_src_filename+"\" --min-chunk-size "+str(FH.chunk_size)+" --verify-against - --remote-delta",get_pty=False)
-         # send local hash file to remote
-         ssh_stdin.write(handle.read())
-
-         #print(ssh_stdout.read(8))
-         # patch with remote stream - sys.stdin.buffer
-#         while ssh_stdout.channel.recv_ready() is not True:
-#            time.sleep(0.1)
-#         import binascii
-         #hexString = str(binascii.hexlify(ssh_stdout.channel.recv(8)))          
-#         hexString = str(binascii.hexlify(ssh_stdout.read(8)))          
-#         print(hexString.split("'")[1].upper().replace('0X','') )
-#         with open("debug.stream","wb") as d:
-#            d.write(ssh_stdout.read())
-#         print(ssh_stderr.read())
-         FH.patch(delta_stream_handle=ssh_stdout)
-         ssh.close()
-
+elif args.index_hashfiles is not False:
+   if args.chunk_index is False:
+      raise Exception("--index-hashfiles needs --chunk-index")
+   index=chunk_index(args.chunk_index)
+   added=index.scan(args.index_hashfiles)
+   index.close()
+   print(f"- chunk index: {added} hashfiles added/updated")
+
+elif args.agent_listen is True:
+   # agent service, e.g. as systemd user service
+   agent=hash_agent(entries=args.agent_cache,thread_mode=args.thread_mode,threads=args.threads,read_mode=args.read_mode,io_mode=args.io_mode,readahead=args.readahead,compress_threads=args.compress_threads,governor=governor,metrics=metrics,debug=args.debug)
+   signal.signal(signal.SIGTERM, lambda _signal, _stack_frame: sys.exit(0))
+   signal.signal(signal.SIGHUP, lambda _signal, _stack_frame: sys.exit(0))
+   try:
+      agent.listen(args.agent_socket)
+   except KeyboardInterrupt:
+      pass
+   finally:
+      agent.close()
+
+elif args.agent is True:
+   # remote side of remote patching and --batch-manifest. with a running agent service
+   # the hash tables are in memory already, otherwise served by this process.
+   connection=agent_relay_connect(args.agent_socket)
+   if connection is not False:
+      agent_relay(connection)
    else:
-      raise Exception("local and remote version do not match")
+      agent=hash_agent(entries=args.agent_cache,thread_mode=args.thread_mode,threads=args.threads,read_mode=args.read_mode,io_mode=args.io_mode,readahead=args.readahead,compress_threads=args.compress_threads,governor=governor,metrics=metrics,debug=args.debug)
+      try:
+         agent.serve(sys.stdin.buffer,sys.stdout.fileno())
+      finally:
+         agent.close()
+   exit(0)
 
 elif args.inputfile is False:
    print("please use -h for help.")
@@ -1229,7 +4473,9 @@ elif args.inputfile is False:
 
 else:
    #print (args)
-   FH=FileHasher(inputfile=args.inputfile, chunk_size=args.min_chunk_size, hashfile=args.hashfile,debug=args.debug)
+   FH=FileHasher(inputfile=args.inputfile, chunk_size=args.min_chunk_size, max_chunk_size=args.max_chunk_size, hash_algorithm=args.hash_algorithm, verify_algorithm=args.verify_algorithm, transfer_mode=args.remote_transfer_mode, compression=args.compression, compress_threads=args.compress_threads, hashfile=args.hashfile,read_mode=args.read_mode,io_mode=args.io_mode,readahead=args.readahead,debug=args.debug)
+   FH.governor=governor
+   FH.metrics=metrics
 
    if args.report_used_hashfile is True:
       print(f"{FH.hashfile}")
@@ -1244,13 +4490,37 @@ else:
    #sys.stdout.buffer.write(b"1000")
 #   print(b'\x01\x00\x00\x00\x00\x00\x00\x00')
 
-   if args.apply_delta_file is False:
+   if args.spot_check is not False:
+      # cheap integrity check of a backup copy, full scrubs with --verify-against.
+      # read only, an outdated hashfile stays as it is.
+      FH.save_hashes=False
+      try:
+         report=FH.spot_check(sample=args.spot_check)
+      except Exception as e:
+         # could not check, not a damaged copy
+         print(f"- spot check failed: {e}")
+         exit(2)
+      if len(report["mismatched"]) == 0:
+         print(f"- spot check: {report['sampled']} of {report['chunks']} chunks match, with 95% confidence less than {report['bad_fraction_95']*100:.3f}% differ")
+      else:
+         print(f"- spot check: {len(report['mismatched'])} of {report['sampled']} sampled chunks do not match ({report['bad_fraction']*100:.3f}%)")
+      print(f"- verified within 30 days[{report['verified_30d']*100:.1f}%] never verified[{report['never_verified']}] unhashed[{report['unhashed']}]")
+      print(json.dumps(report))
+      exit(0 if len(report["mismatched"]) == 0 else 3)
+
+   if args.merkle_delta is True:
+      # remote side of remote-patching, stdout carries the protocol only.
+      FH.hash_file(incremental=True,threading_mode=args.thread_mode,threads=args.threads,quiet=True)
+      FH.merkle_serve(handle_in=sys.stdin.buffer)
+      exit(0)
+
+   elif args.apply_delta_file is False:
 
       # normal hashing + local delta + remote delta
       if args.force_refresh is True:
-         FH.hash_file(incremental=False,threading_mode=args.thread_mode,verify_hash_file=args.verify_against,local_delta_file=args.delta_file,remote_delta=args.remote_delta)
+         FH.hash_file(incremental=False,threading_mode=args.thread_mode,threads=args.threads,verify_hash_file=args.verify_against,local_delta_file=args.delta_file,remote_delta=args.remote_delta)
       else:
-         FH.hash_file(incremental=True,threading_mode=args.thread_mode,verify_hash_file=args.verify_against,local_delta_file=args.delta_file,remote_delta=args.remote_delta)
+         FH.hash_file(incremental=True,threading_mode=args.thread_mode,threads=args.threads,verify_hash_file=args.verify_against,local_delta_file=args.delta_file,remote_delta=args.remote_delta)
 
       # TODO: check remote-delta response.
       # verify_against result
@@ -1271,7 +4541,7 @@ else:
    elif args.apply_delta_file is not False:
       print(f"- file to be patched: {args.inputfile}")
       print(f"- delta file:         {args.apply_delta_file}")
-      FH.patch(delta_file=args.apply_delta_file)
+      FH.patch(delta_file=args.apply_delta_file,threads=args.threads)
       pass
 
    else: